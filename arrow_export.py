@@ -0,0 +1,99 @@
+from pathlib import Path
+import pandas as pd
+
+########################################################################
+# Export of simulation results as Arrow IPC files (Feather v2). Every
+# kind of result has a fixed schema so that downstream readers do not
+# depend on whatever dtypes pandas inferred for a particular run.
+# pyarrow is only needed when something is exported.
+########################################################################
+ARROW_EXPORT_DIR = "./plumsim_arrow"
+
+def schemas():
+    import pyarrow as pa
+
+    ts = pa.timestamp( "ns" )
+    return { "trades" : pa.schema( [ ( "Ticker", pa.string() ), ( "Date", ts ), ( "SellDate", ts ), ( "Type", pa.string() ),
+                                     ( "Strategy", pa.string() ), ( "BuyPrice", pa.float64() ), ( "SellPrice", pa.float64() ),
+                                     ( "Quantity", pa.float64() ), ( "Profit", pa.float64() ), ( "Invested", pa.float64() ),
+                                     ( "Profits", pa.float64() ), ( "AggregateProfits", pa.float64() ) ] ),
+             "ledgers" : pa.schema( [ ( "Ticker", pa.string() ), ( "Date", ts ), ( "Type", pa.string() ), ( "Strategy", pa.string() ),
+                                      ( "Price", pa.float64() ), ( "Quantity", pa.float64() ) ] ),
+             "open_lots" : pa.schema( [ ( "Ticker", pa.string() ), ( "BuyDate", ts ), ( "Type", pa.string() ),
+                                        ( "BuyPrice", pa.float64() ), ( "StopPrice", pa.float64() ), ( "Quantity", pa.float64() ) ] ),
+             "equity" : pa.schema( [ ( "Date", ts ), ( "Equity", pa.float64() ) ] ) }
+
+def toTable( frame, kind ):
+    """Converts one of the result frames of the simulator to an Arrow table with the schema of its kind
+    """
+    import pyarrow as pa
+
+    schema = schemas()[ kind ]
+    if kind == "equity":
+        frame = pd.DataFrame( { "Date" : frame.index, "Equity" : frame.values } ) if len( frame ) else pd.DataFrame()
+
+    columns = {}
+    for field in schema:
+        if field.name not in frame:
+            columns[ field.name ] = pa.nulls( len( frame ), type=field.type )
+            continue
+        values = frame[ field.name ]
+        if pa.types.is_string( field.type ):
+            # Trade types are TradeType members in the ledgers
+            values = values.map( lambda v: getattr( v, "name", v ) ).astype( "string" )
+        elif pa.types.is_timestamp( field.type ):
+            values = pd.to_datetime( values )
+        else:
+            values = pd.to_numeric( values )
+        columns[ field.name ] = pa.array( values, type=field.type, from_pandas=True )
+    return pa.Table.from_arrays( list( columns.values() ), schema=schema )
+
+class ArrowExporter( object ):
+    """Writes the results of one simulation to out_dir. The per ticker ledgers are streamed into
+    ledgers.arrow while the simulation runs, a record batch per ticker, the rest is written at the end
+    """
+    def __init__( self, out_dir=ARROW_EXPORT_DIR ) -> None:
+        self.out_dir = Path( out_dir )
+        self.writer = None
+        self.sink = None
+
+    def path( self, kind ):
+        return self.out_dir.joinpath( f"{kind}.arrow" )
+
+    def open( self ):
+        import pyarrow as pa
+
+        self.out_dir.mkdir( parents=True, exist_ok=True )
+        self.sink = pa.OSFile( str( self.path( "ledgers" ) ), "wb" )
+        self.writer = pa.ipc.new_file( self.sink, schemas()[ "ledgers" ] )
+
+    def writeLedger( self, ledger ):
+        if self.writer is not None and ledger is not None and not ledger.empty:
+            self.writer.write_table( toTable( ledger, "ledgers" ) )
+
+    def close( self ):
+        if self.writer is not None:
+            self.writer.close()
+            self.sink.close()
+            self.writer = None
+
+    def write( self, kind, frame ):
+        import pyarrow.feather as feather
+
+        self.out_dir.mkdir( parents=True, exist_ok=True )
+        feather.write_feather( toTable( frame, kind ), str( self.path( kind ) ), compression="uncompressed" )
+
+    def finish( self, trades, openLots, equity ):
+        self.close()
+        self.write( "trades", trades )
+        self.write( "open_lots", openLots )
+        self.write( "equity", equity )
+        print( f"results exported to {self.out_dir}" )
+
+def readTable( path ):
+    """Memory maps an exported file, the columns of the table point into the file instead of being copied
+    """
+    import pyarrow as pa
+
+    with pa.memory_map( str( path ), "r" ) as source:
+        return pa.ipc.open_file( source ).read_all()
@@ -0,0 +1,298 @@
+import time, json
+import argparse
+import socket
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+from builtin_commands import Commands
+from indicator_state import IndicatorState, IndicatorStore
+
+########################################################################
+# Event-driven replay of a parsed strategy. Bars are pushed one at a time,
+# per ticker, from the stored data, a .csv file or a socket standing in
+# for a live feed. The indicators are moved forward with IndicatorState,
+# the stop losses, BUY and SELL rules are evaluated on the bar as it
+# arrives and every fill is emitted as an event.
+#
+# Only daily rules can be replayed, and only BUY rules that buy on the bar
+# they trigger on. As in TradeEngine, the day a lot is bought is day 1 of
+# its sell timeframes, stop losses are not active on the day they are set
+# and sales close the most recent lots first.
+########################################################################
+Fill = namedtuple( "Fill", "Date Ticker Side Rule Price Quantity" )
+
+class Lot( object ):
+    def __init__( self, date, rule, price, qty ) -> None:
+        self.date = date
+        self.rule = rule
+        self.price = price
+        self.qty = qty
+        self.open = qty
+        self.days = 0
+
+class TickerBook( object ):
+    """Indicator state, open lots and live stop losses of one ticker
+    """
+    def __init__( self, state ) -> None:
+        self.state = state
+        self.lots = []
+        self.stops = []
+
+class ReplayEngine( object ):
+    """Replays bars through a strategy. latencyBudget is the time a bar should take, it is only measured:
+    the bars that take longer are counted in overruns and none of them is cut short or dropped
+    """
+    def __init__( self, strategyInfo, params, data_dir, latencyBudget=0.005, onFill=None ) -> None:
+        self.params = dict( params )
+        self.indicators = Commands().parse( strategyInfo[ "code" ] )
+        self.store = IndicatorStore( data_dir )
+        self.buyRules = self.compileRules( strategyInfo[ "BUY" ], buy=True )
+        self.sellRules = self.compileRules( strategyInfo[ "SELL" ] )
+        self.latencyBudget = latencyBudget
+        self.onFill = onFill
+        self.books = {}
+        self.fills = []
+        self.latencies = []
+        self.overruns = 0
+        self.errors = 0
+
+    def compileRules( self, strategy, buy=False ):
+        rules = []
+        for name, ( timeframe, qty, condition, priceCondition, stopLoss ) in strategy.items():
+            ( d1, t1, d2, t2 ) = timeframe
+            if d1 != "Day":
+                print( f"{name}: only daily rules can be replayed, skipped." )
+                continue
+            # A BUY on a later day or over several days would need the trigger kept pending per ticker
+            if buy and ( t1 > 1 or d2 is not None ):
+                print( f"{name}: only rules on the daily bar of the trigger can be replayed, skipped." )
+                continue
+            rules += [ ( name, timeframe, qty, compile( condition, "<replay>", "eval" ),
+                         compile( priceCondition, "<replay>", "eval" ) if priceCondition else None,
+                         compile( stopLoss, "<replay>", "eval" ) if stopLoss else None ) ]
+        return rules
+
+    def book( self, ticker, date ):
+        """The book of ticker, with the indicators warmed up on the stored history before date
+        """
+        book = self.books.get( ticker )
+        if book is None:
+            history = self.store.history( ticker )
+            if not history.empty:
+                history = history.loc[ history.index < date ]
+            book = TickerBook( IndicatorState( self.indicators ).build( history ) )
+            self.books[ ticker ] = book
+        return book
+
+    def inTimeframe( self, timeframe, day ):
+        ( d1, t1, d2, t2 ) = timeframe
+        if d2 is None:
+            return day == max( t1, 1 )
+        elif d2 == "Day":
+            return t1 <= day < t2
+        elif d2 == "All":
+            return day >= max( t1, 1 )
+        return False
+
+    def fill( self, date, ticker, side, rule, price, qty ):
+        fill = Fill( date, ticker, side, rule, price, qty )
+        self.fills += [ fill ]
+        if self.onFill:
+            self.onFill( fill )
+        return fill
+
+    def sell( self, book, qty ):
+        """Takes qty off the open lots, most recent first, and returns the quantity actually sold
+        """
+        sold = 0
+        while book.lots and sold < qty:
+            lot = book.lots[ -1 ]
+            take = min( lot.open, qty - sold )
+            lot.open -= take
+            sold += take
+            if not lot.open:
+                book.lots.pop()
+        return sold
+
+    def onBar( self, ticker, bar ):
+        """Processes one bar of ticker, a dict with Date, Open, High, Low, Close and volume.
+        Returns the fills it caused
+        """
+        # Warming up a ticker the first time it is seen is a one off, it is not counted against the budget
+        book = self.book( ticker, bar[ "Date" ] )
+        start = time.perf_counter()
+        book.state.update( bar )
+        values = book.state.values()
+        env = self.params
+        date = bar[ "Date" ]
+        fills = []
+
+        # Stop losses set on an earlier bar
+        keep = []
+        for ( price, qty, setDate ) in book.stops:
+            if setDate != date and values[ "Low" ] < price:
+                qty = self.sell( book, qty )
+                if qty:
+                    fills += [ self.fill( date, ticker, "SELL", "STOP", min( values[ "Open" ], price ) * ( 1 - env.get( "DISPERSION", 0 ) ), qty ) ]
+            else:
+                keep += [ ( price, qty, setDate ) ]
+        book.stops = keep
+
+        for lot in book.lots:
+            lot.days += 1
+
+        # A rule that fails on a bar is skipped for that bar only, the other rules and tickers go on.
+        # Everything a rule needs is evaluated before the book is touched
+        for ( name, timeframe, qty, condition, price, stopLoss ) in self.buyRules:
+            try:
+                if not eval( condition, env, values ):
+                    continue
+                buyPrice = eval( price, env, values ) if price else values[ "Close" ]
+                stop = eval( stopLoss, env, values ) if stopLoss else None
+            except Exception as e:
+                self.ruleError( ticker, date, name, e )
+                continue
+            held = sum( lot.open for lot in book.lots )
+            qty = min( qty, env.get( "MAX_POSITION_SIZE", qty ) - held )
+            if qty <= 0:
+                continue
+            lot = Lot( date, name, buyPrice, qty )
+            lot.days = 1
+            book.lots += [ lot ]
+            fills += [ self.fill( date, ticker, "BUY", name, lot.price, qty ) ]
+            if stopLoss:
+                book.stops += [ ( stop, qty, date ) ]
+
+        for lot in list( reversed( book.lots ) ):
+            env[ "Price" ] = lot.price
+            for ( name, timeframe, qty, condition, price, stopLoss ) in self.sellRules:
+                if not lot.open or not self.inTimeframe( timeframe, lot.days ):
+                    continue
+                try:
+                    if not eval( condition, env, values ):
+                        continue
+                    sellPrice = eval( price, env, values ) if price else values[ "Close" ]
+                    stop = eval( stopLoss, env, values ) if stopLoss else None
+                except Exception as e:
+                    self.ruleError( ticker, date, name, e )
+                    continue
+                sold = min( lot.open, lot.qty * qty )
+                lot.open -= sold
+                fills += [ self.fill( date, ticker, "SELL", name, sellPrice, sold ) ]
+                if stopLoss and lot.open:
+                    book.stops += [ ( stop, lot.open, date ) ]
+        book.lots = [ lot for lot in book.lots if lot.open ]
+
+        elapsed = time.perf_counter() - start
+        self.latencies += [ elapsed ]
+        if elapsed > self.latencyBudget:
+            self.overruns += 1
+        return fills
+
+    def ruleError( self, ticker, date, name, e ):
+        self.errors += 1
+        print( f"{date:%Y-%m-%d} {ticker} {name} failed, skipped for this bar: {type( e ).__name__}: {e}" )
+
+    def run( self, source, interval=0 ):
+        """Replays all the ( ticker, bar ) events of source, interval seconds apart
+        """
+        for ticker, bar in source:
+            self.onBar( ticker, bar )
+            if interval:
+                time.sleep( interval )
+        return self.fills
+
+    def latencyStats( self ):
+        if not self.latencies:
+            return { "bars" : 0 }
+        lat = np.array( self.latencies ) * 1e6
+        return { "bars" : len( lat ),
+                 "mean us" : round( float( lat.mean() ), 1 ),
+                 "p50 us" : round( float( np.percentile( lat, 50 ) ), 1 ),
+                 "p99 us" : round( float( np.percentile( lat, 99 ) ), 1 ),
+                 "max us" : round( float( lat.max() ), 1 ),
+                 "budget us" : round( self.latencyBudget * 1e6, 1 ),
+                 "over budget" : self.overruns,
+                 "rule errors" : self.errors }
+
+    def openLots( self ):
+        lots = [ ( t, lot.date, lot.rule, lot.price, lot.open ) for t, book in self.books.items() for lot in book.lots ]
+        return pd.DataFrame( lots, columns=[ "Ticker", "BuyDate", "Rule", "BuyPrice", "Quantity" ] )
+
+########################################################################
+# Sources of bars, all of them yield ( ticker, bar ) in time order
+########################################################################
+def barFromRecord( record ):
+    """Accepts the lower case column names of the stored data as well as the capitalized ones
+    """
+    get = lambda k: record[ k ] if k in record else record.get( k.capitalize() )
+    return { "Date" : pd.to_datetime( get( "date" ) ), "Open" : float( get( "open" ) ), "High" : float( get( "high" ) ),
+             "Low" : float( get( "low" ) ), "Close" : float( get( "close" ) ), "volume" : get( "volume" ),
+             "symbol" : get( "symbol" ) }
+
+def storedBars( data_dir, tickers, startDate=None, endDate=None ):
+    store = IndicatorStore( data_dir )
+    frames = []
+    for t in tickers:
+        data = store.history( t )
+        if not data.empty:
+            frames += [ data.loc[ startDate : endDate ].assign( Ticker=t ) ]
+    if not frames:
+        return
+    data = pd.concat( frames ).sort_index( kind="stable" )
+    for row in data.itertuples():
+        yield ( row.Ticker, { "Date" : row.Index, "Open" : row.Open, "High" : row.High, "Low" : row.Low,
+                              "Close" : row.Close, "volume" : row.volume, "symbol" : row.symbol } )
+
+def fileBars( path, ticker=None ):
+    """A .csv file of daily bars, with a ticker or symbol column unless ticker is given
+    """
+    data = pd.read_csv( path )
+    data = data.sort_values( by="date", kind="stable" )
+    for record in data.to_dict( "records" ):
+        yield ( ticker or record.get( "ticker" ) or record.get( "symbol" ), barFromRecord( record ) )
+
+def socketBars( address ):
+    """Bars sent as lines of json by a feed listening on host:port or unix:/path
+    """
+    from simulator_worker import connect
+
+    sock = connect( address )
+    with sock, sock.makefile( "r" ) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads( line )
+                yield ( record.get( "ticker" ) or record.get( "symbol" ), barFromRecord( record ) )
+
+def serveFeed( address, path, interval=0 ):
+    """A stand-in for a live feed: sends the bars of a .csv file to the first client that connects
+    """
+    if address.startswith( "unix:" ):
+        server = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        server.bind( address[ len( "unix:" ): ] )
+    else:
+        host, port = address.rsplit( ":", 1 )
+        server = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        server.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+        server.bind( ( host, int( port ) ) )
+    server.listen( 1 )
+    print( f"feed listening on {address}" )
+
+    conn, _ = server.accept()
+    with conn:
+        for record in pd.read_csv( path ).sort_values( by="date", kind="stable" ).to_dict( "records" ):
+            conn.sendall( ( json.dumps( record, default=str ) + "\n" ).encode() )
+            if interval:
+                time.sleep( interval )
+    server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description="Bar feed stand-in for PlumSim replay" )
+    parser.add_argument( "address", help="host:port or unix:/path/to/socket to listen on" )
+    parser.add_argument( "file", help=".csv file of daily bars with a ticker or symbol column" )
+    parser.add_argument( "--interval", type=float, default=0, help="seconds between bars" )
+    args = parser.parse_args()
+
+    serveFeed( args.address, args.file, args.interval )
@@ -0,0 +1,219 @@
+import os, sys, io, time, contextlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import pandas as pd
+import yaml
+
+import trade_engine
+from trade_engine import TradeEngine
+from ticker_data import DataLoader
+from builtin_commands import Commands
+from perf_metrics import PerformanceMetrics
+import simulator
+from simulator import Simulator, PlumsimConfig
+
+########################################################################
+# Non-interactive runner for a matrix of (strategy, universe, window)
+# jobs. The jobs are regrouped by ticker, so that every ticker is loaded
+# and its indicators computed once for all the jobs that trade it, and
+# the tickers are spread over a pool of processes. With fewer tickers
+# than processes the jobs of a ticker are split over several processes,
+# the ticker is then loaded once into shared memory and the processes
+# attach to it instead of each loading their own copy.
+#
+# A job file looks like:
+#
+#   strategy_file: ./Strategy1.simulate
+#   output: ./batch_results
+#   jobs:
+#     - name: s1_all
+#       strategy: S1
+#       tickers: AAA BBB watchlist.csv     # or "where avg_volume > 1e6 and price > 5"
+#       start: 2017-01-01
+#       end: 2019-12-31
+#       params:                            # optional overrides of the strategy PARAMS
+#         INIT_CAP: 20000
+########################################################################
+class BatchJob( object ):
+    def __init__( self, name, strategy, strategyInfo, params, tickers ) -> None:
+        self.name = name
+        self.strategy = strategy
+        self.strategyInfo = strategyInfo
+        self.params = params
+        self.tickers = tickers
+
+def loadJobs( jobFile ):
+    """Parses the job file into BatchJobs, with the strategies parsed the same way the shell does
+    """
+    with open( jobFile, 'r' ) as f:
+        spec = yaml.load( f, Loader=yaml.FullLoader )
+
+    if spec.get( "strategy_file" ):
+        simulator.STRATEGY_FILE = spec[ "strategy_file" ]
+
+    config = PlumsimConfig()
+    config.headless = True
+    sim = Simulator( config=config )
+
+    jobs = []
+    for i, job in enumerate( spec.get( "jobs", [] ) ):
+        name = str( job.get( "name", f"job{i + 1}" ) )
+        with contextlib.redirect_stdout( io.StringIO() ):
+            sim.loadStrategy( job[ "strategy" ] )
+            sim.setTickers( str( job[ "tickers" ] ) )
+        if sim._curStrategy != job[ "strategy" ]:
+            print( f"{name}: strategy {job[ 'strategy' ]} not found, skipped." )
+            continue
+
+        params = dict( sim.params )
+        params.update( job.get( "params" ) or {} )
+        for key, option in ( ( "START_DATE", "start" ), ( "END_DATE", "end" ) ):
+            if job.get( option ):
+                params[ key ] = str( job[ option ] )
+
+        jobs += [ BatchJob( name, job[ "strategy" ], sim.strategyInfo[ job[ "strategy" ] ], params, sorted( sim.tickers ) ) ]
+    return spec, jobs
+
+def runTickerJobs( ticker, jobs, dataDir, compact=False, verbose=False, descriptors=None ):
+    """Runs all the jobs for one ticker in a worker process. The data is loaded once, or attached from
+    the shared memory blocks DataLoader.publish() left in descriptors, and the indicators of all the
+    strategies are computed once over the whole history, every job then only copies its window out of it.
+    Returns { job name : ( trades, seconds ) } and the seconds spent on loading and indicators.
+    """
+    from shared_data import SharedFrame
+
+    trade_engine.DATA_DIR = dataDir
+    config = PlumsimConfig()
+    config.compactData = compact
+    results = {}
+
+    out = sys.stdout if verbose else io.StringIO()
+    with contextlib.redirect_stdout( out ):
+        start = time.perf_counter()
+        shared = {}
+        trader = None
+        if descriptors is not None:
+            shared = { period : SharedFrame.attach( d ) for period, d in descriptors.items() }
+            daily = shared[ "daily" ].frame() if "daily" in shared else None
+            intraday = shared[ "intraday" ].frame() if "intraday" in shared else None
+        else:
+            loader = DataLoader( dataDir, compact=compact )
+            daily = loader.data( ticker, period="daily" )
+            intraday = loader.data( ticker, period="intraday" )
+        if daily is None:
+            return ticker, results, time.perf_counter() - start
+
+        TradeEngine.prepareData( daily )
+        Commands( compact=compact ).compile( " ".join( job.strategyInfo[ "code" ] for job in jobs ), daily )
+        seconds = time.perf_counter() - start
+
+        for job in jobs:
+            start = time.perf_counter()
+            try:
+                trader = TradeEngine( ticker, job.strategyInfo, dict( job.params ), config, data=daily, intradayData=intraday )
+                trader.run()
+                startDate = pd.to_datetime( job.params.get( "START_DATE" ) )
+                endDate = pd.to_datetime( job.params.get( "END_DATE" ) )
+                trades = trader.tradeRange( startDate, endDate )
+            except Exception as e:
+                print( f"{ticker} {job.name}: {type( e ).__name__}: {e}", file=sys.__stdout__ )
+                trades = None
+            results[ job.name ] = ( trades, time.perf_counter() - start )
+
+    # The views on the shared blocks have to be gone before the blocks can be closed
+    del daily, intraday, trader
+    for block in shared.values():
+        block.close()
+    return ticker, results, seconds
+
+def summarize( job, trades, seconds ):
+    row = { "job" : job.name, "strategy" : job.strategy, "tickers" : len( job.tickers ),
+            "start" : job.params.get( "START_DATE" ), "end" : job.params.get( "END_DATE" ),
+            "trades" : len( trades ), "seconds" : round( seconds, 3 ) }
+    if not trades.empty:
+        row.update( PerformanceMetrics( trades, job.params[ "INIT_CAP" ] ).summary() )
+    return row
+
+def runBatch( jobFile, procs=None, output=None, verbose=False ):
+    spec, jobs = loadJobs( jobFile )
+    output = Path( output or spec.get( "output", "./batch_results" ) )
+    output.mkdir( parents=True, exist_ok=True )
+    compact = bool( spec.get( "compact", False ) )
+
+    byTicker = {}
+    for job in jobs:
+        for t in job.tickers:
+            byTicker.setdefault( t, [] ).append( job )
+    print( f"{len( jobs )} jobs over {len( byTicker )} tickers" )
+
+    # With processes to spare, the jobs of a ticker are split over several of them. Those tickers are
+    # published to shared memory once here, instead of being loaded again by every process
+    start = time.perf_counter()
+    procs = procs or os.cpu_count() or 1
+    splits = max( 1, procs // max( len( byTicker ), 1 ) )
+    tasks = []
+    published = []
+    loader = DataLoader( trade_engine.DATA_DIR, compact=compact )
+    for t, tickerJobs in byTicker.items():
+        parts = min( splits, len( tickerJobs ) )
+        descriptors = None
+        if parts > 1:
+            with contextlib.redirect_stdout( sys.stdout if verbose else io.StringIO() ):
+                blocks = loader.publish( t )
+            published += blocks.values()
+            descriptors = { period : block.descriptor for period, block in blocks.items() }
+        tasks += [ ( t, tickerJobs[ i : : parts ], descriptors ) for i in range( parts ) ]
+
+    trades = { job.name : [] for job in jobs }
+    seconds = { job.name : 0.0 for job in jobs }
+    sharedSeconds = 0.0
+    try:
+        with ProcessPoolExecutor( max_workers=procs ) as pool:
+            futures = [ pool.submit( runTickerJobs, t, taskJobs, trade_engine.DATA_DIR, compact, verbose, descriptors )
+                        for t, taskJobs, descriptors in tasks ]
+            for done, future in enumerate( as_completed( futures ), 1 ):
+                ticker, results, shared = future.result()
+                sharedSeconds += shared
+                for name, ( jobTrades, elapsed ) in results.items():
+                    seconds[ name ] += elapsed
+                    if jobTrades is not None and not jobTrades.empty:
+                        trades[ name ] += [ jobTrades ]
+                print( f"[{done}/{len( futures )}] {ticker}" )
+    finally:
+        for block in published:
+            block.unlink()
+
+    # Profits are sized the same way simulate does it, with the params of every job
+    sim = Simulator( config=PlumsimConfig() )
+    summary = []
+    for job in jobs:
+        jobTrades = pd.concat( trades[ job.name ] ) if trades[ job.name ] else pd.DataFrame()
+        if not jobTrades.empty:
+            jobTrades.sort_values( by=[ "Date" ], inplace=True )
+            sim.params = job.params
+            sim.calcPnl( jobTrades )
+            jobTrades.to_csv( output.joinpath( f"{job.name}.trades.csv" ) )
+        summary += [ summarize( job, jobTrades, seconds[ job.name ] ) ]
+
+    summary = pd.DataFrame( summary ).set_index( "job" )
+    summary.to_csv( output.joinpath( "summary.csv" ) )
+    print( summary.to_string() )
+    print( f"total {time.perf_counter() - start:.2f}s, of which {sharedSeconds:.2f}s loading data and indicators shared by the jobs" )
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description="PlumSim batch runner" )
+    parser.add_argument( "jobs", help="YAML file with the jobs to run" )
+    parser.add_argument( "--procs", type=int, default=None, help="number of worker processes, one per CPU by default" )
+    parser.add_argument( "--output", default=None, help="directory for the results, overrides the job file" )
+    parser.add_argument( "--data-dir", default=None, help="data directory" )
+    parser.add_argument( "--verbose", action="store_true" )
+    args = parser.parse_args()
+
+    if args.data_dir:
+        trade_engine.DATA_DIR = args.data_dir
+        simulator.DATA_DIR = args.data_dir
+    pd.set_option( "display.max_rows", None )
+    runBatch( args.jobs, args.procs, args.output, args.verbose )
@@ -1,9 +1,18 @@
 import numpy as np
+import pandas as pd
 from re import match, search, findall
 
+# Exponential averages never fully forget old values, so we give them a few spans of
+# history before their values are close enough to the full-history result
+EMA_WARMUP_SPANS = 4
+
+# Names of the days of the week, in the order of DatetimeIndex.dayofweek
+WEEKDAYS = [ "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday" ]
+
 class Commands( object ):
-    def __init__( self ) -> None:
+    def __init__( self, compact=False ) -> None:
         super().__init__()
+        self.compact = compact
         self.tokens = [ ( r"[^a-zA-Z]([Mm][Aa])(\d\d?\d?)", "movingAvg" ),
                         ( r"[^a-zA-Z]([Ee][Mm][Aa])(\d\d?\d?)", "expMovingAvg" ),
                         ( r"[^a-zA-Z]([Aa][Dd][Rr])(\d\d?\d?)?", "adr" ),
@@ -22,11 +31,59 @@ class Commands( object ):
             regex, fname = token
             allMatches = set( findall( regex, code ) )
             for m in allMatches:
+                # Data shared between strategies can come with some of the indicators already computed
+                if ''.join( m ) in data:
+                    continue
                 indicators += [ ''.join( m ) ]
                 func = getattr( self, fname )
                 func( data, *m )
+
+        # Indicators are derived from float32 prices in the compact representation, keep them that way
+        if self.compact:
+            for name in indicators:
+                if name in data and data[ name ].dtype == "float64":
+                    data[ name ] = data[ name ].astype( "float32" )
         print( f"compiled {indicators}" )
 
+    def indicators( self, code ):
+        """Returns the names of all the indicators used in code
+        """
+        return set( self.parse( code ) )
+
+    def parse( self, code ):
+        """Returns { indicator name : ( function name, label, n ) } for the indicators used in code
+        """
+        indicators = {}
+        for token in self.tokens:
+            regex, fname = token
+            for m in findall( regex, code ):
+                indicators[ ''.join( m ) ] = ( fname, *m )
+        return indicators
+
+    def warmup( self, code ):
+        """Returns the number of bars of history needed before the indicators used in code are valid
+        """
+        bars = 0
+        for token in self.tokens:
+            regex, fname = token
+            for m in set( findall( regex, code ) ):
+                bars = max( bars, self.lookback( fname, *m ) )
+        return bars
+
+    def lookback( self, fname, label, n ):
+        if fname in ( "movingAvg", "trend" ):
+            _, n = self.processLabel( label, n )
+        elif fname == "expMovingAvg":
+            _, n = self.processLabel( label, n )
+            n = n * EMA_WARMUP_SPANS
+        elif fname == "adr":
+            _, n = self.processLabel( label, n, 20 )
+        elif fname in ( "range", "dayOfWeek" ):
+            n = 0
+        else:
+            _, n = self.processLabel( label, n, 1 )
+        return n
+
     def processLabel( self, label, n, default=1 ):
         if not n:
             name = label
@@ -58,7 +115,11 @@ class Commands( object ):
     # Code for indicators starts from here
     ########################################################################
     def dayOfWeek( self, data, label, *kargs, **kwargs ):
-        data[ label ] = data.index.strftime( '%A' )
+        if self.compact:
+            # int8 codes into the names of the days instead of a string per row
+            data[ label ] = pd.Categorical.from_codes( data.index.dayofweek.astype( "int8" ), categories=WEEKDAYS )
+        else:
+            data[ label ] = data.index.strftime( '%A' )
 
     def movingAvg( self, data, label, n ):
         name, n = self.processLabel( label, n )
@@ -0,0 +1,245 @@
+import sys, io, time, contextlib
+import argparse
+import numpy as np
+import pandas as pd
+
+import trade_engine
+from trade_engine import TradeEngine
+from ticker_data import DataLoader, COMPACT_PRICE_COLUMNS, COMPACT_PRICE_DTYPE
+from strategy_ast import analyze
+from simulator import Simulator, PlumsimConfig
+
+########################################################################
+# Differential testing of the accelerated evaluation modes of TradeEngine
+# and of its compact data representation against the row by row reference. Random strategies are run on
+# synthetic data, and optionally on stored tickers, once per mode; the
+# positions, the ledgers and the consolidated trades with their PnL must
+# match the reference within the tolerances. Reports the speedup of every
+# case and exits with 1 if any case differs.
+#
+#   python diff_harness.py --cases 50 --seed 7
+#   python diff_harness.py --cases 10 --data-dir ./data --tickers AAPL MSFT
+########################################################################
+
+# Config overrides of every mode, the reference runs with none. compactData runs on the compact representation
+# of the data, its reference on the same float32 prices held as float64
+MODES = { "fastEval" : { "fastEval" : True },
+          "compactData" : { "compactData" : True } }
+
+# Building blocks of the random strategies, all of them expressions the engine accepts as written in a strategy file
+DAILY_CONDITIONS = [ "Close > MA20", "Close < MA20", "MA20 > MA50", "MA20 < MA50", "Close > EMA20", "Close < EMA20",
+                     "PrevClose < MA20", "Close > PrevHigh", "Close < PrevLow", "GapOpen > 0.005", "GapOpen < -0.005",
+                     "ADR > 0.02", "Range > 0.02", "PrevRange < 0.03", "Close > Open", "Close < Open", "volume > 1e6",
+                     "DayOfWeek == 'Monday'", "DayOfWeek != 'Friday'", "Close > PrevClose2", "Close > MA20 and MA20 > MA50" ]
+INTRADAY_CONDITIONS = [ "close > open * 1.001", "close < open * 0.999", "volume > 3000", "not close < open",
+                        "Index >= '15:30'", "Index < '10:00'", "close > open and volume > 2000" ]
+DAILY_PRICES = [ None, "Close", "Open", "Close * 1.001", "( High + Low ) / 2" ]
+STOP_LOSSES = [ "Close * 0.95", "Low * 0.97", "MA50" ]
+BUY_TIMEFRAMES = [ ( "Day", 1, None, 0 ), ( "Day", 2, None, 0 ), ( "Day", 1, "Day", 3 ), ( "Day", 2, "All", 0 ) ]
+SELL_TIMEFRAMES = [ ( "Day", 2, None, 0 ), ( "Day", 3, None, 0 ), ( "Day", 2, "Day", 6 ), ( "Day", 2, "All", 0 ) ]
+MINUTE_TIMEFRAME = ( "1Min", 0, "1Min", 0 )
+
+def syntheticDaily( rng, days, start="2018-01-02", symbol="SYN" ):
+    """A random walk of daily bars, in the format DataLoader.data() returns
+    """
+    dates = pd.bdate_range( start, periods=days, name="date" )
+    close = 50 * np.exp( np.cumsum( rng.normal( 0.0003, 0.018, days ) ) )
+    open = close * np.exp( rng.normal( 0, 0.008, days ) )
+    high = np.maximum( open, close ) * ( 1 + np.abs( rng.normal( 0, 0.008, days ) ) )
+    low = np.minimum( open, close ) * ( 1 - np.abs( rng.normal( 0, 0.008, days ) ) )
+    volume = rng.integers( 2e5, 3e6, days )
+    return pd.DataFrame( { "close" : close, "high" : high, "low" : low, "open" : open, "symbol" : symbol, "volume" : volume }, index=dates )
+
+def syntheticIntraday( rng, daily, halfDays=0.05, missing=0.03 ):
+    """Minute bars for the days of daily, in the format DataLoader.data() returns. Some sessions
+    end at 13:00 like half days and some minutes have no bar at all
+    """
+    frames = []
+    for date, day in daily.iterrows():
+        minutes = 210 if rng.random() < halfDays else 390
+        path = day[ "open" ] * np.exp( np.cumsum( rng.normal( 0, 0.0015, minutes ) ) )
+        open = np.concatenate( [ [ day[ "open" ] ], path[ :-1 ] ] )
+        labels = ( pd.Timestamp( "09:30" ) + pd.to_timedelta( np.arange( minutes ), unit="min" ) ).strftime( "%H:%M" )
+        frame = pd.DataFrame( { "date" : date, "minute" : labels,
+                                "high" : np.maximum( open, path ) * 1.0005, "low" : np.minimum( open, path ) * 0.9995,
+                                "open" : open, "close" : path, "volume" : rng.integers( 100, 5000, minutes ) } )
+        frames += [ frame[ rng.random( minutes ) >= missing ] ]
+    return pd.concat( frames ).set_index( [ "date", "minute" ] )
+
+def randomStrategy( rng, name, intraday=False ):
+    """A parsed strategy in the format of Simulator.strategyInfo, with 1 to 4 BUY and 1 to 3 SELL rules
+    """
+    pick = lambda items: items[ rng.integers( len( items ) ) ]
+
+    def _condition( pool ):
+        terms = [ pick( pool ) for _ in range( rng.integers( 1, 4 ) ) ]
+        return "( " + pick( [ " and ", " or " ] ).join( f"( {t} )" for t in terms ) + " )"
+
+    def _stopLoss():
+        return f"min( Open, {pick( STOP_LOSSES )} )" if rng.random() < 0.4 else None
+
+    buys, sells = {}, {}
+    for i in range( rng.integers( 1, 5 ) ):
+        buys[ f"BUY{i + 1}" ] = ( pick( BUY_TIMEFRAMES ), float( rng.integers( 1, 3 ) ), _condition( DAILY_CONDITIONS ), pick( DAILY_PRICES ), _stopLoss() )
+    if intraday:
+        buys[ f"BUY{len( buys ) + 1}" ] = ( MINUTE_TIMEFRAME, 1.0, _condition( INTRADAY_CONDITIONS ), pick( [ None, "close", "close * 1.001" ] ), None )
+    for i in range( rng.integers( 1, 4 ) ):
+        sells[ f"SELL{i + 1}" ] = ( pick( SELL_TIMEFRAMES ), pick( [ 0.5, 1.0 ] ), _condition( DAILY_CONDITIONS ), pick( DAILY_PRICES ), _stopLoss() )
+
+    strategyInfo = { "BUY" : buys, "SELL" : sells, "name" : name }
+    strategyInfo[ "code" ] = str( { **buys, **sells } )
+    return strategyInfo
+
+def randomParams( rng, daily, intraday=None ):
+    """A random window over the daily data, inside the days with intraday data if it is given
+    """
+    dates = daily.index
+    if intraday is not None:
+        days = intraday.index.get_level_values( 0 )
+        dates = dates[ ( dates >= days.min() ) & ( dates <= days.max() ) ]
+    warmup = min( 60, len( dates ) // 4 )
+    start = dates[ rng.integers( warmup, len( dates ) // 2 ) ]
+    end = dates[ rng.integers( len( dates ) // 2, len( dates ) ) ]
+    return { "START_DATE" : str( start.date() ), "END_DATE" : str( end.date() ), "INIT_CAP" : 10000, "COMPOUND" : False,
+             "DISPERSION" : 0.001, "MAX_POSITION_SIZE" : int( rng.integers( 1, 5 ) ) }
+
+def runMode( ticker, strategyInfo, params, daily, intraday, overrides ):
+    """Runs one engine, returns its positions, ledger, consolidated trades and the seconds it took
+    """
+    config = PlumsimConfig()
+    for k, v in overrides.items():
+        setattr( config, k, v )
+    if config.compactData:
+        loader = DataLoader( trade_engine.DATA_DIR, compact=True )
+        daily = loader.compactFrame( daily )
+        intraday = loader.compactFrame( intraday ) if intraday is not None else None
+
+    with contextlib.redirect_stdout( io.StringIO() ):
+        start = time.perf_counter()
+        trader = TradeEngine( ticker, strategyInfo, dict( params ), config, data=daily.copy(),
+                              intradayData=intraday.copy() if intraday is not None else None )
+        trader.run()
+        trades = trader.tradeRange( pd.to_datetime( params[ "START_DATE" ] ), pd.to_datetime( params[ "END_DATE" ] ) )
+        seconds = time.perf_counter() - start
+
+        # Profits are sized the way simulate does it
+        if not trades.empty:
+            sim = Simulator( config=PlumsimConfig() )
+            sim.params = params
+            trades = trades.sort_values( by=[ "Date" ] )
+            sim.calcPnl( trades )
+    return trader.positions, trader.trades, trades, seconds
+
+def diffFrames( kind, ref, fast, rtol, atol ):
+    """Returns the differences between two frames as messages, at most a few of them
+    """
+    if len( ref ) != len( fast ):
+        return [ f"{kind}: {len( ref )} rows in the reference, {len( fast )} in the fast mode" ]
+    if list( ref.columns ) != list( fast.columns ):
+        return [ f"{kind}: columns {list( ref.columns )} != {list( fast.columns )}" ]
+
+    diffs = []
+    for c in ref.columns:
+        a, b = ref[ c ].reset_index( drop=True ), fast[ c ].reset_index( drop=True )
+        numeric = pd.api.types.is_numeric_dtype( a ) or pd.api.types.is_numeric_dtype( b )
+        if numeric:
+            a, b = pd.to_numeric( a, errors="coerce" ).to_numpy( dtype=float ), pd.to_numeric( b, errors="coerce" ).to_numpy( dtype=float )
+            bad = ~np.isclose( a, b, rtol=rtol, atol=atol, equal_nan=True )
+        else:
+            bad = ~( ( a == b ) | ( a.isna() & b.isna() ) ).to_numpy( dtype=bool )
+        for i in np.flatnonzero( bad )[ :3 ]:
+            diffs += [ f"{kind}: row {i} {c}: {a[ i ]} != {b[ i ]}" ]
+    return diffs
+
+def float32Prices( df ):
+    """df with its prices rounded to float32 and held as float64, what the compact representation computes with
+    """
+    if df is None:
+        return None
+    df = df.copy()
+    for c in COMPACT_PRICE_COLUMNS:
+        if c in df:
+            df[ c ] = pd.to_numeric( df[ c ], errors="coerce" ).astype( COMPACT_PRICE_DTYPE ).astype( float )
+    return df
+
+def runCase( case, ticker, strategyInfo, params, daily, intraday, modes, rtol, atol ):
+    strategyInfo[ "analysis" ] = analyze( strategyInfo, params )
+    refs = {}
+    rows = []
+    for mode in modes:
+        compact = MODES[ mode ].get( "compactData", False )
+        if compact not in refs:
+            refData = ( float32Prices( daily ), float32Prices( intraday ) ) if compact else ( daily, intraday )
+            refs[ compact ] = runMode( ticker, strategyInfo, params, *refData, {} )
+        ref = refs[ compact ]
+        fast = runMode( ticker, strategyInfo, params, daily, intraday, MODES[ mode ] )
+        diffs = []
+        for kind, a, b in zip( ( "positions", "ledger", "trades" ), ref[ :3 ], fast[ :3 ] ):
+            diffs += diffFrames( kind, a, b, rtol, atol )
+        pnl = ( ref[ 2 ][ "Profits" ].sum() if "Profits" in ref[ 2 ] else 0.0, fast[ 2 ][ "Profits" ].sum() if "Profits" in fast[ 2 ] else 0.0 )
+        if not np.isclose( *pnl, rtol=rtol, atol=atol ):
+            diffs += [ f"pnl: {pnl[ 0 ]} != {pnl[ 1 ]}" ]
+        rows += [ { "case" : case, "ticker" : ticker, "mode" : mode,
+                    "rules" : f"{len( strategyInfo[ 'BUY' ] )}/{len( strategyInfo[ 'SELL' ] )}", "1Min" : intraday is not None,
+                    "trades" : len( ref[ 2 ] ), "pnl" : round( pnl[ 0 ], 2 ),
+                    "ref s" : round( ref[ 3 ], 3 ), "fast s" : round( fast[ 3 ], 3 ),
+                    "speedup" : round( ref[ 3 ] / fast[ 3 ], 1 ) if fast[ 3 ] else np.inf,
+                    "result" : "ok" if not diffs else "DIFF" } ]
+        for d in diffs:
+            print( f"case {case} {ticker} {mode}: {d}" )
+        if diffs:
+            print( f"case {case} strategy: {strategyInfo[ 'BUY' ]} {strategyInfo[ 'SELL' ]} params: {params}" )
+    return rows
+
+def storedData( dataDir, tickers ):
+    trade_engine.DATA_DIR = dataDir
+    loader = DataLoader( dataDir )
+    for t in tickers:
+        with contextlib.redirect_stdout( io.StringIO() ):
+            daily = loader.data( t, period="daily" )
+            intraday = loader.data( t, period="intraday" )
+        if daily is None:
+            print( f"{t}: no stored data, skipped." )
+            continue
+        yield ( t, daily, intraday )
+
+def runHarness( cases=20, seed=0, days=250, modes=None, dataDir=None, tickers=(), intradayShare=0.3, rtol=1e-9, atol=1e-9 ):
+    rng = np.random.default_rng( seed )
+    modes = modes or list( MODES )
+    rows = []
+
+    daily = syntheticDaily( rng, days )
+    intraday = syntheticIntraday( rng, daily )
+    universe = [ ( "SYN", daily, intraday ) ] + list( storedData( dataDir, tickers ) if dataDir else [] )
+
+    for case in range( cases ):
+        ticker, daily, intraday = universe[ case % len( universe ) ]
+        withIntraday = intraday is not None and rng.random() < intradayShare
+        strategyInfo = randomStrategy( rng, f"case{case}", intraday=withIntraday )
+        params = randomParams( rng, daily, intraday if withIntraday else None )
+        rows += runCase( case, ticker, strategyInfo, params, daily, intraday if withIntraday else None, modes, rtol, atol )
+
+    report = pd.DataFrame( rows ).set_index( "case" )
+    print( report.to_string() )
+    failed = int( ( report[ "result" ] != "ok" ).sum() )
+    for mode, r in report.groupby( "mode" ):
+        print( f"{mode}: {len( r ) - ( r[ 'result' ] != 'ok' ).sum()}/{len( r )} cases match, "
+               f"total speedup {r[ 'ref s' ].sum() / r[ 'fast s' ].sum():.1f}x" )
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description="Differential test of the fast evaluation modes against the reference engine" )
+    parser.add_argument( "--cases", type=int, default=20, help="number of random strategies" )
+    parser.add_argument( "--seed", type=int, default=0 )
+    parser.add_argument( "--days", type=int, default=250, help="days of synthetic data" )
+    parser.add_argument( "--mode", action="append", choices=list( MODES ), help="modes to test, all by default" )
+    parser.add_argument( "--data-dir", default=None, help="data directory of the stored tickers to test on as well" )
+    parser.add_argument( "--tickers", nargs="*", default=[], help="stored tickers to test on" )
+    parser.add_argument( "--intraday", type=float, default=0.3, help="share of the strategies with a 1Min rule" )
+    parser.add_argument( "--rtol", type=float, default=1e-9 )
+    parser.add_argument( "--atol", type=float, default=1e-9 )
+    args = parser.parse_args()
+
+    failed = runHarness( args.cases, args.seed, args.days, args.mode, args.data_dir, args.tickers, args.intraday, args.rtol, args.atol )
+    sys.exit( 1 if failed else 0 )
@@ -0,0 +1,210 @@
+from collections import deque
+import pathlib
+import pickle
+import os
+import numpy as np
+
+from builtin_commands import Commands
+from ticker_data import DataLoader
+
+SCAN_STATE_FILE = "scan_state.pkl"
+
+########################################################################
+# Incrementally updated indicators. Where Commands computes an indicator
+# over the whole history at once, IndicatorState keeps just enough of it
+# to move to the next bar in constant time: the last few bars, running
+# window sums for MA and ADR, and the numerator and denominator of the
+# (adjusted) EMA. The values are the ones Commands gives on the last bar.
+########################################################################
+class IndicatorState( object ):
+    def __init__( self, indicators ) -> None:
+        """indicators is { name : ( function name, label, n ) } as returned by Commands.parse()
+        """
+        commands = Commands()
+        self.parsed = dict( indicators )
+        self.indicators = {}
+        for name, ( fname, label, n ) in indicators.items():
+            default = 20 if fname == "adr" else 1
+            _, n = commands.processLabel( label, n, default )
+            self.indicators[ name ] = ( fname, n )
+
+        # Every lookback needs one bar more than its length, to drop the bar leaving a window
+        depth = max( [ n for _, n in self.indicators.values() ] + [ 1 ] ) + 1
+        self.bars = deque( maxlen=depth )
+        self.count = 0
+        self.sums = {}
+        self.ema = {}
+        self.lastDate = None
+
+    def covers( self, names ):
+        return set( names ) <= set( self.indicators )
+
+    def build( self, data ):
+        """Initializes the state from the daily history in data, vectorized instead of bar by bar
+        """
+        if data.empty:
+            return self
+        closes = data[ "Close" ].to_numpy( dtype=float )
+        ranges = ( data[ "High" ] / data[ "Low" ] - 1 ).to_numpy( dtype=float )
+        for name, ( fname, n ) in self.indicators.items():
+            if fname == "movingAvg":
+                self.sums[ name ] = float( closes[ -n: ].sum() )
+            elif fname == "adr":
+                self.sums[ name ] = float( ranges[ -n: ].sum() )
+            elif fname == "expMovingAvg":
+                weights = ( 1 - 2 / ( n + 1 ) ) ** np.arange( len( closes ) - 1, -1, -1, dtype=float )
+                self.ema[ name ] = [ float( weights @ closes ), float( weights.sum() ) ]
+
+        for row in data.iloc[ -self.bars.maxlen: ].itertuples():
+            self.bars.append( self.bar( row ) )
+        self.count = len( data )
+        self.lastDate = data.index[ -1 ]
+        return self
+
+    def bar( self, row ):
+        return { "Date" : row.Index, "Open" : row.Open, "High" : row.High, "Low" : row.Low, "Close" : row.Close,
+                 "volume" : getattr( row, "volume", None ), "symbol" : getattr( row, "symbol", None ) }
+
+    def update( self, bar ):
+        """Moves the state forward by one bar, a dict with Date, Open, High, Low, Close and volume
+        """
+        self.bars.append( bar )
+        self.count += 1
+        for name, ( fname, n ) in self.indicators.items():
+            if fname == "movingAvg":
+                self.sums[ name ] = self.sums.get( name, 0.0 ) + bar[ "Close" ] - self.leaving( "Close", n )
+            elif fname == "adr":
+                self.sums[ name ] = self.sums.get( name, 0.0 ) + self.range( bar ) - self.leaving( None, n )
+            elif fname == "expMovingAvg":
+                decay = 1 - 2 / ( n + 1 )
+                num, den = self.ema.get( name, [ 0.0, 0.0 ] )
+                self.ema[ name ] = [ num * decay + bar[ "Close" ], den * decay + 1 ]
+        self.lastDate = bar[ "Date" ]
+
+    def advance( self, data ):
+        """Feeds the bars of data that are newer than the state
+        """
+        if self.lastDate is not None:
+            data = data.loc[ data.index > self.lastDate ]
+        for row in data.itertuples():
+            self.update( self.bar( row ) )
+
+    def leaving( self, column, n ):
+        """Value of the bar that just left a window of n bars, 0 while the window is filling up
+        """
+        if self.count <= n:
+            return 0.0
+        bar = self.bars[ -n - 1 ]
+        return self.range( bar ) if column is None else bar[ column ]
+
+    def range( self, bar ):
+        return bar[ "High" ] / bar[ "Low" ] - 1
+
+    def prev( self, column, n ):
+        return self.bars[ -n - 1 ][ column ] if len( self.bars ) > n else np.nan
+
+    def values( self ):
+        """Returns the last bar with the current value of every indicator, named like the columns
+        of the daily data, so it can be used in place of a row of TradeEngine.data
+        """
+        if not self.bars:
+            return {}
+        last = self.bars[ -1 ]
+        values = { "Index" : last[ "Date" ], "Close" : last[ "Close" ], "High" : last[ "High" ], "Low" : last[ "Low" ],
+                   "Open" : last[ "Open" ], "symbol" : last[ "symbol" ], "volume" : last[ "volume" ] }
+        for name, ( fname, n ) in self.indicators.items():
+            if fname == "movingAvg":
+                value = self.sums[ name ] / n if self.count >= n else np.nan
+            elif fname == "adr":
+                value = round( self.sums[ name ] / n, 4 ) if self.count >= n else np.nan
+            elif fname == "expMovingAvg":
+                num, den = self.ema[ name ]
+                value = num / den
+            elif fname == "prevClose":
+                value = self.prev( "Close", n )
+            elif fname == "prevHigh":
+                value = self.prev( "High", n )
+            elif fname == "prevLow":
+                value = self.prev( "Low", n )
+            elif fname == "gapOpen":
+                value = ( last[ "Open" ] - self.prev( "Close", n ) ) / self.prev( "Close", n )
+            elif fname == "prevOpenCloseRange":
+                value = ( self.prev( "Close", n ) - self.prev( "Open", n ) ) / self.prev( "Close", n )
+            elif fname == "prevRange":
+                value = ( self.prev( "High", n ) - self.prev( "Low", n ) ) / self.prev( "Low", n )
+            elif fname == "range":
+                value = self.range( last )
+            elif fname == "dayOfWeek":
+                value = last[ "Date" ].strftime( '%A' )
+            else:
+                value = np.nan
+            values[ name ] = value
+        return values
+
+
+class IndicatorStore( object ):
+    """The IndicatorStates of a universe, kept in one file in the data directory
+    """
+    def __init__( self, data_dir ) -> None:
+        self.data_dir = data_dir
+        self.path = pathlib.Path( data_dir ).joinpath( SCAN_STATE_FILE )
+        self.states = None
+        self.changed = False
+
+    def load( self ):
+        if self.states is None:
+            self.states = {}
+            if self.path.exists():
+                try:
+                    with open( self.path, 'rb' ) as f:
+                        self.states = pickle.load( f )
+                except ( OSError, EOFError, pickle.UnpicklingError ):
+                    print( "Rebuilding unreadable scan state." )
+        return self.states
+
+    def save( self ):
+        if self.states is None or not self.changed:
+            return
+        tmp_path = self.path.with_suffix( ".tmp" )
+        with open( tmp_path, 'wb' ) as f:
+            pickle.dump( self.states, f, protocol=pickle.HIGHEST_PROTOCOL )
+        os.replace( tmp_path, self.path )
+        self.changed = False
+
+    def history( self, ticker, data=None ):
+        """Daily data of ticker as read from storage, in the format of TradeEngine.data
+        """
+        from trade_engine import TradeEngine
+
+        loader = DataLoader( self.data_dir )
+        if data is None:
+            data = loader.read( ticker, "daily" )
+        if data.empty:
+            return data
+        return TradeEngine.prepareData( loader.formatDailyData( data ).copy() )
+
+    def state( self, ticker, indicators, lastDate=None ):
+        """Returns the state of ticker holding at least the given indicators, up to date till lastDate.
+        The state is only rebuilt from the full history when it does not have all the indicators
+        """
+        states = self.load()
+        state = states.get( ticker )
+        if state is None or not state.covers( indicators ):
+            tracked = dict( indicators )
+            if state is not None:
+                tracked.update( state.parsed )
+            state = IndicatorState( tracked ).build( self.history( ticker ) )
+            states[ ticker ] = state
+            self.changed = True
+        elif lastDate is not None and ( state.lastDate is None or state.lastDate < lastDate ):
+            state.advance( self.history( ticker ) )
+            self.changed = True
+        return state
+
+    def advance( self, ticker, data ):
+        """Moves an existing state of ticker forward with the daily data as read from storage
+        """
+        state = self.load().get( ticker )
+        if state is not None:
+            state.advance( self.history( ticker, data ) )
+            self.changed = True
@@ -0,0 +1,254 @@
+import pandas as pd
+import numpy as np
+
+TRADING_DAYS = 252
+
+########################################################################
+# Performance statistics of a set of consolidated trades. Everything is
+# computed in vectorized passes over the trade table, so it stays cheap
+# on results with millions of trades.
+########################################################################
+class PerformanceMetrics( object ):
+    def __init__( self, trades, initCap, equity=None ) -> None:
+        """equity is an optional daily equity curve, e.g. marked to market with markToMarket(). When it is
+        not given, the curve is built from the realized profits on the days the trades were closed.
+        """
+        self.initCap = initCap
+        self.numTrades = len( trades )
+        if trades.empty:
+            self.equity = pd.Series( dtype=float )
+            self.byTicker = pd.DataFrame()
+            self.byRule = pd.DataFrame()
+            return
+
+        profits = trades[ "Profits" ].to_numpy( dtype=float )
+        buyDates = pd.to_datetime( trades[ "Date" ] ).to_numpy()
+        sellDates = pd.to_datetime( trades[ "SellDate" ] ).to_numpy()
+
+        # Win / loss statistics
+        wins = profits > 0
+        losses = profits < 0
+        self.numWin = int( wins.sum() )
+        self.numLoss = int( losses.sum() )
+        self.winRate = self.numWin / ( self.numWin + self.numLoss ) if ( self.numWin + self.numLoss ) else 0.0
+        self.totalProfit = float( profits.sum() )
+        self.grossProfit = float( profits[ wins ].sum() )
+        self.grossLoss = float( -profits[ losses ].sum() )
+        self.profitFactor = self.grossProfit / self.grossLoss if self.grossLoss else np.inf
+        self.avgHoldDays = float( ( ( sellDates - buyDates ) / np.timedelta64( 1, 'D' ) ).mean() )
+
+        # Realized daily PnL over every business day of the run, days without trades included
+        days = pd.bdate_range( min( buyDates.min(), sellDates.min() ), max( buyDates.max(), sellDates.max() ) )
+        sellIdx = np.clip( days.searchsorted( sellDates ), 0, len( days ) - 1 )
+        if equity is None or equity.empty:
+            dailyPnl = np.bincount( sellIdx, weights=profits, minlength=len( days ) )
+            self.dailyPnl = pd.Series( dailyPnl, index=days )
+            self.equity = self.initCap + self.dailyPnl.cumsum()
+        else:
+            self.equity = equity
+            self.dailyPnl = equity.diff().fillna( equity.iloc[ 0 ] - self.initCap )
+            dailyPnl = self.dailyPnl.to_numpy()
+
+        self.maxDrawdown, self.maxDrawdownPct, self.maxDrawdownDuration = drawdown( self.equity.to_numpy() )
+
+        prevEquity = np.concatenate( [ [ self.initCap ], self.equity.to_numpy()[ :-1 ] ] )
+        returns = dailyPnl / prevEquity
+        self.sharpe = annualizedRatio( returns, returns.std() )
+        self.sortino = annualizedRatio( returns, np.sqrt( np.mean( np.minimum( returns, 0 ) ** 2 ) ) )
+
+        # Exposure is the share of days with at least one open position, found with an interval sweep:
+        # +1 on the buy day, -1 on the sell day, and a running sum gives the number of open positions
+        buyIdx = days.searchsorted( buyDates )
+        openCount = np.bincount( buyIdx, minlength=len( days ) + 1 ) - np.bincount( sellIdx, minlength=len( days ) + 1 )
+        openCount = np.cumsum( openCount[ :-1 ] )
+        self.exposure = float( ( openCount > 0 ).mean() )
+        self.avgPositions = float( openCount.mean() )
+
+        # Turnover is the value bought and sold over the run relative to the average equity
+        traded = ( trades[ "Invested" ] * trades[ "Quantity" ] ).to_numpy( dtype=float )
+        self.turnover = float( 2 * traded.sum() / self.equity.mean() ) if self.equity.mean() else 0.0
+
+        self.byTicker = breakdown( trades, "Ticker" )
+        self.byRule = breakdown( trades, "Strategy" ) if "Strategy" in trades else pd.DataFrame()
+
+    def summary( self ):
+        if not self.numTrades:
+            return { "trades" : 0 }
+        return { "trades" : self.numTrades,
+                 "winning trades" : self.numWin,
+                 "losing trades" : self.numLoss,
+                 "winning %" : round( self.winRate * 100, 2 ),
+                 "total profit" : round( self.totalProfit, 2 ),
+                 "profit factor" : round( self.profitFactor, 2 ),
+                 "max drawdown" : round( self.maxDrawdown, 2 ),
+                 "max drawdown %" : round( self.maxDrawdownPct * 100, 2 ),
+                 "max drawdown days" : self.maxDrawdownDuration,
+                 "sharpe" : round( self.sharpe, 2 ),
+                 "sortino" : round( self.sortino, 2 ),
+                 "exposure %" : round( self.exposure * 100, 2 ),
+                 "avg open positions" : round( self.avgPositions, 2 ),
+                 "turnover" : round( self.turnover, 2 ),
+                 "avg holding days" : round( self.avgHoldDays, 1 ) }
+
+    def toString( self ):
+        return "\n".join( f"{k}: {v}" for k, v in self.summary().items() )
+
+
+def drawdown( equity ):
+    """Returns the largest drop from a peak, as an amount and as a fraction of the peak,
+    and the longest time in bars spent below a previous peak
+    """
+    if not len( equity ):
+        return ( 0.0, 0.0, 0 )
+    peak = np.maximum.accumulate( equity )
+    dd = peak - equity
+    ddPct = np.divide( dd, peak, out=np.zeros_like( dd, dtype=float ), where=peak > 0 )
+
+    # Length of the underwater stretches, the counter restarts every time a new peak is reached
+    underwater = dd > 0
+    idx = np.arange( len( equity ) )
+    lastPeak = np.maximum.accumulate( np.where( underwater, -1, idx ) )
+    duration = int( ( idx - lastPeak )[ underwater ].max() ) if underwater.any() else 0
+    return ( float( dd.max() ), float( ddPct.max() ), duration )
+
+def annualizedRatio( returns, risk ):
+    if not risk or np.isnan( risk ):
+        return 0.0
+    return float( returns.mean() / risk * np.sqrt( TRADING_DAYS ) )
+
+def breakdown( trades, column ):
+    profits = trades[ "Profits" ].to_numpy( dtype=float )
+    frame = pd.DataFrame( { "Profits" : profits,
+                            "AvgProfit" : trades[ "Profit" ].to_numpy( dtype=float ),
+                            "WinRate" : profits > 0 } )
+    grouped = frame.groupby( trades[ column ].to_numpy(), sort=False )
+    result = grouped.agg( { "Profits" : "sum", "AvgProfit" : "mean", "WinRate" : "mean" } )
+    result.insert( 0, "Trades", grouped.size() )
+    result.index.name = column
+    return result.sort_values( by="Profits", ascending=False )
+
+
+def markToMarket( lots, closes, days, initCap ):
+    """Daily equity of a whole universe, with the open positions valued at each day's close.
+
+    lots has a row per lot with Ticker, Date, SellDate (NaT while still open), BuyPrice, Quantity,
+    Invested and Profits. closes gives ( ticker, close prices ) pairs, each series only has to cover
+    the days the lots of its ticker are held. days are the trading days of the curve.
+    A lot is held from the close of its buy day until its sell day, when its profit is realized.
+
+    The holdings are built with an interval sweep per ticker: the shares are added on the buy day,
+    taken out on the sell day and a cumulative sum over the days gives what is held on each day.
+    Only the days between the first buy and the last sell of a ticker are looked at.
+    """
+    n = len( days )
+    if not n:
+        return pd.Series( dtype=float )
+
+    buyIdx = days.searchsorted( pd.to_datetime( lots[ "Date" ] ).to_numpy() )
+    sellDates = pd.to_datetime( lots[ "SellDate" ] )
+    isOpen = sellDates.isna().to_numpy()
+    sellIdx = np.where( isOpen, n, days.searchsorted( sellDates.fillna( days[ -1 ] ).to_numpy() ) )
+
+    notional = ( lots[ "Invested" ] * lots[ "Quantity" ] ).to_numpy( dtype=float )
+    shares = notional / lots[ "BuyPrice" ].to_numpy( dtype=float )
+
+    profits = np.where( isOpen, 0.0, lots[ "Profits" ].to_numpy( dtype=float ) )
+    realized = np.bincount( sellIdx, weights=profits, minlength=n + 1 )[ :n ]
+
+    rows = pd.Series( lots[ "Ticker" ].to_numpy() ).groupby( lots[ "Ticker" ].to_numpy() ).indices
+    unrealized = np.zeros( n )
+    for ticker, close in closes:
+        sel = rows.get( ticker )
+        if sel is None:
+            continue
+        lo, hi = buyIdx[ sel ].min(), sellIdx[ sel ].max()
+        if hi <= lo:
+            continue
+
+        width = hi - lo
+        held = np.zeros( width + 1 )
+        cost = np.zeros( width + 1 )
+        for idx, sign in ( ( buyIdx[ sel ], 1 ), ( sellIdx[ sel ], -1 ) ):
+            held += sign * np.bincount( idx - lo, weights=shares[ sel ], minlength=width + 1 )
+            cost += sign * np.bincount( idx - lo, weights=notional[ sel ], minlength=width + 1 )
+        held = held[ :width ].cumsum()
+        cost = cost[ :width ].cumsum()
+
+        # The last close before a day without one stands in for it
+        prices = close.reindex( days[ lo : hi ], method="ffill" ).to_numpy( dtype=float )
+
+        # The running sums leave tiny rounding residue once a position is closed, that is not a holding
+        value = np.where( np.abs( held ) > 1e-9, held * prices - cost, 0.0 )
+        unrealized[ lo : hi ] += np.where( np.isnan( value ), 0.0, value )
+
+    return pd.Series( initCap + realized.cumsum() + unrealized, index=days )
+
+
+def compoundedInvested( profit, initCap, compound ):
+    """Amount invested in each trade, as in Simulator.calcPnl. With compounding, every trade is sized
+    with the capital left after all the trades before it. Works along the last axis, so profit can
+    also be a matrix with one sequence of trades per row.
+    """
+    profit = np.asarray( profit, dtype=float )
+    if not compound:
+        return np.full( profit.shape, float( initCap ) )
+
+    growth = np.cumprod( 1 + profit, axis=-1 )
+    ones = np.ones( profit.shape[ :-1 ] + ( 1, ) )
+    return initCap * np.concatenate( [ ones, growth[ ..., :-1 ] ], axis=-1 )
+
+########################################################################
+# Monte Carlo analysis of trade results. The trade sequence is resampled
+# (bootstrap) or reordered (shuffle) once per path, and all the paths of
+# a chunk are evaluated together as matrices with one path per row.
+########################################################################
+MONTECARLO_CHUNK_ELEMENTS = 4_000_000
+
+def monteCarlo( profit, quantity, initCap, compound, paths=10000, mode="bootstrap", seed=None, procs=1 ):
+    """Returns the final equity, max drawdown and longest losing streak of every path
+    """
+    if paths < 1:
+        raise ValueError( f"paths has to be at least 1, got {paths}" )
+    profit = np.asarray( profit, dtype=float )
+    quantity = np.asarray( quantity, dtype=float )
+    n = len( profit )
+
+    # Bound the size of the paths x trades matrices of each chunk
+    rows = max( 1, MONTECARLO_CHUNK_ELEMENTS // max( n, 1 ) )
+    sizes = [ min( rows, paths - start ) for start in range( 0, paths, rows ) ]
+    seeds = np.random.SeedSequence( seed ).spawn( len( sizes ) )
+    jobs = [ ( profit, quantity, initCap, compound, size, mode, s ) for size, s in zip( sizes, seeds ) ]
+
+    if procs > 1 and len( jobs ) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor( max_workers=procs ) as executor:
+            results = list( executor.map( monteCarloChunk, jobs ) )
+    else:
+        results = [ monteCarloChunk( job ) for job in jobs ]
+
+    return { k : np.concatenate( [ r[ k ] for r in results ] ) for k in results[ 0 ] }
+
+def monteCarloChunk( job ):
+    profit, quantity, initCap, compound, size, mode, seed = job
+    rng = np.random.default_rng( seed )
+    n = len( profit )
+
+    if mode == "shuffle":
+        idx = rng.permuted( np.broadcast_to( np.arange( n ), ( size, n ) ), axis=1 )
+    else:
+        idx = rng.integers( 0, n, size=( size, n ) )
+
+    p = profit[ idx ]
+    pnl = compoundedInvested( p, initCap, compound ) * p * quantity[ idx ]
+    equity = initCap + np.cumsum( pnl, axis=1 )
+
+    peak = np.maximum( np.maximum.accumulate( equity, axis=1 ), initCap )
+    maxDrawdown = ( peak - equity ).max( axis=1 )
+
+    # Losing streaks: a running count of losses, minus its value at the last winning trade
+    losses = pnl < 0
+    count = np.cumsum( losses, axis=1 )
+    reset = np.maximum.accumulate( np.where( losses, 0, count ), axis=1 )
+    streak = ( count - reset ).max( axis=1 )
+
+    return { "finalEquity" : equity[ :, -1 ], "maxDrawdown" : maxDrawdown, "maxLosingStreak" : streak }
@@ -0,0 +1,177 @@
+from pathlib import Path
+import pandas as pd
+import hashlib
+import json
+import os
+
+RESULT_CACHE_DIR = "./.plumsim_cache"
+
+# Bump this whenever a change to the trade engine changes the trades it produces,
+# so that results cached by older versions are not reused
+RESULT_CACHE_VERSION = 1
+
+class ResultCache( object ):
+    """Persists the raw trade ledger of each ticker under a key derived from everything that went into it,
+    i.e. the strategy, the parameters, the ticker and the version of its data files
+    """
+    def __init__( self, cache_dir=RESULT_CACHE_DIR ) -> None:
+        self.cache_dir = Path( cache_dir )
+        self.hits = 0
+        self.misses = 0
+
+    def key( self, code, params, ticker, dataVersion ):
+        # The engine stores its own state in params while it runs, that should not be a part of the key
+        params = { k : v for k, v in params.items() if k not in ( "Price", "__builtins__" ) }
+        content = json.dumps( [ RESULT_CACHE_VERSION, code, params, ticker, dataVersion ], sort_keys=True, default=str )
+        return hashlib.sha1( content.encode() ).hexdigest()
+
+    def path( self, key ):
+        return self.cache_dir.joinpath( key[ :2 ], f"{key}.pkl" )
+
+    def get( self, key ):
+        path = self.path( key )
+        if not path.exists():
+            self.misses += 1
+            return None
+
+        try:
+            trades = pd.read_pickle( path )
+        except:
+            print( f"Discarding unreadable cache entry {path.name}" )
+            path.unlink()
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return trades
+
+    def put( self, key, trades ):
+        path = self.path( key )
+        path.parent.mkdir( parents=True, exist_ok=True )
+
+        # Write to a temporary file first so that an interrupted write never leaves a partial entry behind
+        tmp_path = path.with_suffix( ".tmp" )
+        trades.to_pickle( tmp_path )
+        os.replace( tmp_path, path )
+
+    def resetStats( self ):
+        self.hits = 0
+        self.misses = 0
+
+    def clear( self ):
+        for path in self.cache_dir.glob( "*/*.pkl" ):
+            path.unlink()
+
+
+SPILL_DIR = "./.plumsim_spill"
+
+class LedgerSpill( object ):
+    """Holds the raw trade ledgers of the tickers of a streaming simulation on disk,
+    so that their engines can be released as soon as they are done. The consolidated
+    trades and the ledgers of the simulated window are spilled next to them, kind tells them apart
+    """
+    def __init__( self, spill_dir=SPILL_DIR ) -> None:
+        self.spill_dir = Path( spill_dir )
+        self.spill_dir.mkdir( parents=True, exist_ok=True )
+        self.tickers = {}
+
+    def path( self, ticker, kind="ledger" ):
+        return self.spill_dir.joinpath( kind, f"{ticker}.pkl" )
+
+    def put( self, ticker, trades, kind="ledger" ):
+        path = self.path( ticker, kind )
+        path.parent.mkdir( exist_ok=True )
+        trades.to_pickle( path )
+        self.tickers.setdefault( kind, {} )[ ticker ] = None
+
+    def get( self, ticker, kind="ledger" ):
+        if ticker not in self.tickers.get( kind, () ):
+            return None
+        return pd.read_pickle( self.path( ticker, kind ) )
+
+    def frames( self, kind ):
+        """The spilled frames of kind, one ticker at a time in the order they were put
+        """
+        for ticker in self.tickers.get( kind, () ):
+            yield pd.read_pickle( self.path( ticker, kind ) )
+
+    def clear( self ):
+        for path in self.spill_dir.glob( "**/*.pkl" ):
+            path.unlink()
+        self.tickers = {}
+
+
+CHECKPOINT_DIR = "./.plumsim_checkpoint"
+
+class SimulationCheckpoint( object ):
+    """Keeps the raw trade ledgers of the tickers a simulation has finished on disk, so that an
+    interrupted run can be resumed without simulating those tickers again. The ledgers are written
+    in parts, a batch of tickers at a time, and a manifest lists the parts that are complete
+    """
+    def __init__( self, checkpoint_dir=CHECKPOINT_DIR ) -> None:
+        self.checkpoint_dir = Path( checkpoint_dir )
+        self.checkpoint_dir.mkdir( parents=True, exist_ok=True )
+        self.manifestPath = self.checkpoint_dir.joinpath( "checkpoint.json" )
+        self.runKey = None
+        self.parts = []
+        self.done = set()
+        self.pending = {}
+
+    def key( self, code, params ):
+        params = { k : v for k, v in params.items() if k not in ( "Price", "__builtins__" ) }
+        content = json.dumps( [ RESULT_CACHE_VERSION, code, params ], sort_keys=True, default=str )
+        return hashlib.sha1( content.encode() ).hexdigest()
+
+    def start( self, runKey ):
+        self.clear()
+        self.runKey = runKey
+        self.saveManifest()
+
+    def resume( self, runKey ):
+        """Picks up the checkpoint of an earlier run, if it was a run of the same strategy and parameters
+        """
+        if not self.manifestPath.exists():
+            return False
+        with open( self.manifestPath, 'r' ) as f:
+            manifest = json.load( f )
+        if manifest[ "key" ] != runKey:
+            return False
+        self.runKey = runKey
+        self.parts = manifest[ "parts" ]
+        self.done = set( manifest[ "done" ] )
+        return True
+
+    def ledgers( self ):
+        for part in self.parts:
+            yield from pd.read_pickle( self.checkpoint_dir.joinpath( part ) ).items()
+
+    def add( self, ticker, trades ):
+        self.pending[ ticker ] = trades
+
+    def flush( self ):
+        if not self.pending:
+            return
+        part = f"part{len( self.parts ) + 1:05d}.pkl"
+        tmp_path = self.checkpoint_dir.joinpath( part + ".tmp" )
+        pd.to_pickle( self.pending, tmp_path )
+        os.replace( tmp_path, self.checkpoint_dir.joinpath( part ) )
+
+        self.parts += [ part ]
+        self.done |= set( self.pending )
+        self.pending = {}
+        self.saveManifest()
+
+    def saveManifest( self ):
+        tmp_path = self.manifestPath.with_suffix( ".tmp" )
+        with open( tmp_path, 'w' ) as f:
+            json.dump( { "key" : self.runKey, "parts" : self.parts, "done" : sorted( self.done ) }, f )
+        os.replace( tmp_path, self.manifestPath )
+
+    def clear( self ):
+        for path in self.checkpoint_dir.glob( "part*.pkl*" ):
+            path.unlink()
+        if self.manifestPath.exists():
+            self.manifestPath.unlink()
+        self.parts = []
+        self.done = set()
+        self.pending = {}
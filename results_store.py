@@ -0,0 +1,155 @@
+import sqlite3
+import json
+import time
+import pandas as pd
+
+RESULTS_DB = "./.plumsim_results.db"
+
+TRADE_COLUMNS = [ "Ticker", "Date", "SellDate", "Type", "Strategy", "BuyPrice", "SellPrice", "Quantity", "Profit", "Invested", "Profits", "AggregateProfits" ]
+LEDGER_COLUMNS = [ "Ticker", "Date", "Type", "Strategy", "Price", "Quantity" ]
+
+# Columns that can be grouped by in a query, besides the plain trade columns
+DERIVED_COLUMNS = { "MONTH" : "substr( Date, 1, 7 )",
+                    "YEAR" : "substr( Date, 1, 4 )",
+                    "SELLMONTH" : "substr( SellDate, 1, 7 )",
+                    "RULE" : "Strategy" }
+
+########################################################################
+# SQLite store of simulation results. Every run gets a run id, its trades
+# are indexed by ticker, date and rule, and the aggregates the shell asks
+# for most often are computed once when the run is saved.
+########################################################################
+class ResultsStore( object ):
+    def __init__( self, path=RESULTS_DB ) -> None:
+        self.path = path
+        self.conn = sqlite3.connect( path, check_same_thread=False )
+        self.createTables()
+
+    def createTables( self ):
+        c = self.conn
+        c.execute( "CREATE TABLE IF NOT EXISTS runs ( run_id INTEGER PRIMARY KEY, strategy TEXT, params TEXT, created REAL )" )
+        c.execute( """CREATE TABLE IF NOT EXISTS trades ( run_id INTEGER, Ticker TEXT, Date TEXT, SellDate TEXT, Type TEXT, Strategy TEXT,
+                      BuyPrice REAL, SellPrice REAL, Quantity REAL, Profit REAL, Invested REAL, Profits REAL, AggregateProfits REAL )""" )
+        c.execute( "CREATE TABLE IF NOT EXISTS ledger ( run_id INTEGER, Ticker TEXT, Date TEXT, Type TEXT, Strategy TEXT, Price REAL, Quantity REAL )" )
+        c.execute( "CREATE TABLE IF NOT EXISTS agg_ticker ( run_id INTEGER, Ticker TEXT, Trades INTEGER, Profits REAL, Invested REAL )" )
+        c.execute( "CREATE TABLE IF NOT EXISTS agg_date ( run_id INTEGER, Date TEXT, Trades INTEGER, Profits REAL, Invested REAL )" )
+
+        for table, column in ( ( "trades", "Ticker" ), ( "trades", "Date" ), ( "trades", "Strategy" ), ( "trades", "Profits" ),
+                               ( "ledger", "Ticker" ), ( "agg_ticker", "Ticker" ), ( "agg_date", "Date" ) ):
+            c.execute( f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table} ( run_id, {column} )" )
+        c.commit()
+
+    def save( self, strategy, params, trades, ledger ):
+        """Stores the consolidated trades and the raw ledger of a run, returns the id of the new run
+        """
+        params = { k : v for k, v in params.items() if k not in ( "Price", "__builtins__" ) }
+        cur = self.conn.execute( "INSERT INTO runs ( strategy, params, created ) VALUES ( ?, ?, ? )",
+                                 ( strategy, json.dumps( params, default=str ), time.time() ) )
+        runId = cur.lastrowid
+
+        trades = self.toRows( trades, TRADE_COLUMNS, runId )
+        ledger = self.toRows( ledger, LEDGER_COLUMNS, runId )
+        trades.to_sql( "trades", self.conn, if_exists="append", index=False )
+        ledger.to_sql( "ledger", self.conn, if_exists="append", index=False )
+
+        # The group-bys the shell uses all the time are done once here
+        self.conn.execute( """INSERT INTO agg_ticker SELECT run_id, Ticker, COUNT(*), SUM( Profits ), SUM( Invested )
+                              FROM trades WHERE run_id = ? GROUP BY Ticker""", ( runId, ) )
+        self.conn.execute( """INSERT INTO agg_date SELECT run_id, Date, COUNT(*), SUM( Profits ), SUM( Invested )
+                              FROM trades WHERE run_id = ? GROUP BY Date""", ( runId, ) )
+        self.conn.commit()
+        return runId
+
+    def toRows( self, df, columns, runId ):
+        df = df.reindex( columns=columns ).copy()
+        for c in ( "Date", "SellDate" ):
+            if c in df:
+                df[ c ] = pd.to_datetime( df[ c ] ).dt.strftime( "%Y-%m-%d" )
+        if "Type" in df:
+            df[ "Type" ] = df[ "Type" ].map( lambda t : getattr( t, "name", t ) )
+        df.insert( 0, "run_id", runId )
+        return df
+
+    def read( self, sql, args=() ):
+        df = pd.read_sql_query( sql, self.conn, params=args )
+        for c in ( "Date", "SellDate" ):
+            if c in df:
+                df[ c ] = pd.to_datetime( df[ c ] )
+        return df
+
+    def lastRun( self ):
+        row = self.conn.execute( "SELECT MAX( run_id ) FROM runs" ).fetchone()
+        return row[ 0 ]
+
+    def runs( self ):
+        return self.read( "SELECT run_id, strategy, datetime( created, 'unixepoch', 'localtime' ) AS created FROM runs ORDER BY run_id" )
+
+    def aggregate( self, runId, by ):
+        if by == "Ticker":
+            return self.read( "SELECT Ticker, Trades, Profits, Invested FROM agg_ticker WHERE run_id = ? ORDER BY Ticker", ( runId, ) ).set_index( "Ticker" )
+        return self.read( "SELECT Date, Trades, Profits, Invested FROM agg_date WHERE run_id = ? ORDER BY Date", ( runId, ) ).set_index( "Date" )
+
+    def outliers( self, runId, n, best=True ):
+        order = "DESC" if best else "ASC"
+        return self.read( f"SELECT * FROM trades WHERE run_id = ? ORDER BY Profits {order} LIMIT ?", ( runId, n ) ).drop( columns=[ "run_id" ] )
+
+    def trades( self, runId, ticker ):
+        return self.read( "SELECT * FROM trades WHERE run_id = ? AND Ticker = ? ORDER BY Date", ( runId, ticker ) ).drop( columns=[ "run_id" ] )
+
+    def ledger( self, runId, ticker ):
+        return self.read( "SELECT * FROM ledger WHERE run_id = ? AND Ticker = ? ORDER BY rowid", ( runId, ticker ) ).drop( columns=[ "run_id" ] )
+
+    def query( self, runId, args ):
+        """Runs a query written as: [from DATE] [to DATE] [rule R1,R2] [tickers T1,T2] [by COL1,COL2] [limit N]
+        Without 'by' the matching trades are returned, with it they are grouped by the given columns,
+        which can be any trade column or month, year, sellmonth and rule.
+        """
+        words = args.split()
+        options = {}
+        i = 0
+        while i < len( words ) - 1:
+            options[ words[ i ].upper() ] = words[ i + 1 ]
+            i += 2
+        if i < len( words ):
+            raise ValueError( f"Missing value for '{words[ i ]}'" )
+
+        where = [ "run_id = ?" ]
+        values = [ runId ]
+        if "FROM" in options:
+            where += [ "Date >= ?" ]
+            values += [ pd.to_datetime( options[ "FROM" ] ).strftime( "%Y-%m-%d" ) ]
+        if "TO" in options:
+            where += [ "Date <= ?" ]
+            values += [ pd.to_datetime( options[ "TO" ] ).strftime( "%Y-%m-%d" ) ]
+        for key, column in ( ( "RULE", "Strategy" ), ( "TICKERS", "Ticker" ), ( "TICKER", "Ticker" ) ):
+            if key in options:
+                items = [ x.strip().upper() if column == "Ticker" else x.strip() for x in options[ key ].split( "," ) ]
+                where += [ "{} IN ( {} )".format( column, ", ".join( "?" * len( items ) ) ) ]
+                values += items
+        where = " AND ".join( where )
+        limit = f" LIMIT {int( options[ 'LIMIT' ] )}" if "LIMIT" in options else ""
+
+        if "BY" not in options:
+            return self.read( f"SELECT * FROM trades WHERE {where} ORDER BY Date{limit}", values ).drop( columns=[ "run_id" ] )
+
+        groups = []
+        for g in options[ "BY" ].split( "," ):
+            expr = self.column( g )
+            groups += [ f"{expr} AS {g.strip().capitalize() if g.upper() in DERIVED_COLUMNS else expr}" ]
+        names = ", ".join( g.split( " AS " )[ 1 ] for g in groups )
+        sql = f"""SELECT {", ".join( groups )}, COUNT(*) AS Trades, SUM( Profits ) AS Profits, AVG( Profit ) AS AvgProfit,
+                  AVG( Profits > 0 ) AS WinRate, SUM( Invested ) AS Invested
+                  FROM trades WHERE {where} GROUP BY {names} ORDER BY {names}{limit}"""
+        return self.read( sql, values ).set_index( [ n.strip() for n in names.split( "," ) ] )
+
+    def column( self, name ):
+        name = name.strip()
+        if name.upper() in DERIVED_COLUMNS:
+            return DERIVED_COLUMNS[ name.upper() ]
+        for c in TRADE_COLUMNS:
+            if c.upper() == name.upper():
+                return c
+        raise ValueError( f"Unknown column '{name}'" )
+
+    def close( self ):
+        self.conn.close()
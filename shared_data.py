@@ -0,0 +1,144 @@
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+ALIGNMENT = 64
+
+########################################################################
+# Shared memory transport for price data. The publishing process copies a
+# DataFrame once into a shared memory block, worker processes attach to
+# the block through a small picklable descriptor and get NumPy views on
+# the same memory instead of unpickling their own copy.
+########################################################################
+class SharedFrame( object ):
+    def __init__( self, descriptor, shm ) -> None:
+        self.descriptor = descriptor
+        self.shm = shm
+
+    @classmethod
+    def publish( cls, frame ):
+        """Copies frame into a new shared memory block. The caller owns the block and has to unlink() it once all workers are done
+        """
+        arrays = []
+        descriptor = { "rows" : len( frame ), "blocks" : [], "categoricals" : [], "masked" : [], "index" : None }
+
+        # Columns of the same dtype go into one 2D block, laid out the way pandas stores them internally
+        # so that the DataFrame can be built on top of the block without consolidating it
+        groups = {}
+        masked = []
+        for name in frame.columns:
+            values = frame[ name ]
+            if cls._isMasked( values.dtype ):
+                masked += [ name ]
+            elif cls._isPlain( values.dtype ):
+                groups.setdefault( values.dtype.str, [] ).append( name )
+            else:
+                codes, categories = pd.factorize( values )
+                arrays += [ codes ]
+                descriptor[ "categoricals" ] += [ { "name" : name, "categories" : list( categories ) } ]
+
+        for dtype, names in groups.items():
+            arrays += [ np.ascontiguousarray( frame[ names ].to_numpy( dtype=dtype ).T ) ]
+            descriptor[ "blocks" ] += [ { "names" : names, "dtype" : dtype } ]
+
+        # Nullable integer columns, e.g. compact intraday volumes, travel as their values and their NA mask
+        for name in masked:
+            values = frame[ name ]
+            arrays += [ values.to_numpy( dtype=values.dtype.numpy_dtype, na_value=0 ), values.isna().to_numpy() ]
+            descriptor[ "masked" ] += [ { "name" : name } ]
+
+        index = frame.index
+        if isinstance( index, pd.MultiIndex ):
+            levels = []
+            for level, codes in zip( index.levels, index.codes ):
+                levels += [ cls._levelInfo( level ) ]
+                arrays += [ cls._levelValues( level ), np.asarray( codes ) ]
+            descriptor[ "index" ] = { "type" : "multi", "names" : list( index.names ), "levels" : levels }
+        else:
+            arrays += [ cls._levelValues( index ) ]
+            descriptor[ "index" ] = { "type" : "single", "names" : [ index.name ], "levels" : [ cls._levelInfo( index ) ] }
+
+        # Lay out all the arrays back to back in one block
+        offset = 0
+        layout = []
+        for a in arrays:
+            layout += [ ( offset, a.dtype.str, a.shape ) ]
+            offset += ( a.nbytes + ALIGNMENT - 1 ) // ALIGNMENT * ALIGNMENT
+
+        shm = shared_memory.SharedMemory( create=True, size=max( offset, 1 ) )
+        for a, ( start, dtype, shape ) in zip( arrays, layout ):
+            view = np.ndarray( shape, dtype=dtype, buffer=shm.buf, offset=start )
+            view[ ... ] = a
+        descriptor[ "name" ] = shm.name
+        descriptor[ "layout" ] = layout
+
+        return cls( descriptor, shm )
+
+    @classmethod
+    def attach( cls, descriptor ):
+        shm = shared_memory.SharedMemory( name=descriptor[ "name" ] )
+        return cls( descriptor, shm )
+
+    def frame( self ):
+        """Returns a DataFrame whose numeric columns are views on the shared block. It must not outlive this object.
+        """
+        d = self.descriptor
+        views = iter( np.ndarray( shape, dtype=dtype, buffer=self.shm.buf, offset=start ) for ( start, dtype, shape ) in d[ "layout" ] )
+
+        categoricals = [ ( c, next( views ) ) for c in d[ "categoricals" ] ]
+        blocks = [ ( b, next( views ) ) for b in d[ "blocks" ] ]
+        masked = [ ( m, next( views ), next( views ) ) for m in d.get( "masked", [] ) ]
+
+        index = d[ "index" ]
+        if index[ "type" ] == "multi":
+            levels, codes = [], []
+            for info in index[ "levels" ]:
+                levels += [ self._level( info, next( views ) ) ]
+                codes += [ next( views ) ]
+            index = pd.MultiIndex( levels=levels, codes=codes, names=index[ "names" ], verify_integrity=False )
+        else:
+            index = self._level( index[ "levels" ][ 0 ], next( views ) ).rename( index[ "names" ][ 0 ] )
+
+        parts = [ pd.DataFrame( values.T, index=index, columns=b[ "names" ], copy=False ) for ( b, values ) in blocks ]
+        for ( c, codes ) in categoricals:
+            parts += [ pd.DataFrame( { c[ "name" ] : pd.Categorical.from_codes( codes, c[ "categories" ] ) }, index=index ) ]
+        for ( m, values, mask ) in masked:
+            parts += [ pd.DataFrame( { m[ "name" ] : pd.arrays.IntegerArray( values, mask, copy=False ) }, index=index ) ]
+
+        if not parts:
+            return pd.DataFrame( index=index )
+        return pd.concat( parts, axis=1, copy=False )
+
+    def close( self ):
+        self.shm.close()
+
+    def unlink( self ):
+        self.shm.close()
+        self.shm.unlink()
+
+    @staticmethod
+    def _isPlain( dtype ):
+        return dtype.kind in "biufcmM" and not isinstance( dtype, pd.api.types.CategoricalDtype )
+
+    @staticmethod
+    def _isMasked( dtype ):
+        return pd.api.types.is_integer_dtype( dtype ) and not isinstance( dtype, np.dtype )
+
+    @staticmethod
+    def _levelInfo( level ):
+        if SharedFrame._isPlain( level.dtype ):
+            return { "dtype" : level.dtype.str, "values" : None }
+        return { "dtype" : None, "values" : list( level ) }
+
+    @staticmethod
+    def _levelValues( level ):
+        # Object levels are small (e.g. the minutes of a day) and travel inside the descriptor instead
+        if SharedFrame._isPlain( level.dtype ):
+            return np.asarray( level )
+        return np.zeros( 0, dtype=np.int8 )
+
+    @staticmethod
+    def _level( info, values ):
+        if info[ "dtype" ] is None:
+            return pd.Index( info[ "values" ] )
+        return pd.Index( values, copy=False )
@@ -1,18 +1,27 @@
+import time
+STARTUP_TIME = time.perf_counter()
+
 from pathlib import Path
 import pandas as pd
 import numpy as np
-import time
 import json
 import yaml
 import re
 from enum import Enum
-import plotly.express as px
+from collections import OrderedDict
+import itertools
 
-from simulator_webserver import WebApp
 from ticker_data import DataLoaderUtils
 from simulator_shell import Shell, ShellConfig
-from utils_common import timer, timerData
-from trade_engine import TradeEngine
+from utils_common import timer, timerData, runMetrics
+from trade_engine import TradeEngine, DATA_DIR
+from builtin_commands import Commands
+from result_cache import ResultCache, LedgerSpill, SimulationCheckpoint
+from ticker_data import DataLoader, TickerCatalog, Prefetcher
+from perf_metrics import PerformanceMetrics, markToMarket, compoundedInvested, monteCarlo
+from results_store import ResultsStore
+from indicator_state import IndicatorStore
+from strategy_ast import analyze
 
 CONFIG_FILE = "./.plumsim.config.json"
 STRATEGY_FILE = "./Strategy1.simulate"
@@ -25,6 +34,24 @@ class PlumsimConfig( object ):
     threads = []
     verbose = True
     debuglevel = 0
+    resultCache = True
+    streaming = False
+    memoryBudget = 0                # MB of engines kept alive for reuse in streaming mode, 0 releases each one once it is spilled
+    spillDir = "./.plumsim_spill"
+    workers = []                    # host:port or unix:/path addresses of remote workers
+    workerTimeout = 600             # seconds to wait on a remote worker before its ticker is handed to another one
+    markToMarket = True             # value open positions at the daily close for the equity curve
+    resultsStore = True             # save every run to the SQLite results store
+    compactData = False             # float32 prices and categorical/int codes for the loaded data
+    arrowExport = None              # directory to stream the results of every simulation to as Arrow files
+    checkpointDir = "./.plumsim_checkpoint"
+    checkpointEvery = 50            # tickers finished between two checkpoints of a simulation
+    checkpointSeconds = 60          # or seconds, whichever comes first
+    headless = False                # no web server and no plots, plotly and dash are never imported
+    fastEval = False                # evaluate the BUY rules of a strategy together, getBuys() is the reference
+    prefetchDepth = 4               # tickers whose data is loaded ahead of the one being simulated, 0 turns it off
+    prefetchThreads = 2
+    prefetchMemory = 512            # MB of prefetched data held at most
 
 ########################################################################
 # Simulator code starts here
@@ -36,7 +63,7 @@ class Stats( object ):
 class Simulator( object ):
     def __init__( self, config, env={} ) -> None:
         self.env = env
-        self.trades_master = pd.DataFrame( columns=[ "Date", "SellDate", "Type", "BuyPrice", "SellPrice", "Quantity", "Ticker", "Profit", "Invested", "Profits", "AggregateProfits" ] )
+        self.trades_master = pd.DataFrame( columns=[ "Date", "SellDate", "Type", "Strategy", "BuyPrice", "SellPrice", "Quantity", "Ticker", "Profit", "Invested", "Profits", "AggregateProfits" ] )
         self.positions_master = pd.DataFrame()
         self.tickers = []
         self.stats = Stats()
@@ -45,6 +72,17 @@ class Simulator( object ):
         self.cache = {}
         self.strategyInfo = {}
         self._curStrategy = None
+        self.resultCache = ResultCache()
+        self.spill = None
+        self.prefetcher = None
+        self.metrics = None
+        self.openLots = pd.DataFrame()
+        self.equity = pd.Series( dtype=float )
+        self.ledger_master = pd.DataFrame()
+        self.store = None
+        self.runId = None
+        self.signals = pd.DataFrame()
+        self.fills = pd.DataFrame()
 
     def setTickers( self, args ):
         def processArgs( args ):
@@ -63,56 +101,411 @@ class Simulator( object ):
                     arg = arg.strip( " ,\"[]" )
                     if arg.endswith( ".csv" ):
                         df = pd.read_csv( arg, index_col=0 ).index.values
+                        tickers += [ str( t ).strip().upper() for t in df ]
                     else:
                         ticker = [ arg.upper() ]
                         tickers += ticker
             return set( tickers )
 
-        self.tickers = processArgs( args )
+        # A "where" clause screens the tickers in the catalog, e.g. where avg_volume > 1e6 and price > 5
+        m = re.match( r"\s*where\s+(.+)", args, re.IGNORECASE )
+        if m:
+            try:
+                self.tickers = set( TickerCatalog( DATA_DIR ).select( m.group( 1 ) ) )
+            except Exception as e:
+                print( f"Bad filter: {e}" )
+                return
+        else:
+            self.tickers = processArgs( args )
         print( "Item count: {}".format( len( self.tickers ) ) )
 
     def clearTrades( self, args ):
         self.trades_master = pd.DataFrame()
+        self.openLots = pd.DataFrame()
+        self.equity = pd.Series( dtype=float )
+        self.ledger_master = pd.DataFrame()
+        self.runId = None
 
     def simulate( self, args ):
+        options = self.parseOptions( args )
         start_date = pd.to_datetime( self.params[ "START_DATE" ] )
         end_date = pd.to_datetime( self.params[ "END_DATE" ] )
-
-        threads = []
-        for t in self.tickers:
-            trader = TradeEngine( t, self.strategyInfo[ self._curStrategy ], self.params, self.config )
-            self.cache[ t ] = trader
-            buy, sell = ( True, True )
-            trader.run( buy, sell )
-        
-        for t in self.tickers:
-            trader = self.cache[ t ] 
-            trades = trader.tradeRange( start_date, end_date )
-
-            if trades is not None and not trades.empty:
-                self.trades_master = pd.concat( [ self.trades_master, trades ] )
+        streaming = self.config.streaming or "STREAM" in options
+        workers = options[ "WORKERS" ].split( "," ) if "WORKERS" in options else self.config.workers
+
+        if streaming:
+            self.spill = LedgerSpill( self.config.spillDir )
+            self.spill.clear()
+            budget = self.config.memoryBudget * 2**20
+            inMemory = OrderedDict()
+
+        # Finished tickers are checkpointed as the run goes, "simulate resume" picks up an interrupted run
+        # of the same strategy and parameters and only simulates the tickers that were not finished
+        checkpoint = SimulationCheckpoint( self.config.checkpointDir )
+        runKey = checkpoint.key( self.strategyInfo[ self._curStrategy ][ "code" ], self.params )
+        if ( "RESUME" in options or "--RESUME" in options ) and checkpoint.resume( runKey ):
+            print( f"resuming, {len( checkpoint.done )} tickers already done" )
+        else:
+            checkpoint.start( runKey )
+        finished = set( checkpoint.done )
+        lastCheckpoint = time.perf_counter()
+
+        # The ledgers are streamed to the Arrow export as the tickers finish, the rest is written at the end
+        exportDir = options.get( "ARROW" ) or self.config.arrowExport
+        exporter = None
+        if exportDir:
+            from arrow_export import ArrowExporter, ARROW_EXPORT_DIR
+
+            # A bare "arrow" exports to the configured directory or the default one
+            if exportDir is True:
+                exportDir = self.config.arrowExport or ARROW_EXPORT_DIR
+            exporter = ArrowExporter( exportDir )
+            exporter.open()
+
+        self.resultCache.resetStats()
+        self.prefetcher = None
+        allTrades = [ self.trades_master ]
+        openLots = [ self.openLots ]
+        ledgers = [ self.ledger_master ]
+        tickers = self.remoteTickers( workers, skip=finished ) if workers else self.streamTickers( skip=finished )
+        tickers = itertools.chain( self.checkpointedTickers( checkpoint ), tickers )
+        # Feeds the monitor tab of the web app, the time of a ticker runs from the end of the previous one
+        runMetrics.startRun( len( self.tickers ) )
+        tickerStart = time.perf_counter()
+        try:
+            for t, trader in tickers:
+                self.cache[ t ] = trader
+                trades = trader.tradeRange( start_date, end_date )
+                ledger = None
+                if self.config.resultsStore or exporter:
+                    ledger = trader.tradeRange( start_date, end_date, consolidate=False )
+                    if exporter:
+                        exporter.writeLedger( ledger )
+                if not trader.openTrades.empty:
+                    openLots += [ trader.openTrades.assign( Ticker=t ) ]
+
+                # Nothing of a ticker is held in memory while streaming. The raw ledger goes to the spill so that
+                # show_trades and show_pnl can rebuild the engine, the trades and the ledger of the window are read
+                # back once all tickers are done. Engines are only kept for reuse up to the memory budget
+                if streaming:
+                    self.spill.put( t, trader.trades )
+                    if trades is not None and not trades.empty:
+                        self.spill.put( t, trades, kind="trades" )
+                    if ledger is not None:
+                        self.spill.put( t, ledger, kind="window" )
+                    inMemory[ t ] = trader.memoryUsage()
+                    while inMemory and sum( inMemory.values() ) > budget:
+                        released, _ = inMemory.popitem( last=False )
+                        del self.cache[ released ]
+                else:
+                    if trades is not None and not trades.empty:
+                        allTrades += [ trades ]
+                    if ledger is not None:
+                        ledgers += [ ledger ]
+
+                if t not in finished:
+                    checkpoint.add( t, trader.trades )
+                    if len( checkpoint.pending ) >= self.config.checkpointEvery or \
+                       time.perf_counter() - lastCheckpoint > self.config.checkpointSeconds:
+                        checkpoint.flush()
+                        lastCheckpoint = time.perf_counter()
+
+                now = time.perf_counter()
+                bars = len( trader.data ) + ( len( trader.intradayData ) if trader.intradayData is not None else 0 )
+                runMetrics.tickerDone( t, now - tickerStart, bars, len( trades ) if trades is not None else 0 )
+                runMetrics.setCounters( cacheHits=self.resultCache.hits, cacheMisses=self.resultCache.misses )
+                tickerStart = now
+        finally:
+            runMetrics.endRun()
+            # Whatever finished is saved, also when the run is interrupted
+            checkpoint.flush()
+            if exporter:
+                exporter.close()
+
+        if streaming:
+            allTrades = itertools.chain( allTrades, self.spill.frames( "trades" ) )
+            ledgers = itertools.chain( ledgers, self.spill.frames( "window" ) )
+        self.trades_master = pd.concat( allTrades )
+        self.openLots = pd.concat( openLots )
+        self.ledger_master = pd.concat( ledgers )
+
+        if self.config.resultCache:
+            print( f"result cache: {self.resultCache.hits} hits, {self.resultCache.misses} misses" )
+        if self.prefetcher:
+            print( f"prefetch: {self.prefetcher.hits} tickers loaded ahead, {self.prefetcher.waited:.2f}s waiting for data" )
 
         if self.trades_master.empty:
             print( "No Trades during this period." )
+            checkpoint.clear()
             return
 
         self.trades_master.sort_values( by=[ "Date" ], inplace=True )
 
         self.calcPnl( self. trades_master )
+        if self.config.markToMarket:
+            self.equity = self.equityCurve()
+        if self.config.resultsStore:
+            self.runId = self.resultsStore().save( self._curStrategy, self.params, self.trades_master, self.ledger_master )
+            print( f"saved as run {self.runId}" )
+        if exporter:
+            exporter.finish( self.trades_master, self.openLots, self.equity )
+        checkpoint.clear()
         self.showSummary( self.trades_master )
 
+    def resultsStore( self ):
+        if self.store is None:
+            self.store = ResultsStore()
+        return self.store
+
+    def equityCurve( self ):
+        """Daily equity of the current results, with the lots still open at the end valued at the daily close
+        """
+        trades = self.trades_master
+        lots = trades[ [ "Ticker", "Date", "SellDate", "BuyPrice", "Quantity", "Invested", "Profits" ] ]
+
+        if not self.openLots.empty:
+            # Open lots are sized with the capital available when they were bought
+            amounts = self.investedAmount( self.openLots[ "BuyDate" ] )
+            open = pd.DataFrame( { "Ticker" : self.openLots[ "Ticker" ],
+                                   "Date" : self.openLots[ "BuyDate" ],
+                                   "SellDate" : pd.NaT,
+                                   "BuyPrice" : self.openLots[ "BuyPrice" ],
+                                   "Quantity" : self.openLots[ "Quantity" ],
+                                   "Invested" : amounts,
+                                   "Profits" : 0.0 } )
+            lots = pd.concat( [ lots, open ] )
+
+        start_date = pd.to_datetime( self.params[ "START_DATE" ] )
+        end_date = pd.to_datetime( self.params[ "END_DATE" ] )
+        days, closes = self.closePrices( lots, start_date, end_date )
+        return markToMarket( lots, closes, days, self.params[ "INIT_CAP" ] )
+
+    def investedAmount( self, dates ):
+        """Amount invested in a trade taken on each of dates, following the compounding in calcPnl
+        """
+        dates = pd.to_datetime( dates ).to_numpy()
+        trades = self.trades_master
+        if not self.params.get( "COMPOUND" ) or trades.empty:
+            return self.params[ "INIT_CAP" ]
+
+        amount = ( trades[ "Invested" ] * ( 1 + trades[ "Profit" ] ) ).to_numpy( dtype=float )
+        i = pd.to_datetime( trades[ "Date" ] ).to_numpy().searchsorted( dates, side="right" )
+        return np.where( i > 0, amount[ np.maximum( i - 1, 0 ) ], self.params[ "INIT_CAP" ] )
+
+    def closePrices( self, lots, start_date, end_date ):
+        """Trading days of the window and the close prices of each ticker of lots, as ( ticker, closes ) pairs.
+        Of every ticker only the closes from its first buy to its last sell are kept
+        """
+        days = pd.DatetimeIndex( [] )
+        closes = []
+        loader = None
+        dates = pd.to_datetime( lots[ "Date" ] )
+        sellDates = pd.to_datetime( lots[ "SellDate" ] ).fillna( end_date )
+        for t, rows in lots.groupby( "Ticker" ).indices.items():
+            trader = self.cache.get( t )
+            if isinstance( trader, TradeEngine ) and not trader.data.empty:
+                close = trader.data[ "Close" ]
+            else:
+                # The engine was released or only holds a cached ledger, so the stored closes are read,
+                # without bringing the data up to date first
+                loader = loader or DataLoader( DATA_DIR, compact=self.config.compactData )
+                data = loader.read( t, "daily", columns=[ "date", "close" ] )
+                if data.empty:
+                    continue
+                data = loader.formatDailyData( data )
+                close = ( loader.compactFrame( data ) if loader.compact else data )[ "close" ]
+
+            close = close.sort_index().loc[ start_date : end_date ]
+            days = days.union( close.index )
+            # The close before the first buy stays in for days the ticker did not trade
+            first = max( close.index.searchsorted( dates.iloc[ rows ].min(), side="right" ) - 1, 0 )
+            closes += [ ( t, close.iloc[ first : ].loc[ : sellDates.iloc[ rows ].max() ] ) ]
+        return days, closes
+
+    def streamTickers( self, skip=() ):
+        tickers = [ t for t in self.tickers if t not in skip ]
+        self.prefetcher = self.startPrefetch( tickers )
+        try:
+            for t in tickers:
+                data = self.prefetcher.get( t ) if self.prefetcher else None
+                yield ( t, self.runTicker( t, data ) )
+        finally:
+            if self.prefetcher:
+                self.prefetcher.close()
+
+    def startPrefetch( self, tickers ):
+        """Starts loading the data of the tickers that will have to be simulated from scratch, i.e. the
+        ones without a live engine or a cached result
+        """
+        if not self.config.prefetchDepth:
+            return None
+
+        strategyInfo = self.strategyInfo[ self._curStrategy ]
+        compact = self.config.compactData
+
+        def _needsData( t ):
+            if t in self.cache:
+                return False
+            return not ( self.config.resultCache and self.resultCache.path( self.resultKey( t ) ).exists() )
+
+        def _load( t ):
+            # A loader per ticker, DataLoader keeps the ticker it is working on
+            loader = DataLoader( DATA_DIR, compact=compact )
+            return ( TradeEngine.loadData( loader, t, strategyInfo, "daily" ), TradeEngine.loadData( loader, t, strategyInfo, "intraday" ) )
+
+        return Prefetcher( _load, ( t for t in tickers if _needsData( t ) ), depth=self.config.prefetchDepth,
+                           memoryLimit=self.config.prefetchMemory * 2**20, threads=self.config.prefetchThreads )
+
+    def checkpointedTickers( self, checkpoint ):
+        """Engines of the tickers finished by an interrupted run, rebuilt from their checkpointed ledgers
+        """
+        strategyInfo = self.strategyInfo[ self._curStrategy ]
+        for t, trades in checkpoint.ledgers():
+            if t in self.tickers:
+                trader = TradeEngine( t, strategyInfo, self.params, self.config, load=False )
+                trader.trades = trades
+                yield ( t, trader )
+
+    def remoteTickers( self, addresses, skip=() ):
+        """Runs the tickers on remote workers, and locally whatever the workers could not run
+        """
+        from simulator_worker import WorkerPool
+
+        strategyInfo = self.strategyInfo[ self._curStrategy ]
+        pool = WorkerPool( addresses, timeout=self.config.workerTimeout )
+        tickers = sorted( t for t in self.tickers if t not in skip )
+        for t, trades in pool.run( tickers, strategyInfo, self.params ):
+            trader = TradeEngine( t, strategyInfo, self.params, self.config, load=False )
+            trader.trades = trades
+            yield ( t, trader )
+
+        for t, error in pool.failed.items():
+            print( f"{t}: simulation failed, {error}" )
+
+        if pool.lost:
+            print( f"{len( pool.lost )} tickers could not be run on the workers, running them locally." )
+            for t in sorted( pool.lost ):
+                yield ( t, self.runTicker( t ) )
+
+    def engine( self, ticker ):
+        """Returns the engine for ticker, rebuilding it from the spilled ledger if it was released
+        """
+        if ticker in self.cache:
+            return self.cache[ ticker ]
+
+        trades = self.spill.get( ticker ) if self.spill else None
+        if trades is None:
+            return None
+
+        trader = TradeEngine( ticker, self.strategyInfo[ self._curStrategy ], self.params, self.config, load=False )
+        trader.trades = trades
+        return trader
+
+    def parseOptions( self, args ):
+        """Splits command arguments into a dict. Plain words become flags, key=value pairs keep their value
+        """
+        options = {}
+        for arg in ( args or "" ).split():
+            key, _, value = arg.partition( "=" )
+            options[ key.strip().upper() ] = value.strip() if value else True
+        return options
+
+    def runTicker( self, ticker, data=None ):
+        """Returns an engine holding the trades of ticker for the current strategy, taking them from
+        the result cache, reusing a cached engine or simulating from scratch, whichever is cheapest.
+        data is ( daily, intraday ) if it has been loaded already
+        """
+        strategyInfo = self.strategyInfo[ self._curStrategy ]
+        useCache = self.config.resultCache
+
+        # A live engine is preferred over the result cache, it can be reused for the next strategy edit
+        trader, buy, sell = self.reuseEngine( ticker )
+        if trader is not None:
+            if not ( buy or sell ):
+                return trader
+            trader.update( strategyInfo, self.params, buy=buy )
+
+        elif useCache:
+            trades = self.resultCache.get( self.resultKey( ticker ) )
+            if trades is not None:
+                trader = TradeEngine( ticker, strategyInfo, self.params, self.config, load=False )
+                trader.trades = trades
+                return trader
+
+        if trader is None:
+            daily, intraday = data or ( None, None )
+            trader = TradeEngine( ticker, strategyInfo, self.params, self.config, data=daily, intradayData=intraday )
+            buy, sell = ( True, True )
+        trader.run( buy, sell )
+
+        # The engine may have downloaded new data while loading, so the key is worked out again
+        if useCache and ( buy or sell ):
+            self.resultCache.put( self.resultKey( ticker ), trader.trades )
+        return trader
+
+    def resultKey( self, ticker ):
+        code = self.strategyInfo[ self._curStrategy ][ "code" ]
+        # Only the periods the strategy reads, new intraday data does not change a daily strategy's results
+        analysis = self.strategyInfo[ self._curStrategy ].get( "analysis" )
+        periods = ( "daily", ) if analysis and analysis[ "intradayColumns" ] is None else ( "daily", "intraday" )
+        dataVersion = DataLoader( DATA_DIR ).version( ticker, periods )
+        # float32 prices give slightly different results, keep them apart from the full precision ones
+        params = dict( self.params, COMPACT_DATA=True ) if self.config.compactData else self.params
+        return self.resultCache.key( code, params, ticker, dataVersion )
+
+    def reuseEngine( self, ticker ):
+        """Finds out how much of the cached engine for ticker can be reused for the current strategy.
+        Returns the engine and whether the buys and sells need to be recalculated, or None
+        if the engine has to be built from scratch.
+        """
+        trader = self.cache.get( ticker )
+        strategyInfo = self.strategyInfo[ self._curStrategy ]
+        if not isinstance( trader, TradeEngine ) or trader.strategyInfo.get( "name" ) != self._curStrategy:
+            return ( None, True, True )
+        if trader.compact != self.config.compactData:
+            return ( None, True, True )
+
+        changes = self.diffStrategy( trader.strategyInfo, trader.params, strategyInfo, self.params )
+        start_date = pd.to_datetime( self.params[ "START_DATE" ] )
+        end_date = pd.to_datetime( self.params[ "END_DATE" ] )
+        warmup = Commands().warmup( strategyInfo[ "code" ] )
+        if changes[ "INDICATORS" ] or not trader.covers( start_date, end_date, warmup ):
+            return ( None, True, True )
+        if not trader.provides( strategyInfo.get( "analysis" ) ):
+            return ( None, True, True )
+
+        # Parameters can be referenced inside the buy conditions, any of those changing invalidates the buys
+        buyCode = str( strategyInfo[ "BUY" ] )
+        buyParams = [ k for k in changes[ "PARAMS" ] if re.search( rf"\b{k}\b", buyCode ) ]
+
+        buy = changes[ "BUY" ] or changes[ "WINDOW" ] or bool( buyParams )
+        sell = buy or changes[ "SELL" ] or bool( changes[ "PARAMS" ] )
+        return ( trader, buy, sell )
+
+    def diffStrategy( self, old, oldParams, new, newParams ):
+        """Compares two parsed versions of a strategy and returns what changed between them
+        """
+        window = ( "START_DATE", "END_DATE" )
+        ignore = window + ( "Price", "__builtins__" )
+        keys = ( set( oldParams ) | set( newParams ) ) - set( ignore )
+
+        def _indicators( info ):
+            analysis = info.get( "analysis" )
+            return analysis[ "indicators" ] if analysis else Commands().indicators( info[ "code" ] )
+
+        changes = {}
+        changes[ "INDICATORS" ] = _indicators( old ) != _indicators( new )
+        changes[ "BUY" ] = old[ "BUY" ] != new[ "BUY" ]
+        changes[ "SELL" ] = old[ "SELL" ] != new[ "SELL" ]
+        changes[ "WINDOW" ] = any( oldParams.get( k ) != newParams.get( k ) for k in window )
+        changes[ "PARAMS" ] = { k for k in keys if oldParams.get( k ) != newParams.get( k ) }
+        return changes
+
     def calcPnl( self, trades ):
         if trades.empty:
             return
 
-        trades[ 'Invested' ] = self.params[ "INIT_CAP" ]
-
-        if self.params[ "COMPOUND" ]:
-            amount = self.params[ "INIT_CAP" ]
-            for row in trades.itertuples():
-                trades.loc[ row.Index, "Invested" ] = amount
-                amount = amount * ( 1 + row.Profit )
-
+        trades[ 'Invested' ] = compoundedInvested( trades[ "Profit" ], self.params[ "INIT_CAP" ], self.params[ "COMPOUND" ] )
         trades[ "Profits" ] =  trades[ "Invested" ] * trades[ "Profit" ] * trades[ 'Quantity' ]
         trades[ "AggregateProfits" ] = trades[ "Profits" ].cumsum()
 
@@ -123,27 +516,15 @@ class Simulator( object ):
         print( trades.tail( 10 ) )
         print( "---------" )
 
-        numWin = trades[ trades[ "Profits" ] > 0 ][ "Profits" ].count()
-        numLoss = trades[ trades[ "Profits" ] < 0 ][ "Profits" ].count()
-        print( "winning trades: %s" % numWin )
-        print( "losing trades: %s" % numLoss )
-        print( "winning %: {}".format( round( numWin / ( numWin + numLoss ) * 100 ) ) )
-
-        # Aggregate the statistics for each date
-        ntrades = {}
-        dailyprofit = {}
-        for t in trades.itertuples():
-            if t.Date not in ntrades:
-                ntrades[ t.Date ] = 0
-            if t.Type == "LONG":
-                ntrades[ t.Date ] += 1
-
-            if t.Date not in dailyprofit:
-                dailyprofit[ t.Date ] = 0
-            dailyprofit[ t.Date ] += t.Profit
+        if trades is self.trades_master:
+            metrics = PerformanceMetrics( trades, self.params[ "INIT_CAP" ], equity=self.equity )
+            self.metrics = metrics
+        else:
+            metrics = PerformanceMetrics( trades, self.params[ "INIT_CAP" ] )
 
+        print( metrics.toString() )
+        print( "---------" )
         print( trades[ "Profits" ].describe().to_string() )
-        print( "Total profit: %d" % trades[ "Profits" ].sum() )
 
     def showPnl( self, args ):
         args = args.split()
@@ -154,29 +535,46 @@ class Simulator( object ):
             return
 
         if args[ 0 : 2 ] == [ "BY", "TICKER" ]:
-            trades = self.trades_master.groupby( [ 'Ticker' ] ).sum()
+            trades = self.aggregate( "Ticker" )
             print( "---------" )
             print( trades.loc[ : , 'Profits' ].to_string() )
 
-        if args[ 0 : 2 ] == [ "BY", "DAY" ]:
-            trades = self.trades_master.groupby( [ 'Date' ] ).sum()
+        elif args[ 0 : 2 ] == [ "BY", "RULE" ]:
+            metrics = PerformanceMetrics( self.trades_master, self.params[ "INIT_CAP" ] )
+            print( "---------" )
+            print( metrics.byRule.to_string() )
+
+        elif args[ 0 : 2 ] == [ "BY", "DAY" ]:
+            trades = self.aggregate( "Date" )
             print( "---------" )
             print( trades.loc[ : , 'Profits' ].to_string() )
-            self.custom_fig = px.histogram( trades, x="Profits" )
+            self.custom_fig = self.histogram( trades, x="Profits" )
 
-        if args[ 0 : 2 ] == [ "BY", "INVESTED" ]:
-            trades = self.trades_master.groupby( [ 'Date' ] ).sum()
+        elif args[ 0 : 2 ] == [ "BY", "INVESTED" ]:
+            trades = self.aggregate( "Date" )
             print( "---------" )
             print( trades.loc[ : , 'Invested' ].to_string() )
-            self.custom_fig = px.histogram( trades, x="Invested" )
+            self.custom_fig = self.histogram( trades, x="Invested" )
 
-        elif args[ 0 ] in self.cache:
+        elif self.runId:
+            trades = self.resultsStore().trades( self.runId, args[ 0 ] )
+            self.calcPnl( trades )
+            self.showSummary( trades )
+
+        elif self.engine( args[ 0 ] ):
             start_date = pd.to_datetime( self.params[ "START_DATE" ] )
             end_date = pd.to_datetime( self.params[ "END_DATE" ] )
-            trades = self.cache[ args[ 0 ] ].tradeRange( start_date, end_date, consolidate=True )
+            trades = self.engine( args[ 0 ] ).tradeRange( start_date, end_date, consolidate=True )
             self.calcPnl( trades )
             self.showSummary( trades )
 
+    def aggregate( self, by ):
+        """Trades, profits and invested amounts of the current results grouped by Ticker or Date
+        """
+        if self.runId:
+            return self.resultsStore().aggregate( self.runId, by )
+        return self.trades_master.groupby( [ by ] )[ [ "Profits", "Invested" ] ].sum()
+
     def showTrades( self, args ):
         args = args.split()
         args = [ arg.strip().upper() for arg in args ]
@@ -193,14 +591,21 @@ class Simulator( object ):
             ticker = args[ 0 ]
             consolidate=False
 
-        if not ticker or ticker not in self.cache:
+        if self.runId and ticker:
+            store = self.resultsStore()
+            trades = store.trades( self.runId, ticker ) if consolidate else store.ledger( self.runId, ticker )
+            print( trades )
+            return
+
+        trader = self.engine( ticker ) if ticker else None
+        if not trader:
             print( f"No data available for {ticker}." )
             return
 
         start_date = pd.to_datetime( self.params[ "START_DATE" ] )
         end_date = pd.to_datetime( self.params[ "END_DATE" ] )
 
-        trades = self.cache[ ticker ].tradeRange( start_date, end_date, consolidate=consolidate )
+        trades = trader.tradeRange( start_date, end_date, consolidate=consolidate )
         print( trades )
 
     def showOutliers( self, showBest, args ):
@@ -215,11 +620,211 @@ class Simulator( object ):
         except:
             n = 10
 
-        if showBest:
+        if self.runId:
+            print( self.resultsStore().outliers( self.runId, n, best=showBest ) )
+        elif showBest:
             print( self.trades_master.nlargest( n, "Profits" ) )
         else:
             print( self.trades_master.nsmallest( n, "Profits" ) )
 
+    def arrowTables( self ):
+        """The current results as Arrow tables with the schemas of the export, for use in process
+        """
+        from arrow_export import toTable
+
+        return { "trades" : toTable( self.trades_master, "trades" ),
+                 "ledgers" : toTable( self.ledger_master, "ledgers" ),
+                 "open_lots" : toTable( self.openLots, "open_lots" ),
+                 "equity" : toTable( self.equity, "equity" ) }
+
+    def exportArrow( self, args ):
+        """export_arrow [dir]
+        """
+        from arrow_export import ArrowExporter, ARROW_EXPORT_DIR
+
+        if self.trades_master.empty:
+            print( "No results to export, run simulate first." )
+            return
+        exporter = ArrowExporter( args.strip() or self.config.arrowExport or ARROW_EXPORT_DIR )
+        exporter.write( "ledgers", self.ledger_master )
+        exporter.finish( self.trades_master, self.openLots, self.equity )
+
+    def scan( self, args ):
+        """scan - lists the BUY rules of the current strategy that trigger on the latest bar of every ticker
+        """
+        if not self._curStrategy:
+            print( "Load a strategy first." )
+            return
+
+        start = time.perf_counter()
+        strategyInfo = self.strategyInfo[ self._curStrategy ]
+        indicators = Commands().parse( strategyInfo[ "code" ] )
+        catalog = TickerCatalog( DATA_DIR ).load()
+        loader = DataLoader( DATA_DIR )
+        store = IndicatorStore( DATA_DIR )
+
+        # Only rules that trade on the day they trigger can be decided from the latest daily bar
+        rules = []
+        for name, ( timeframe, qty, condition, priceCondition, stopLoss ) in strategyInfo[ "BUY" ].items():
+            ( d1, t1, d2, t2 ) = timeframe
+            if d1 != "Day" or t1 > 1:
+                print( f"{name}: only rules on the daily bar of the trigger can be scanned, skipped." )
+                continue
+            price = compile( priceCondition, "<scan>", "eval" ) if priceCondition else None
+            rules += [ ( name, compile( condition, "<scan>", "eval" ), price ) ]
+
+        signals = []
+        env = dict( self.params )
+        for t in sorted( self.tickers ):
+            if t in catalog.index:
+                lastDate = pd.to_datetime( catalog.at[ t, "last_date" ] )
+            else:
+                entry = loader.manifest( t ).get( "daily" )
+                lastDate = pd.to_datetime( entry[ "last_date" ] ) if entry and entry[ "last_date" ] else None
+
+            values = store.state( t, indicators, lastDate ).values()
+            if not values:
+                continue
+            for name, condition, price in rules:
+                try:
+                    if eval( condition, env, values ):
+                        signals += [ { "Ticker" : t, "Rule" : name, "Date" : values[ "Index" ], "Close" : values[ "Close" ],
+                                       "Price" : eval( price, env, values ) if price else None } ]
+                except Exception as e:
+                    print( f"{t} {name}: {type( e ).__name__}: {e}" )
+        store.save()
+
+        self.signals = pd.DataFrame( signals, columns=[ "Ticker", "Rule", "Date", "Close", "Price" ] )
+        print( self.signals.to_string( index=False ) if not self.signals.empty else "No signals." )
+        print( f"scanned {len( self.tickers )} tickers in {time.perf_counter() - start:.3f}s" )
+
+    def replay( self, args ):
+        """replay [file=PATH [ticker=T]] [socket=host:port] [from=DATE] [to=DATE] [budget=ms] [interval=s]
+        """
+        from bar_replay import ReplayEngine, storedBars, fileBars, socketBars
+
+        if not self._curStrategy:
+            print( "Load a strategy first." )
+            return
+
+        options = self.parseOptions( args )
+        budget = float( options.get( "BUDGET", 5 ) ) / 1000
+        engine = ReplayEngine( self.strategyInfo[ self._curStrategy ], self.params, DATA_DIR, latencyBudget=budget,
+                               onFill=lambda f: print( f"{f.Date:%Y-%m-%d} {f.Ticker} {f.Side} {f.Rule} {f.Quantity:g} @ {f.Price:.2f}" ) )
+
+        if "SOCKET" in options:
+            source = socketBars( options[ "SOCKET" ] )
+        elif "FILE" in options:
+            source = fileBars( options[ "FILE" ], options.get( "TICKER" ) )
+        else:
+            start_date = options.get( "FROM", self.params.get( "START_DATE" ) )
+            end_date = options.get( "TO", self.params.get( "END_DATE" ) )
+            source = storedBars( DATA_DIR, sorted( self.tickers ), start_date, end_date )
+
+        try:
+            engine.run( source, float( options.get( "INTERVAL", 0 ) ) )
+        except KeyboardInterrupt:
+            print( "replay stopped." )
+
+        self.fills = pd.DataFrame( engine.fills )
+        print( f"{len( self.fills )} fills, {len( engine.openLots() )} lots still open" )
+        print( "\n".join( f"{k}: {v}" for k, v in engine.latencyStats().items() ) )
+
+    def query( self, args ):
+        """query [run N] [from DATE] [to DATE] [rule R1,R2] [tickers T1,T2] [by COL1,COL2] [limit N]
+        """
+        store = self.resultsStore()
+        args = args or ""
+        m = re.search( r"\brun\s+(\d+)", args, re.IGNORECASE )
+        runId = int( m.group( 1 ) ) if m else ( self.runId or store.lastRun() )
+        args = re.sub( r"\brun\s+\d+", "", args, flags=re.IGNORECASE )
+
+        if runId is None:
+            print( "No saved runs." )
+            return
+
+        try:
+            result = store.query( runId, args )
+        except ValueError as e:
+            print( e )
+            return
+        print( result.to_string() )
+
+    def showMemory( self, args ):
+        """show_memory [ticker]
+        """
+        engines = { t : e for t, e in self.cache.items() if isinstance( e, TradeEngine ) and not e.data.empty }
+        if not engines:
+            print( "No data loaded, run simulate first." )
+            return
+
+        ticker = args.strip().upper() if args else None
+        if ticker:
+            if ticker not in engines:
+                print( f"{ticker} is not loaded." )
+                return
+            engines = { ticker : engines[ ticker ] }
+
+        usage = pd.concat( { t : e.memoryByColumn() for t, e in engines.items() }, names=[ "Ticker", "Column" ] )
+        usage[ "Total" ] = usage.sum( axis=1 )
+
+        # Tell the indicators apart from the columns that were loaded
+        indicators = Commands().indicators( self.strategyInfo[ self._curStrategy ][ "code" ] ) if self._curStrategy else set()
+        columns = usage.index.get_level_values( "Column" )
+        usage[ "Kind" ] = [ "indicator" if c in indicators else "index" if c == "Index" else "data" for c in columns ]
+
+        if ticker:
+            print( usage.droplevel( "Ticker" ).to_string() )
+        else:
+            print( usage.groupby( level="Ticker" )[ [ "daily", "intraday", "Total" ] ].sum().to_string() )
+            print( usage.groupby( [ columns, "Kind" ] )[ [ "daily", "intraday", "Total" ] ].sum().to_string() )
+        print( f"Total: {usage[ 'Total' ].sum() / 2**20:.1f} MB in {len( engines )} tickers" )
+
+    def showRuns( self, args ):
+        print( self.resultsStore().runs().to_string( index=False ) )
+
+    def monteCarlo( self, args ):
+        """montecarlo [paths=10000] [mode=bootstrap|shuffle] [procs=1] [seed=n]
+        """
+        trades = self.trades_master
+        if trades.empty:
+            print( "No trades to analyze, run simulate first." )
+            return
+
+        options = self.parseOptions( args )
+        try:
+            paths = int( options.get( "PATHS", 10000 ) )
+            mode = str( options.get( "MODE", "bootstrap" ) ).lower()
+            procs = int( options.get( "PROCS", 1 ) )
+            seed = int( options[ "SEED" ] ) if "SEED" in options else None
+        except ValueError:
+            paths = None
+        if paths is None or paths < 1 or procs < 1 or mode not in ( "bootstrap", "shuffle" ):
+            print( "usage: montecarlo [paths=10000] [mode=bootstrap|shuffle] [procs=1] [seed=n], with paths and procs at least 1" )
+            return
+
+        start = time.perf_counter()
+        result = monteCarlo( trades[ "Profit" ], trades[ "Quantity" ], self.params[ "INIT_CAP" ], self.params[ "COMPOUND" ],
+                             paths=paths, mode=mode, seed=seed, procs=procs )
+        elapsed = time.perf_counter() - start
+
+        summary = pd.DataFrame( result ).quantile( [ 0.05, 0.25, 0.5, 0.75, 0.95 ] )
+        summary.index = [ "5%", "25%", "50%", "75%", "95%" ]
+        print( f"{paths} {mode} paths over {len( trades )} trades in {elapsed:.2f}s" )
+        print( summary.round( 2 ).to_string() )
+        print( "probability of loss: {:.2f}%".format( ( result[ "finalEquity" ] < self.params[ "INIT_CAP" ] ).mean() * 100 ) )
+
+        self.monteCarloResult = result
+        self.custom_fig = self.histogram( x=result[ "finalEquity" ], labels={ "x" : "Final equity" } )
+
+    def histogram( self, *kargs, **kwargs ):
+        """Builds a plotly histogram for the custom chart of the web app, nothing when running headless
+        """
+        if self.config.headless:
+            return None
+        import plotly.express as px
+        return px.histogram( *kargs, **kwargs )
+
     def exit( self ):
         pass
         #print( "Exiting simulator" )
@@ -232,6 +837,26 @@ class Simulator( object ):
         with open( CONFIG_FILE, 'w' ) as f:
             f.write( jsonObject )
 
+    def setOption( self, args ):
+        args = args.split() if args else []
+        if not args:
+            for k in dir( self.config ):
+                if not k.startswith( "_" ):
+                    print( f"{k} : {getattr( self.config, k )}" )
+            return
+
+        name, value = args[ 0 ], " ".join( args[ 1: ] )
+        if not hasattr( self.config, name ):
+            print( f"Unknown option {name}" )
+            return
+
+        try:
+            value = eval( value )
+        except:
+            pass
+        setattr( self.config, name, value )
+        print( f"{name} : {value}" )
+
     def printParams( self ):
         for k, v in self.params.items():
             print( f"{k} : {v}" )
@@ -332,11 +957,12 @@ class Simulator( object ):
             return
 
         cacheKey = f"_{name}"
-        if cacheKey in self.cache:
-            oldStrategy = self.cache[ cacheKey ]
         self.cache[ cacheKey ] = strategy
-        
+        oldStrategy = self.strategyInfo.get( name )
+        oldParams = self.params
+
         self.initStrategyInfo( name )
+        self.strategyInfo[ name ][ "name" ] = name
         self.strategyInfo[ name ][ "code" ] = str( strategy )
         self.initParams()
         
@@ -385,6 +1011,26 @@ class Simulator( object ):
             print( "{} : {}".format( key, parsedStrategy ) )
             print( "---" )
 
+        # What the expressions reference decides which columns get loaded and kept by the engines
+        try:
+            analysis = analyze( self.strategyInfo[ name ], self.params )
+        except SyntaxError as e:
+            print( f"Syntax error in strategy: {e}" )
+            analysis = None
+        self.strategyInfo[ name ][ "analysis" ] = analysis
+        if analysis:
+            print( "columns : {}".format( sorted( analysis[ "columns" ] ) ) )
+            print( "intraday columns : {}".format( sorted( analysis[ "intradayColumns" ] ) if analysis[ "intradayColumns" ] is not None else "not used" ) )
+            print( "indicators : {}".format( sorted( analysis[ "indicators" ] ) ) )
+            print( "params : {}".format( sorted( analysis[ "params" ] ) ) )
+            if analysis[ "unknown" ]:
+                print( "unknown names : {}".format( sorted( analysis[ "unknown" ] ) ) )
+
+        if oldStrategy:
+            changes = self.diffStrategy( oldStrategy, oldParams, self.strategyInfo[ name ], self.params )
+            changed = [ k for k, v in changes.items() if v ]
+            print( "changed since last load: {}".format( changed if changed else "nothing" ) )
+
     def printStrategy( self, args ):
         with open( STRATEGY_FILE, 'r') as f:
             dictionary = yaml.load( f, Loader=yaml.FullLoader )
@@ -398,18 +1044,34 @@ class Simulator( object ):
         print( temp )
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser( description="PlumSim strategy simulator" )
+    parser.add_argument( "--headless", action="store_true", help="run the shell only, without the web server" )
+    cmdline = parser.parse_args()
+
     pd.set_option( "display.max_rows", None )
+    importTime = time.perf_counter() - STARTUP_TIME
 
     plumsimConfig = PlumsimConfig()
+    plumsimConfig.headless = cmdline.headless
     simulator = Simulator( config=plumsimConfig )
-    webServer = WebApp( simulator )
-    webServer.startServer()
+
+    # Dash and plotly take a good part of the startup time, only load them when the web app is used
+    webTime = 0
+    if not plumsimConfig.headless:
+        start = time.perf_counter()
+        from simulator_webserver import WebApp
+        webServer = WebApp( simulator )
+        webServer.startServer()
+        webTime = time.perf_counter() - start
 
     config = ShellConfig()
     config.app = simulator
     config.config = plumsimConfig
     config.utils = DataLoaderUtils()
 
+    print( f"startup: {time.perf_counter() - STARTUP_TIME:.2f}s (imports {importTime:.2f}s, web app {webTime:.2f}s)" )
     shell = Shell( config )
     shell.prompt = '%s>> ' % ( "SIMULATOR" )
     shell._cmdloop( "" )
\ No newline at end of file
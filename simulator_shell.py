@@ -33,6 +33,9 @@ class Shell( ShellCommon ):
     def do_load_strategy( self, args ):
         self.config.app.loadStrategy( args )
 
+    def do_set_option( self, args ):
+        self.config.app.setOption( args )
+
     def do_save_config( self, args ):
         self.config.app.saveConfig( args )
 
@@ -49,7 +52,42 @@ class Shell( ShellCommon ):
         self.config.app.showOutliers( False, args )
 
     def do_simulate( self, args ):
+        """simulate [stream] [resume] [workers=host:port,...] [arrow=dir]
+        """
         self.config.app.simulate( args )
         
+    def do_query( self, args ):
+        """query [run N] [from DATE] [to DATE] [rule R1,R2] [tickers T1,T2] [by COL1,COL2] [limit N]
+        """
+        self.config.app.query( args )
+
+    def do_show_memory( self, args ):
+        """show_memory [ticker]
+        """
+        self.config.app.showMemory( args )
+
+    def do_scan( self, args ):
+        """scan - BUY rules that trigger on the latest bar of every ticker
+        """
+        self.config.app.scan( args )
+
+    def do_replay( self, args ):
+        """replay [file=PATH [ticker=T]] [socket=host:port] [from=DATE] [to=DATE] [budget=ms] [interval=s]
+        """
+        self.config.app.replay( args )
+
+    def do_export_arrow( self, args ):
+        """export_arrow [dir]
+        """
+        self.config.app.exportArrow( args )
+
+    def do_show_runs( self, args ):
+        self.config.app.showRuns( args )
+
+    def do_montecarlo( self, args ):
+        """montecarlo [paths=10000] [mode=bootstrap|shuffle] [procs=1] [seed=n]
+        """
+        self.config.app.monteCarlo( args )
+
     def do_show_pnl( self, args ):
         self.config.app.showPnl( args )
\ No newline at end of file
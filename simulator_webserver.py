@@ -6,8 +6,12 @@ import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output
+from dash.exceptions import PreventUpdate
 
 import threading
+from utils_common import runMetrics
+
+MONITOR_INTERVAL_MS = 1000
 
 class WebApp( object ):
     def __init__( self, simulator ) -> None:
@@ -49,12 +53,14 @@ class WebApp( object ):
                     [
                         dbc.Tab( label="performance", tab_id="perf_graph" ),
                         dbc.Tab( label="histogram", tab_id="histogram_chart" ),
-                        dbc.Tab( label="custom", tab_id="custom_chart" )
+                        dbc.Tab( label="custom", tab_id="custom_chart" ),
+                        dbc.Tab( label="monitor", tab_id="monitor" )
                     ],
                     id = "tabs",
                     active_tab = "perf_graph",
                 ),
                 html.Div( id="tab-content" ),
+                dcc.Interval( id="monitor-interval", interval=MONITOR_INTERVAL_MS ),
                 dbc.Button( "Simulate", color="primary", id="simulate-button" ),
                 html.Div( id="simulate-button-pressed", children="Press simulate button to start" )
             ]
@@ -66,16 +72,26 @@ class WebApp( object ):
         @app.callback(
             Output( "tab-content", "children" ),
             [ Input( "tabs", "active_tab" ),
-              Input( "simulate-button-pressed", "children" )
+              Input( "simulate-button-pressed", "children" ),
+              Input( "monitor-interval", "n_intervals" )
             ]
         )
-        def render_tab_content( active_tab, simulate_complete ):
-            
+        def render_tab_content( active_tab, simulate_complete, n_intervals ):
+            # The interval only refreshes the monitor, the other tabs are not redrawn every tick
+            triggered = [ t[ "prop_id" ] for t in dash.callback_context.triggered ]
+            if triggered == [ "monitor-interval.n_intervals" ] and active_tab != "monitor":
+                raise PreventUpdate
+
             if active_tab == "perf_graph":
-                fig = px.line( self.simulator.trades_master, x="Date", y="AggregateProfits" )
-                return dcc.Graph( style={ "width": "50vw", "height": "50vh" }, 
-                                  config={ "displaylogo" : False },
-                                  figure=fig )
+                equity = self.simulator.equity
+                if not equity.empty:
+                    fig = px.line( x=equity.index, y=equity.values, labels={ "x" : "Date", "y" : "Equity" } )
+                else:
+                    fig = px.line( self.simulator.trades_master, x="Date", y="AggregateProfits" )
+                return html.Div( [ dcc.Graph( style={ "width": "50vw", "height": "50vh" }, 
+                                              config={ "displaylogo" : False },
+                                              figure=fig ),
+                                   self.metricsTable() ] )
             elif active_tab == "histogram_chart":
                 fig = px.histogram( self.simulator.trades_master, x="Profits" )
                 return dcc.Graph( style={ "width": "50vw", "height": "50vh" }, 
@@ -85,6 +101,8 @@ class WebApp( object ):
                 return dcc.Graph( style={ "width": "50vw", "height": "50vh" }, 
                                   config={ "displaylogo" : False },
                                   figure=self.simulator.custom_fig )
+            elif active_tab == "monitor":
+                return self.monitorPanel()
 
         @app.callback( 
             Output( "simulate-button-pressed", "children" ),
@@ -96,6 +114,44 @@ class WebApp( object ):
                 self.simulator.simulate( None )
             return None
 
+    def metricsTable( self ):
+        metrics = self.simulator.metrics
+        if metrics is None:
+            return html.Div()
+
+        rows = [ html.Tr( [ html.Td( k ), html.Td( v ) ] ) for k, v in metrics.summary().items() ]
+        return dbc.Table( html.Tbody( rows ), bordered=False, size="sm", style={ "width": "30vw" } )
+
+    def monitorPanel( self ):
+        """Live view of the simulation in progress, read from the in-process metrics buffer
+        """
+        snap = runMetrics.snapshot()
+        counters = snap[ "counters" ]
+        lookups = counters.get( "cacheHits", 0 ) + counters.get( "cacheMisses", 0 )
+        hitRate = f"{counters.get( 'cacheHits', 0 ) / lookups:.0%}" if lookups else "-"
+
+        summary = { "status" : "running" if snap[ "running" ] else "idle",
+                    "tickers" : f"{snap[ 'done' ]} / {snap[ 'tickers' ]}",
+                    "elapsed" : f"{snap[ 'elapsed' ]:.1f} s",
+                    "bars/sec" : f"{snap[ 'barsPerSec' ]:,.0f}",
+                    "trades/sec" : f"{snap[ 'tradesPerSec' ]:,.1f}",
+                    "memory" : f"{snap[ 'memory' ] / 2**20:,.0f} MB",
+                    "result cache hit rate" : hitRate }
+        summaryRows = [ html.Tr( [ html.Td( k ), html.Td( v ) ] ) for k, v in summary.items() ]
+
+        stages = sorted( ( ( k, t, n ) for k, ( t, n ) in snap[ "stages" ].items() if n ), key=lambda s: s[ 1 ], reverse=True )
+        stageRows = [ html.Tr( [ html.Td( k ), html.Td( n ), html.Td( f"{t:.3f}" ), html.Td( f"{t / n * 1e6:,.1f}" ) ] )
+                      for k, t, n in stages ]
+        slowRows = [ html.Tr( [ html.Td( t ), html.Td( f"{secs:.3f}" ) ] ) for t, secs in snap[ "slowest" ] ]
+
+        table = lambda header, rows: dbc.Table( [ html.Thead( html.Tr( [ html.Th( h ) for h in header ] ) ), html.Tbody( rows ) ],
+                                                bordered=False, size="sm", style={ "width": "40vw" } )
+        return html.Div( [ dbc.Table( html.Tbody( summaryRows ), bordered=False, size="sm", style={ "width": "30vw" } ),
+                           html.H5( "Stages" ),
+                           table( [ "stage", "calls", "total s", "per call us" ], stageRows ),
+                           html.H5( "Slowest tickers" ),
+                           table( [ "ticker", "seconds" ], slowRows ) ] )
+
     def startServer( self ):
         self.web_thread = threading.Thread( target=self.app.run_server, kwargs={ "debug" : True, "host": "0.0.0.0", "use_reloader" : False, "dev_tools_hot_reload" : False } )
         self.web_thread_active = True
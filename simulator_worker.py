@@ -0,0 +1,271 @@
+import os, sys, io, time, contextlib
+import argparse
+import pickle
+import queue
+import socket
+import socketserver
+import struct
+import threading
+
+import trade_engine
+from trade_engine import TradeEngine
+
+########################################################################
+# Remote workers for sharded simulation. A worker process runs TradeEngine
+# against its own copy of the data directory, a coordinator (WorkerPool)
+# hands out tickers to a set of workers and collects the trade ledgers.
+#
+# Messages are pickled, with a 4 byte length prefix. Pickle is not safe
+# against untrusted peers, only run workers on a trusted network.
+########################################################################
+HEADER = struct.Struct( "!I" )
+
+# Seconds a coordinator waits on a worker, for the connection and for the reply to a ticker. A worker
+# that does not answer in time is treated as failed and its ticker is handed to the others
+WORKER_TIMEOUT = 600
+
+def sendMessage( sock, message ):
+    payload = pickle.dumps( message, protocol=pickle.HIGHEST_PROTOCOL )
+    sock.sendall( HEADER.pack( len( payload ) ) + payload )
+
+def recvMessage( sock ):
+    header = recvExactly( sock, HEADER.size )
+    if header is None:
+        return None
+    ( length, ) = HEADER.unpack( header )
+    return pickle.loads( recvExactly( sock, length ) )
+
+def recvExactly( sock, n ):
+    buf = bytearray()
+    while len( buf ) < n:
+        chunk = sock.recv( n - len( buf ) )
+        if not chunk:
+            if buf:
+                raise ConnectionError( "Connection closed in the middle of a message" )
+            return None
+        buf += chunk
+    return bytes( buf )
+
+def connect( address, timeout=None ):
+    """address is either "host:port" or "unix:/path/to/socket"
+    """
+    if address.startswith( "unix:" ):
+        sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        sock.settimeout( timeout )
+        sock.connect( address[ len( "unix:" ): ] )
+    else:
+        host, port = address.rsplit( ":", 1 )
+        sock = socket.create_connection( ( host, int( port ) ), timeout=timeout )
+    return sock
+
+########################################################################
+# Worker side
+########################################################################
+class WorkerHandler( socketserver.BaseRequestHandler ):
+    def handle( self ):
+        while True:
+            try:
+                message = recvMessage( self.request )
+            except ( ConnectionError, OSError ):
+                return
+            if message is None:
+                return
+
+            if message[ "op" ] == "ping":
+                sendMessage( self.request, { "op" : "pong", "pid" : os.getpid() } )
+            elif message[ "op" ] == "run":
+                sendMessage( self.request, self.server.runTicker( message ) )
+
+class WorkerMixin( object ):
+    verbose = False
+
+    def runTicker( self, message ):
+        ticker = message[ "ticker" ]
+        start = time.perf_counter()
+        reply = { "op" : "result", "ticker" : ticker, "trades" : None, "error" : None }
+        try:
+            out = sys.stdout if self.verbose else io.StringIO()
+            with contextlib.redirect_stdout( out ):
+                trader = TradeEngine( ticker, message[ "strategyInfo" ], dict( message[ "params" ] ) )
+                trader.run()
+            reply[ "trades" ] = trader.trades
+        except Exception as e:
+            reply[ "error" ] = f"{type( e ).__name__}: {e}"
+        reply[ "elapsed" ] = time.perf_counter() - start
+        return reply
+
+class TCPWorker( WorkerMixin, socketserver.ThreadingTCPServer ):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class UnixWorker( WorkerMixin, socketserver.ThreadingUnixStreamServer ):
+    daemon_threads = True
+
+def serve( address, data_dir=None, verbose=False ):
+    if data_dir:
+        trade_engine.DATA_DIR = data_dir
+
+    if address.startswith( "unix:" ):
+        path = address[ len( "unix:" ): ]
+        if os.path.exists( path ):
+            os.unlink( path )
+        server = UnixWorker( path, WorkerHandler )
+    else:
+        host, port = address.rsplit( ":", 1 )
+        server = TCPWorker( ( host, int( port ) ), WorkerHandler )
+    server.verbose = verbose
+
+    print( f"worker {os.getpid()} listening on {address}, data in {trade_engine.DATA_DIR}" )
+    with server:
+        server.serve_forever()
+
+########################################################################
+# Coordinator side
+########################################################################
+class WorkerPool( object ):
+    """Hands out tickers to remote workers. Every worker pulls the next ticker as soon as it is done
+    with the previous one, and once there is nothing left to hand out, idle workers steal a copy of
+    the longest running ticker, so a single slow ticker does not hold up the whole run.
+    A ticker whose worker fails or hangs for longer than timeout is handed out again, up to retries times.
+    """
+    def __init__( self, addresses, retries=2, timeout=WORKER_TIMEOUT ) -> None:
+        self.addresses = addresses
+        self.retries = retries
+        self.timeout = timeout
+
+    def run( self, tickers, strategyInfo, params ):
+        """Generator of ( ticker, trades ) as results come in. Tickers the engine failed on are left in
+        self.failed, tickers that could not be run because the workers failed are left in self.lost
+        """
+        self.pending = queue.Queue()
+        for t in tickers:
+            self.pending.put( t )
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        self.inFlight = {}
+        self.attempts = { t : 0 for t in tickers }
+        self.done = set()
+        self.failed = {}
+        self.lost = {}
+        self.stolen = set()
+        self.liveWorkers = len( self.addresses )
+        self.strategyInfo = strategyInfo
+        self.params = { k : v for k, v in params.items() if k != "__builtins__" }
+
+        threads = [ threading.Thread( target=self.workerLoop, args=( a, ), daemon=True ) for a in self.addresses ]
+        for th in threads:
+            th.start()
+
+        remaining = len( self.attempts )
+        while remaining:
+            item = self.results.get()
+            if item is None:
+                # All the workers are gone, whatever is left has failed
+                with self.lock:
+                    for t in self.attempts:
+                        if not self.settled( t ):
+                            self.lost[ t ] = "no workers left"
+                break
+
+            ticker, trades = item
+            remaining -= 1
+            if trades is not None:
+                yield ( ticker, trades )
+
+    def nextTicker( self ):
+        with self.lock:
+            while True:
+                try:
+                    t = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if not self.settled( t ):
+                    self.inFlight[ t ] = time.perf_counter()
+                    return t
+
+            # Nothing left to hand out, steal the longest running ticker that nobody has stolen yet
+            candidates = [ ( start, t ) for t, start in self.inFlight.items() if t not in self.stolen ]
+            if candidates:
+                _, t = min( candidates )
+                self.stolen.add( t )
+                return t
+            return None
+
+    def settled( self, ticker ):
+        return ticker in self.done or ticker in self.failed or ticker in self.lost
+
+    def finish( self, ticker, trades, error=None, lost=False ):
+        with self.lock:
+            if self.settled( ticker ):
+                return
+            if lost:
+                self.lost[ ticker ] = error
+            elif error is not None:
+                self.failed[ ticker ] = error
+            else:
+                self.done.add( ticker )
+            self.inFlight.pop( ticker, None )
+        self.results.put( ( ticker, trades if error is None else None ) )
+
+    def retry( self, ticker, reason ):
+        with self.lock:
+            if self.settled( ticker ):
+                return
+            self.attempts[ ticker ] += 1
+            give_up = self.attempts[ ticker ] > self.retries
+            if not give_up:
+                self.inFlight.pop( ticker, None )
+                self.stolen.discard( ticker )
+                self.pending.put( ticker )
+        if give_up:
+            self.finish( ticker, None, reason, lost=True )
+
+    def workerLoop( self, address ):
+        ticker = None
+        try:
+            sock = connect( address, self.timeout )
+            with sock:
+                while True:
+                    ticker = self.nextTicker()
+                    if ticker is None:
+                        # Others may still fail and put their tickers back, so wait until everything is settled
+                        with self.lock:
+                            settled = not self.inFlight and self.pending.empty()
+                        if settled:
+                            return
+                        time.sleep( 0.05 )
+                        continue
+
+                    sendMessage( sock, { "op" : "run", "ticker" : ticker, "strategyInfo" : self.strategyInfo, "params" : self.params } )
+                    reply = recvMessage( sock )
+                    if reply is None:
+                        raise ConnectionError( "worker closed the connection" )
+
+                    if reply[ "error" ]:
+                        # A ticker that breaks the engine will break it on every worker, so it is not retried
+                        print( f"{address}: {ticker} failed: {reply[ 'error' ]}" )
+                        self.finish( ticker, None, reply[ "error" ] )
+                    else:
+                        self.finish( ticker, reply[ "trades" ] )
+                    ticker = None
+
+        except ( OSError, EOFError, pickle.UnpicklingError ) as e:
+            print( f"worker {address} failed: {e}" )
+            if ticker is not None:
+                self.retry( ticker, str( e ) )
+        finally:
+            with self.lock:
+                self.liveWorkers -= 1
+                last = ( self.liveWorkers == 0 )
+            if last:
+                self.results.put( None )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description="PlumSim simulation worker" )
+    parser.add_argument( "address", help="host:port or unix:/path/to/socket to listen on" )
+    parser.add_argument( "--data-dir", default=None, help="data directory of this worker" )
+    parser.add_argument( "--verbose", action="store_true" )
+    args = parser.parse_args()
+
+    serve( args.address, args.data_dir, args.verbose )
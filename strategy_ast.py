@@ -0,0 +1,195 @@
+import ast
+import builtins
+
+from builtin_commands import Commands
+
+########################################################################
+# Static analysis of parsed strategies. Every condition, price and stop
+# loss expression is parsed into an AST and the names it references are
+# sorted into data columns, indicators and PARAMS. The engine uses the
+# result to load and keep only the columns a strategy actually needs.
+########################################################################
+
+# Columns of the daily data as the strategies see them, and their names in the stored files
+DAILY_COLUMNS = { "Close" : "close", "Open" : "open", "High" : "high", "Low" : "low", "volume" : "volume", "symbol" : "symbol" }
+INTRADAY_COLUMNS = { "close" : "marketClose", "open" : "marketOpen", "high" : "marketHigh", "low" : "marketLow", "volume" : "marketVolume" }
+
+# Columns the indicators are computed from
+INDICATOR_INPUTS = { "movingAvg" : { "Close" },
+                     "expMovingAvg" : { "Close" },
+                     "trend" : { "Close" },
+                     "prevClose" : { "Close" },
+                     "prevOpen" : { "Open" },
+                     "prevHigh" : { "High" },
+                     "prevLow" : { "Low" },
+                     "gapOpen" : { "Open", "Close" },
+                     "prevOpenCloseRange" : { "Open", "Close" },
+                     "prevRange" : { "High", "Low" },
+                     "range" : { "High", "Low" },
+                     "adr" : { "High", "Low" },
+                     "dayOfWeek" : set() }
+
+# Names the engine puts into the environment of every expression itself
+ENGINE_NAMES = { "Price", "Index" }
+
+def names( expr ):
+    """Returns the names referenced by a python expression
+    """
+    if not expr:
+        return set()
+    tree = ast.parse( expr.strip(), mode="eval" )
+    return { node.id for node in ast.walk( tree ) if isinstance( node, ast.Name ) }
+
+def isIntraday( timeframe ):
+    ( d1, t1, d2, t2 ) = timeframe
+    return "Min" in str( d1 ) or "Min" in str( d2 )
+
+def analyze( strategyInfo, params ):
+    """Returns what a parsed strategy references:
+        columns         : daily columns, including the ones the indicators and stop losses are computed from
+        intradayColumns : intraday columns, None if no rule runs on intraday data
+        indicators      : indicator names, e.g. MA50
+        params          : PARAMS used by the expressions
+        timeframes      : the timeframes of the rules
+        unknown         : names that are none of the above, nor python builtins
+    """
+    commands = Commands()
+    daily, intraday, params_used, unknown = set(), set(), set(), set()
+    indicators = {}
+    timeframes = set()
+    stopLosses = False
+
+    for side in ( "BUY", "SELL" ):
+        for name, ( timeframe, qty, condition, priceCondition, stopLoss ) in strategyInfo[ side ].items():
+            timeframes.add( timeframe )
+            stopLosses = stopLosses or bool( stopLoss )
+            columns = intraday if isIntraday( timeframe ) else daily
+            known = INTRADAY_COLUMNS if isIntraday( timeframe ) else DAILY_COLUMNS
+
+            for n in names( condition ) | names( priceCondition ) | names( stopLoss ):
+                parsed = commands.parse( f" {n}" )
+                if n in known:
+                    columns.add( n )
+                elif n in parsed:
+                    indicators[ n ] = parsed[ n ]
+                elif n in params:
+                    params_used.add( n )
+                elif n not in ENGINE_NAMES and not hasattr( builtins, n ):
+                    unknown.add( n )
+
+    # Live stop losses are checked against the Low and filled at the Open of the bar
+    if stopLosses:
+        daily |= { "Low", "Open" }
+        params_used.add( "DISPERSION" )
+
+    for fname, *_ in indicators.values():
+        daily |= INDICATOR_INPUTS.get( fname, { "Close" } )
+    daily.add( "Close" )
+
+    return { "columns" : daily,
+             "intradayColumns" : intraday if any( isIntraday( t ) for t in timeframes ) else None,
+             "indicators" : set( indicators ),
+             "params" : params_used,
+             "timeframes" : timeframes,
+             "unknown" : unknown }
+
+def storedColumns( analysis, period ):
+    """Names of the columns of the stored files that have to be read for a strategy
+    """
+    if period == "daily":
+        return [ "date" ] + [ DAILY_COLUMNS[ c ] for c in analysis[ "columns" ] ]
+    return [ "date", "minute" ] + [ INTRADAY_COLUMNS[ c ] for c in ( analysis[ "intradayColumns" ] or () ) ]
+
+########################################################################
+# Common subexpressions of the rules of a side. A subexpression that
+# occurs more than once, in one rule or across rules, is rewritten into
+# a lookup in a per row memo so that it is computed once per row. The
+# memo is filled lazily, which keeps the short circuiting of and/or.
+########################################################################
+SHARED_MEMO = "_shared"
+SHARED_NODES = ( ast.Compare, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Call )
+
+def sharedSubexpressions( exprs ):
+    """Returns the dumps of the subexpressions that occur more than once in exprs
+    """
+    counts = {}
+    for expr in exprs:
+        if not expr:
+            continue
+        for node in ast.walk( ast.parse( expr.strip(), mode="eval" ) ):
+            if isinstance( node, SHARED_NODES ):
+                key = ast.dump( node )
+                counts[ key ] = counts.get( key, 0 ) + 1
+    return { key for key, n in counts.items() if n > 1 }
+
+class _MemoizeShared( ast.NodeTransformer ):
+    def __init__( self, shared ) -> None:
+        self.shared = shared
+
+    def visit( self, node ):
+        if isinstance( node, SHARED_NODES ):
+            key = ast.dump( node )
+            if key in self.shared:
+                # _shared[ key ] if key in _shared else _shared.setdefault( key, node )
+                memo = lambda: ast.Name( id=SHARED_MEMO, ctx=ast.Load() )
+                return ast.IfExp( test=ast.Compare( left=ast.Constant( key ), ops=[ ast.In() ], comparators=[ memo() ] ),
+                                  body=ast.Subscript( value=memo(), slice=ast.Constant( key ), ctx=ast.Load() ),
+                                  orelse=ast.Call( func=ast.Attribute( value=memo(), attr="setdefault", ctx=ast.Load() ),
+                                                   args=[ ast.Constant( key ), self.generic_visit( node ) ], keywords=[] ) )
+        return self.generic_visit( node )
+
+def compileShared( expr, shared=() ):
+    """Compiles expr for eval(), with the subexpressions in shared memoized in the _shared dict
+    of the locals. Returns None for an empty expression
+    """
+    if not expr:
+        return None
+    tree = ast.parse( expr.strip(), mode="eval" )
+    if shared:
+        tree = ast.fix_missing_locations( _MemoizeShared( shared ).visit( tree ) )
+    return compile( tree, "<rule>", "eval" )
+
+########################################################################
+# Conditions evaluated over arrays, one element per bar. and, or and not
+# are not defined on numpy arrays, they are rewritten into &, | and ~ of
+# the truth values of their operands, and chained comparisons into the
+# & of the single comparisons.
+########################################################################
+VECTOR_TRUTH = "_truth"
+
+class _Vectorize( ast.NodeTransformer ):
+    def truth( self, node ):
+        return ast.Call( func=ast.Name( id=VECTOR_TRUTH, ctx=ast.Load() ), args=[ node ], keywords=[] )
+
+    def combine( self, op, nodes ):
+        node = self.truth( nodes[ 0 ] )
+        for right in nodes[ 1: ]:
+            node = ast.BinOp( left=node, op=op, right=self.truth( right ) )
+        return node
+
+    def visit_BoolOp( self, node ):
+        self.generic_visit( node )
+        return self.combine( ast.BitAnd() if isinstance( node.op, ast.And ) else ast.BitOr(), node.values )
+
+    def visit_UnaryOp( self, node ):
+        self.generic_visit( node )
+        if isinstance( node.op, ast.Not ):
+            return ast.UnaryOp( op=ast.Invert(), operand=self.truth( node.operand ) )
+        return node
+
+    def visit_Compare( self, node ):
+        self.generic_visit( node )
+        if len( node.ops ) == 1:
+            return node
+        operands = [ node.left ] + node.comparators
+        compares = [ ast.Compare( left=operands[ i ], ops=[ op ], comparators=[ operands[ i + 1 ] ] ) for i, op in enumerate( node.ops ) ]
+        return self.combine( ast.BitAnd(), compares )
+
+def compileVectorized( expr ):
+    """Compiles a condition for eval() over arrays, the locals need a _truth function that returns
+    the truth value of every element of its argument. Returns None for an empty expression
+    """
+    if not expr:
+        return None
+    tree = ast.fix_missing_locations( _Vectorize().visit( ast.parse( expr.strip(), mode="eval" ) ) )
+    return compile( tree, "<vectorized>", "eval" )
@@ -1,22 +1,42 @@
 import pandas as pd
 import pathlib
 from pathlib import Path
+from collections import defaultdict
 import datetime
+import time
+import threading
+import json
+import zlib
+import os
 
-from pyEX.client import _INCLUDE_POINTS_RATES
+# Number of segment files a ticker can collect before they are compacted into its main file
+COMPACT_SEGMENTS = 8
+
+STORAGE_LOCKS = defaultdict( threading.Lock )
+
+# dtypes of the compact representation of the loaded data, see DataLoader.compactFrame()
+COMPACT_PRICE_DTYPE = "float32"
+COMPACT_PRICE_COLUMNS = [ "open", "high", "low", "close" ]
+# Volumes are whole numbers and float32 is exact only up to 2**24, so they get an unsigned integer dtype
+# when they fit in it. The capitalized variants are pandas' nullable dtypes for intraday data with missing bars
+COMPACT_VOLUME_DTYPES = { False : ( "uint32", "int64" ), True : ( "UInt32", "Int64" ) }
+COMPACT_VOLUME_MAX = 2**32 - 1
 
 
 class DataLoader( object ):
-    def __init__( self, data_dir ):
+    def __init__( self, data_dir, compact=False ):
         self.ticker = None
         self.path_prefix = None
         self.data_dir = pathlib.Path( data_dir )
         self.minimizeDownload = True
+        self.compact = compact
         
         if not self.data_dir.exists():
             return None
 
-    def data( self, ticker, period="daily" ):
+    def data( self, ticker, period="daily", columns=None ):
+        """columns limits the stored columns that are read, by their names in the files
+        """
         if ticker is None:
             return None
 
@@ -28,70 +48,264 @@ class DataLoader( object ):
             self.path_prefix.mkdir( parents=True, exist_ok=True )
 
         if period == "daily":
-            daily_data = self.loader( "daily" )
+            daily_data = self.loader( "daily", columns )
             if not daily_data.empty:
-                return self.formatDailyData( daily_data )
+                daily_data = self.formatDailyData( daily_data )
+                return self.compactFrame( daily_data ) if self.compact else daily_data
         elif period == "intraday":
-            intradayData = self.loader( "intraday" )
+            intradayData = self.loader( "intraday", columns )
             if not intradayData.empty:
-                return self.formatIntradayData( intradayData )
+                intradayData = self.formatIntradayData( intradayData )
+                return self.compactFrame( intradayData ) if self.compact else intradayData
         else:
             return None
 
-    def loader( self, period ):
+    def compactFrame( self, df ):
+        """Converts a formatted frame to a smaller representation: float32 prices, integer volumes and
+        a categorical symbol. The intraday minutes stay "HH:MM" strings, 1Min rules compare Index against
+        them and the index level holds every minute only once anyway
+        """
+        df = df.copy()
+        for c in COMPACT_PRICE_COLUMNS:
+            if c in df:
+                # Missing intraday values are pd.NA, which leaves the column with object dtype
+                df[ c ] = pd.to_numeric( df[ c ], errors="coerce" ).astype( COMPACT_PRICE_DTYPE )
+        if "volume" in df:
+            volume = pd.to_numeric( df[ "volume" ], errors="coerce" )
+            present = volume.dropna()
+            # Fractional volumes are left alone rather than truncated
+            if ( present % 1 == 0 ).all():
+                fits = present.empty or ( present.min() >= 0 and present.max() <= COMPACT_VOLUME_MAX )
+                small, large = COMPACT_VOLUME_DTYPES[ len( present ) < len( volume ) ]
+                volume = volume.astype( small if fits else large )
+            df[ "volume" ] = volume
+        if "symbol" in df:
+            df[ "symbol" ] = df[ "symbol" ].astype( "category" )
+        return df
+
+    def publish( self, ticker ):
+        """Loads the daily and intraday data for ticker into shared memory blocks and returns them by period.
+        Their descriptors can be sent to worker processes, which attach with SharedFrame.attach()
+        """
+        from shared_data import SharedFrame
+
+        shared = {}
+        for period in ( "daily", "intraday" ):
+            df = self.data( ticker, period=period )
+            if df is not None:
+                shared[ period ] = SharedFrame.publish( df )
+        return shared
+
+    def loader( self, period, columns=None ):
         """
-        Reads the .csv file and downloads additional data to keep it up to date if needed
-        If no .csv file exists, downloads entire historical data till today
+        Downloads additional data to keep the stored data up to date if needed, and reads it.
+        If no data is stored yet, downloads entire historical data till today
         Does not deal with a corrupted .csv file yet.
         """
+        self.update( self.ticker, period )
+        return self.read( self.ticker, period, columns )
 
-        file_name_suffix = "-daily.csv" if period == "daily" else "-intraday-1m.csv"
-        file_path = self.path_prefix.joinpath( self.ticker + file_name_suffix )
-        
-        data = pd.DataFrame()
-        last_stored_date = None
-        download = False
+    def update( self, ticker, period ):
+        """
+        Brings the stored data for ticker up to date. Whether anything needs to be downloaded is
+        decided from the manifest, without reading the data, and new data is appended as a segment
+        file instead of rewriting the whole history.
+        """
+        self.ticker = ticker.strip().upper()
+        self.data_dir.joinpath( self.ticker ).mkdir( parents=True, exist_ok=True )
 
+        entry = self.manifest( self.ticker ).get( period )
+        download = False
         today = pd.to_datetime( "today", utc=False ).normalize()
-        
-        if file_path.exists():
-            data = pd.read_csv ( file_path, index_col=0 )
-
-            # Check if csv has up to date data, otherwise we may need to download more        
-            sort_key = [ "date" ] if period == "daily" else [ "date", "minute" ]
-            data[ "date" ] = pd.to_datetime( data[ "date" ], utc=False )
-            data.sort_values( by=sort_key, ascending=True, inplace=True )
-            last_row = data.tail( 1 )
-            last_stored_date = last_row.iloc[ 0 ][ "date" ]
-    
-            # For intraday, check if we have a full day worth of data
-            # Otherwise, we will delete parial days data and redownload it
-            if period != "daily":
-                last_stored_min = ( last_row.iloc[ 0 ][ "minute" ] ).strip()
-                if last_stored_min != "15:59":
-                    print( "Removing incomplete intraday data for date %s" % last_stored_date )
-                    i = data[ data [ "date" ] == last_stored_date ].index
-                    data.drop( i, inplace=True )
-                    last_stored_date -= datetime.timedelta( days=1 )
 
-        if data.empty:
-            # Either a csv file didn't exist or there was no content in it
+        if not entry or not entry[ "rows" ]:
+            # Either nothing is stored yet or there was no content in it
             # In this case, we will download the entire dataset until today.
             start_date = None
             download = True
-        elif today > last_stored_date:
+        else:
+            last_stored_date = pd.to_datetime( entry[ "last_date" ] )
+
+            # For intraday, check if we have a full day worth of data, otherwise download that day again.
+            # The new copy of the day replaces the partial one when the data is read.
+            if period != "daily" and entry[ "last_minute" ] != "15:59":
+                print( "Incomplete intraday data for date %s" % last_stored_date )
+                last_stored_date -= datetime.timedelta( days=1 )
+
+            if today > last_stored_date:
                 start_date = last_stored_date + datetime.timedelta( days=1 )
                 download = True
-        else:
-            print( "%s data is up to date." % period )
+            else:
+                print( "%s data is up to date." % period )
 
         if download:
             downloaded_data = self.download( start_date=start_date, period=period )
-            data = pd.concat( [ data, downloaded_data ] )
-            data.to_csv( file_path )
+            if downloaded_data is not None and not downloaded_data.empty:
+                self.append( self.ticker, period, downloaded_data )
 
+    def read( self, ticker, period, columns=None ):
+        # Holding the lock keeps compactSegments() from replacing the main file and removing the segments
+        # between reading the manifest and reading the files it lists
+        with STORAGE_LOCKS[ ( str( self.data_dir ), ticker ) ]:
+            return self._read( ticker, period, columns )
+
+    def _read( self, ticker, period, columns=None ):
+        """read() without the lock, for callers that already hold it
+        """
+        entry = self.manifest( ticker ).get( period )
+        file_path = self.filePath( ticker, period )
+        files = [ file_path ] + [ file_path.with_name( f ) for f in ( entry[ "segments" ] if entry else [] ) ]
+
+        # Only parse the columns asked for, besides the leading index column of the files
+        usecols = None
+        if columns is not None:
+            columns = set( columns )
+            usecols = lambda c: c in columns or c == "" or c.startswith( "Unnamed" )
+
+        frames = [ pd.read_csv( f, index_col=0, usecols=usecols ) for f in files if f.exists() ]
+        frames = [ f for f in frames if not f.empty ]
+        if not frames:
+            return pd.DataFrame()
+
+        data = pd.concat( frames )
+        sort_key = [ "date" ] if period == "daily" else [ "date", "minute" ]
+        data[ "date" ] = pd.to_datetime( data[ "date" ], utc=False )
+        if len( frames ) > 1:
+            data.drop_duplicates( subset=sort_key, keep="last", inplace=True )
+        data.sort_values( by=sort_key, ascending=True, inplace=True )
+
+        # Leave out a partial trading day at the end of the intraday data
+        if period != "daily" and entry and entry[ "last_minute" ] != "15:59":
+            data = data[ data[ "date" ] != pd.to_datetime( entry[ "last_date" ] ) ]
         return data
 
+    ######################################################################
+    # Append-only storage. Each ticker has a main .csv file per period,
+    # newly downloaded data goes into numbered segment files next to it,
+    # and a manifest.json keeps the state of both periods so that it can
+    # be checked without reading any data.
+    ######################################################################
+    def filePath( self, ticker, period ):
+        file_name_suffix = "-daily.csv" if period == "daily" else "-intraday-1m.csv"
+        return self.data_dir.joinpath( ticker, ticker + file_name_suffix )
+
+    def manifestPath( self, ticker ):
+        return self.data_dir.joinpath( ticker, "manifest.json" )
+
+    def manifest( self, ticker ):
+        path = self.manifestPath( ticker )
+        if path.exists():
+            try:
+                with open( path, 'r' ) as f:
+                    return json.load( f )
+            except ValueError:
+                print( f"{ticker}: rebuilding unreadable manifest." )
+        return self.buildManifest( ticker )
+
+    def buildManifest( self, ticker ):
+        """Creates the manifest from the stored files, this is the only time their content has to be read
+        """
+        manifest = {}
+        if not self.data_dir.joinpath( ticker ).exists():
+            return manifest
+
+        for period in ( "daily", "intraday" ):
+            file_path = self.filePath( ticker, period )
+            if file_path.exists():
+                segments = sorted( p.name for p in file_path.parent.glob( file_path.stem + ".seg*.csv" ) )
+                manifest[ period ] = { "segments" : segments, "rows" : 0, "checksum" : 0, "last_date" : None, "last_minute" : None }
+                for f in [ file_path ] + [ file_path.with_name( f ) for f in segments ]:
+                    self.addToEntry( manifest[ period ], period, pd.read_csv( f, index_col=0 ), f.read_bytes() )
+                manifest[ period ][ "version" ] = manifest[ period ][ "checksum" ]
+        self.saveManifest( ticker, manifest )
+        return manifest
+
+    def saveManifest( self, ticker, manifest ):
+        path = self.manifestPath( ticker )
+        tmp_path = path.with_suffix( ".tmp" )
+        with open( tmp_path, 'w' ) as f:
+            json.dump( manifest, f )
+        os.replace( tmp_path, path )
+
+    def addToEntry( self, entry, period, df, content ):
+        entry[ "rows" ] += len( df )
+        entry[ "checksum" ] = zlib.crc32( content, entry[ "checksum" ] )
+        if df.empty:
+            return
+
+        dates = pd.to_datetime( df[ "date" ], utc=False )
+        last_date = dates.max()
+        if entry[ "last_date" ] is None or last_date >= pd.to_datetime( entry[ "last_date" ] ):
+            entry[ "last_date" ] = last_date.strftime( "%Y-%m-%d" )
+            if period != "daily":
+                entry[ "last_minute" ] = str( df.loc[ ( dates == last_date ).to_numpy(), "minute" ].max() ).strip()
+
+    def append( self, ticker, period, df ):
+        with STORAGE_LOCKS[ ( str( self.data_dir ), ticker ) ]:
+            manifest = self.manifest( ticker )
+            entry = manifest.get( period )
+            file_path = self.filePath( ticker, period )
+
+            if entry is None or not file_path.exists():
+                entry = { "segments" : [], "rows" : 0, "checksum" : 0, "last_date" : None, "last_minute" : None }
+                path = file_path
+            else:
+                n = max( [ int( f.rsplit( ".seg", 1 )[ 1 ].split( "." )[ 0 ] ) for f in entry[ "segments" ] ] + [ 0 ] ) + 1
+                path = file_path.with_name( f"{file_path.stem}.seg{n}.csv" )
+                entry[ "segments" ] += [ path.name ]
+
+            content = df.reset_index( drop=True ).to_csv().encode()
+            with open( path, 'wb' ) as f:
+                f.write( content )
+
+            self.addToEntry( entry, period, df, content )
+            entry[ "version" ] = zlib.crc32( content, entry.get( "version", 0 ) )
+            manifest[ period ] = entry
+            self.saveManifest( ticker, manifest )
+
+        if len( entry[ "segments" ] ) >= COMPACT_SEGMENTS:
+            threading.Thread( target=self.compactSegments, args=( ticker, period ), daemon=True ).start()
+
+    def compactSegments( self, ticker, period ):
+        """Merges the segments of ticker back into its main file
+        """
+        with STORAGE_LOCKS[ ( str( self.data_dir ), ticker ) ]:
+            manifest = self.manifest( ticker )
+            entry = manifest.get( period )
+            if not entry or not entry[ "segments" ]:
+                return
+
+            data = self._read( ticker, period ).reset_index( drop=True )
+            data[ "date" ] = data[ "date" ].dt.strftime( "%Y-%m-%d" )
+            content = data.to_csv().encode()
+
+            # The new main file is complete before it replaces the old one, and the segments only go once
+            # the manifest no longer lists them. Readers take the same lock, so none of them is in between
+            file_path = self.filePath( ticker, period )
+            tmp_path = file_path.with_suffix( ".tmp" )
+            with open( tmp_path, 'wb' ) as f:
+                f.write( content )
+            os.replace( tmp_path, file_path )
+
+            segments = entry[ "segments" ]
+            # Compaction does not change the data, so the version of the entry stays as it was
+            entry = { "segments" : [], "rows" : 0, "checksum" : 0, "last_date" : entry[ "last_date" ], "last_minute" : entry[ "last_minute" ],
+                      "version" : entry.get( "version", entry[ "checksum" ] ) }
+            self.addToEntry( entry, period, data, content )
+            manifest[ period ] = entry
+            self.saveManifest( ticker, manifest )
+
+            for f in segments:
+                file_path.with_name( f ).unlink( missing_ok=True )
+
+    def version( self, ticker, periods=( "daily", "intraday" ) ):
+        """Returns a cheap fingerprint of the stored data of ticker for periods. It changes whenever new data
+        is stored, and not when the segments are compacted
+        """
+        ticker = ticker.strip().upper()
+        manifest = self.manifest( ticker )
+        return [ ( period, manifest[ period ].get( "version", manifest[ period ][ "checksum" ] ) ) for period in periods if period in manifest ]
+
     def download( self, start_date=None, period="daily" ):
         if period == "daily":
             return self.daily( start_date=start_date )
@@ -105,7 +319,8 @@ class DataLoader( object ):
     # All the data provider specific functions start from here
     ######################################################################
     def formatDailyData( self, df ):
-        df = df[ [ 'date', 'close',	'high', 'low',	'open', 'symbol', 'volume' ] ].set_index( 'date' )
+        columns = [ c for c in [ 'date', 'close', 'high', 'low', 'open', 'symbol', 'volume' ] if c in df ]
+        df = df[ columns ].set_index( 'date' )
         return df
 
     def formatIntradayData( self, df ):
@@ -115,7 +330,8 @@ class DataLoader( object ):
                              'marketClose': 'close',
                              'marketVolume': 'volume' }, inplace=True )
         
-        df = df[ [ 'date', 'minute', 'high', 'low', 'open', 'close', 'volume' ] ].set_index( [ 'date', 'minute' ] )
+        columns = [ c for c in [ 'date', 'minute', 'high', 'low', 'open', 'close', 'volume' ] if c in df ]
+        df = df[ columns ].set_index( [ 'date', 'minute' ] )
         df.replace( to_replace=0, value=pd.NA, inplace=True )
         df.fillna( axis=0, method="ffill" )
         return df
@@ -188,22 +404,168 @@ class DataLoader( object ):
         return timeframe
 
 
+########################################################################
+# Catalog of per-ticker summary statistics, kept in one small file in the
+# data directory so that a universe can be screened without loading the
+# data of every ticker.
+########################################################################
+CATALOG_FILE = "catalog.csv"
+CATALOG_LOOKBACK = 63           # bars used for the price and volume statistics
+CATALOG_ADR_PERIOD = 20
+
+class TickerCatalog( object ):
+    def __init__( self, data_dir ) -> None:
+        self.path = pathlib.Path( data_dir ).joinpath( CATALOG_FILE )
+        self.catalog = None
+
+    def load( self ):
+        if self.catalog is None:
+            if self.path.exists():
+                self.catalog = pd.read_csv( self.path, index_col="ticker" )
+            else:
+                self.catalog = pd.DataFrame( columns=[ "first_date", "last_date", "days", "price", "avg_volume",
+                                                       "avg_dollar_volume", "adr", "checksum" ] ).rename_axis( "ticker" )
+        return self.catalog
+
+    def save( self ):
+        if self.catalog is not None:
+            tmp_path = self.path.with_suffix( ".tmp" )
+            self.catalog.sort_index().to_csv( tmp_path )
+            os.replace( tmp_path, self.path )
+
+    def refresh( self, loader, ticker ):
+        """Recomputes the statistics of ticker, unless its daily data has not changed since the last time.
+        Returns the daily data if it had to be read
+        """
+        catalog = self.load()
+        entry = loader.manifest( ticker ).get( "daily" )
+        if not entry:
+            return None
+        if ticker in catalog.index and catalog.at[ ticker, "checksum" ] == entry[ "checksum" ]:
+            return None
+
+        data = loader.read( ticker, "daily" )
+        if data.empty:
+            return None
+        catalog.loc[ ticker ] = self.stats( data ) | { "checksum" : entry[ "checksum" ] }
+        return data
+
+    def stats( self, data ):
+        recent = data.tail( CATALOG_LOOKBACK )
+        dollarVolume = recent[ "close" ] * recent[ "volume" ]
+        ranges = ( data[ "high" ] / data[ "low" ] - 1 ).tail( CATALOG_ADR_PERIOD )
+        return { "first_date" : data[ "date" ].iloc[ 0 ].strftime( "%Y-%m-%d" ),
+                 "last_date" : data[ "date" ].iloc[ -1 ].strftime( "%Y-%m-%d" ),
+                 "days" : len( data ),
+                 "price" : round( float( recent[ "close" ].median() ), 4 ),
+                 "avg_volume" : round( float( recent[ "volume" ].mean() ) ),
+                 "avg_dollar_volume" : round( float( dollarVolume.mean() ) ),
+                 "adr" : round( float( ranges.mean() ), 4 ) }
+
+    def select( self, expr ):
+        """Returns the tickers matching expr, e.g. "avg_volume > 1e6 and price > 5"
+        """
+        return list( self.load().query( expr ).index )
+
+
+########################################################################
+# Prefetching of the data of the tickers a simulation is about to run.
+# The reads and the parsing happen on a small thread pool, so that the
+# disk, or a network filesystem, is busy while the current ticker is
+# being simulated. The loaded frames are handed over in ticker order.
+########################################################################
+class Prefetcher( object ):
+    """Loads the data of upcoming tickers with load( ticker ). At most depth tickers are loaded ahead
+    and no new load is started while the data loaded but not yet taken holds memoryLimit bytes or more.
+    tickers may be a generator, it is consumed only as far as the loads ahead go
+    """
+    def __init__( self, load, tickers, depth=4, memoryLimit=512 * 2**20, threads=2 ) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.load = load
+        self.tickers = iter( tickers )
+        self.depth = depth
+        self.memoryLimit = memoryLimit
+        self.pool = ThreadPoolExecutor( max_workers=threads, thread_name_prefix="prefetch" )
+        self.futures = {}
+        self.sizes = []
+        self.hits = 0
+        self.waited = 0.0
+        self.fill()
+
+    def loadTicker( self, ticker ):
+        data = self.load( ticker )
+        size = sum( int( f.memory_usage( deep=True ).sum() ) for f in data if f is not None )
+        self.sizes.append( size )
+        return data, size
+
+    def held( self ):
+        """Bytes of the loaded data not taken yet, with the loads still running counted at the average size so far
+        """
+        done = [ f for f in self.futures.values() if f.done() and f.exception() is None ]
+        running = len( [ f for f in self.futures.values() if not f.done() ] )
+        average = sum( self.sizes ) / len( self.sizes ) if self.sizes else 0
+        return sum( f.result()[ 1 ] for f in done ) + running * average
+
+    def fill( self ):
+        while len( self.futures ) < self.depth:
+            # One load is always kept going, however large the tickers are. Until a load has finished
+            # there is no telling how large they are, so only one is started
+            if self.futures and ( not self.sizes or self.held() >= self.memoryLimit ):
+                break
+            ticker = next( self.tickers, None )
+            if ticker is None:
+                break
+            self.futures[ ticker ] = self.pool.submit( self.loadTicker, ticker )
+
+    def get( self, ticker ):
+        """Returns the data loaded for ticker, None if it was not prefetched or could not be loaded
+        """
+        future = self.futures.pop( ticker, None )
+        data = None
+        if future is not None:
+            start = time.perf_counter()
+            try:
+                data, _ = future.result()
+                self.hits += 1
+            except Exception as e:
+                print( f"{ticker}: prefetch failed, {e}" )
+            self.waited += time.perf_counter() - start
+        self.fill()
+        return data
+
+    def close( self ):
+        self.pool.shutdown( wait=False, cancel_futures=True )
+        self.futures = {}
+
+
 class DataLoaderUtils( object ):
     def __init__( self ) -> None:
         super().__init__()
         self.data_dir = "./data"
 
     def data_update_cache( self, args ):
+        from indicator_state import IndicatorStore
+
         loader = DataLoader( self.data_dir )
+        catalog = TickerCatalog( self.data_dir )
+        states = IndicatorStore( self.data_dir )
         saved_minimizeDownload = loader.minimizeDownload
         loader.minimizeDownload = False
         for p in Path( self.data_dir ).iterdir():
             if p.is_dir():
                 print( p.name )
                 ticker = str( p.name )
-                loader.data( ticker, period="daily" )
-                loader.data( ticker, period="intraday" )
+                loader.update( ticker, period="daily" )
+                loader.update( ticker, period="intraday" )
+                data = catalog.refresh( loader, ticker )
+
+                # Move the indicator state kept for scan forward by the new bars
+                if data is not None:
+                    states.advance( ticker, data )
         loader.minimizeDownload = saved_minimizeDownload
+        catalog.save()
+        states.save()
 
     def download_data( self, args ):
         """Takes a filename as argument and downloads historical data for all symbols in the file
@@ -215,11 +577,14 @@ class DataLoaderUtils( object ):
 
         wl = pd.read_csv( wl_path )
         loader = DataLoader( self.data_dir )
+        catalog = TickerCatalog( self.data_dir )
         for t in wl[ "Symbols" ]:
             print( t )
-            ticker = t.strip()
+            ticker = t.strip().upper()
             try:
-                loader.data( ticker, period="daily" )
-                loader.data( ticker, period="intraday" )
+                loader.update( ticker, period="daily" )
+                loader.update( ticker, period="intraday" )
+                catalog.refresh( loader, ticker )
             except:
-                pass
\ No newline at end of file
+                pass
+        catalog.save()
\ No newline at end of file
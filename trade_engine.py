@@ -1,5 +1,6 @@
 from pathlib import Path
 from collections import OrderedDict, namedtuple
+import numpy as np
 import pandas as pd
 import sys, code, traceback
 from enum import Enum
@@ -8,6 +9,7 @@ from ticker_data import DataLoader
 
 from utils_common import timer, timerData
 from builtin_commands import Commands
+from strategy_ast import storedColumns, sharedSubexpressions, compileShared, compileVectorized, isIntraday, names, SHARED_MEMO, VECTOR_TRUTH
 
 DATA_DIR = "./data"
 
@@ -21,7 +23,7 @@ class TradeType( Enum ):
     COVER = 4
 
 class TradeEngine( object ):
-    def __init__( self, ticker, strategyInfo, params={}, config=None ):
+    def __init__( self, ticker, strategyInfo, params={}, config=None, load=True, data=None, intradayData=None ):
         self._ticker = ticker
         self.strategyInfo = strategyInfo
         self.params = params
@@ -36,36 +38,182 @@ class TradeEngine( object ):
         self.positions = pd.DataFrame( columns=[ 'Date', 'Ticker', 'Type', 'Strategy', 'Price', 'Quantity' ] )
         self.openTrades = pd.DataFrame( columns=[ 'BuyDate', 'Type', 'BuyPrice', 'StopPrice', 'Quantity' ] )
 
-        self.loader = DataLoader( DATA_DIR )
-        self.data = self.loader.data( ticker, period="daily" )
-        self.intradayData = self.loader.data( ticker, period="intraday" )
+        # Simulation window, evaluation is restricted to these dates plus the indicator warmup
+        self.startDate = pd.to_datetime( params[ "START_DATE" ] ) if params.get( "START_DATE" ) else None
+        self.endDate = pd.to_datetime( params[ "END_DATE" ] ) if params.get( "END_DATE" ) else None
+
+        # Opt-in float32/categorical representation of the data and the indicators
+        self.compact = getattr( config, "compactData", False )
+        self.loader = DataLoader( DATA_DIR, compact=self.compact )
+        self.matrix = {}
+        self.firstTriggers = {}
+
+        # An engine that is not loaded only holds a trade ledger computed earlier
+        if not load:
+            self.data = pd.DataFrame()
+            self.intradayData = None
+            self.initTradeInfo()
+            return
+
+        # The data can be handed over already loaded, e.g. attached from shared memory by the batch runner
+        # or prefetched by the simulator
+        if data is None:
+            data = self.loadData( self.loader, ticker, strategyInfo, "daily" )
+        if intradayData is None:
+            intradayData = self.loadData( self.loader, ticker, strategyInfo, "intraday" )
+        self.data = data
+        self.intradayData = intradayData
 
         self.setup()
 
+    @staticmethod
+    def loadData( loader, ticker, strategyInfo, period ):
+        """Reads the data of ticker for period the way an engine for strategyInfo needs it: only the columns
+        the strategy references, and no intraday data unless it has intraday rules
+        """
+        analysis = strategyInfo.get( "analysis" )
+        if period == "intraday" and analysis is not None and analysis[ "intradayColumns" ] is None:
+            return None
+        return loader.data( ticker, period=period, columns=storedColumns( analysis, period ) if analysis else None )
+
     def initTradeInfo( self ):
         self.tradeInfo = {}
         self.tradeInfo[ "totalQty" ] = 0
         self.tradeInfo[ "triggered" ] = []
         self.tradeInfo[ "liveStopLoss" ] = []
 
+    @staticmethod
+    def prepareData( data ):
+        """Brings loaded daily data into the form the strategies are written against, in place
+        """
+        data.rename( columns={ 'close': 'Close',
+                               'open': 'Open',
+                               'low': 'Low', 
+                               'high': 'High' }, inplace=True )
+        data.index.rename( 'Date', inplace=True )
+        data.sort_index( inplace=True )
+        return data
+
     def setup( self ):
-        self.data.rename( columns={ 'close': 'Close',
-                                    'open': 'Open',
-                                    'low': 'Low', 
-                                    'high': 'High' }, inplace=True )
-        self.data.index.rename( 'Date', inplace=True )
-        self.data.sort_index( inplace=True )
+        self.prepareData( self.data )
 
         # Init meta data
         self.initTradeInfo()
 
-        # Compile the indicators
-        commands = Commands()
-        code = self.strategyInfo[ "code" ]
+        # Compile the indicators only over the window we are going to trade in
+        commands = Commands( compact=self.compact )
+        analysis = self.strategyInfo.get( "analysis" )
+        code = " " + " ".join( sorted( analysis[ "indicators" ] ) ) if analysis else self.strategyInfo[ "code" ]
+        self.trimToWindow( commands.warmup( code ) )
         commands.compile( code, self.data )
 
+        # Every row is handed to the conditions as a dict, drop the columns none of them use
+        if analysis:
+            keep = analysis[ "columns" ] | analysis[ "indicators" ]
+            self.data.drop( columns=[ c for c in self.data.columns if c not in keep ], inplace=True )
+
+    def provides( self, analysis ):
+        """Checks if the loaded data has all the columns a strategy with this analysis references
+        """
+        if analysis is None:
+            return True
+        if not analysis[ "columns" ] <= set( self.data.columns ):
+            return False
+        if analysis[ "intradayColumns" ] is not None:
+            if self.intradayData is None or not analysis[ "intradayColumns" ] <= set( self.intradayData.columns ):
+                return False
+        return True
+
+    def trimToWindow( self, warmup ):
+        """Drops the data outside of the simulation window, keeping warmup bars before the start
+        so that the indicators are valid from the first day of the window
+        """
+        lo, hi = 0, len( self.data )
+        if self.startDate is not None:
+            lo = max( self.data.index.searchsorted( self.startDate ) - warmup, 0 )
+        if self.endDate is not None:
+            hi = self.data.index.searchsorted( self.endDate, side="right" )
+        self.atHistoryStart = ( lo == 0 )
+        self.atHistoryEnd = ( hi == len( self.data ) )
+        # The daily data is copied, also when it is attached from shared memory, the indicators are added to it
+        self.data = self.data.iloc[ lo : hi ].copy()
+
+        # Intraday data is not used by the indicators, so it needs no warmup. It is sorted by date,
+        # so slicing it by position keeps it a view instead of copying it. The dates it was cut at,
+        # if any, limit the windows the engine can be reused for
+        self.intradayFrom, self.intradayTo = None, None
+        if self.intradayData is not None and not self.intradayData.empty:
+            dates = self.intradayData.index.get_level_values( 0 )
+            lo = dates.searchsorted( self.startDate ) if self.startDate is not None else 0
+            hi = dates.searchsorted( self.endDate, side="right" ) if self.endDate is not None else len( dates )
+            self.intradayFrom = self.startDate if lo > 0 else None
+            self.intradayTo = self.endDate if hi < len( dates ) else None
+            self.intradayData = self.intradayData.iloc[ lo : hi ]
+
+    def window( self ):
+        """Returns the part of the daily data where trades can be taken
+        """
+        return self.data.loc[ self.startDate : self.endDate ]
+
+    def covers( self, startDate, endDate, warmup ):
+        """Checks if the loaded data is enough to simulate the given window without reloading
+        """
+        if self.data.empty:
+            return False
+        if startDate is None:
+            start = self.atHistoryStart
+        else:
+            # Without a warmup searchsorted() is always far enough in, the start itself has to be loaded
+            start = self.atHistoryStart or ( startDate >= self.data.index[ 0 ] and self.data.index.searchsorted( startDate ) >= warmup )
+        if endDate is None:
+            end = self.atHistoryEnd
+        else:
+            end = self.atHistoryEnd or endDate <= self.data.index[ -1 ]
+
+        # The intraday data has no warmup, a window reaching past the dates it was cut at needs a reload
+        if self.intradayFrom is not None and ( startDate is None or startDate < self.intradayFrom ):
+            return False
+        if self.intradayTo is not None and ( endDate is None or endDate > self.intradayTo ):
+            return False
+        return start and end
+
+    def update( self, strategyInfo, params, buy=True ):
+        """Points the engine at a re-parsed strategy, keeping the loaded data and the indicators.
+        The buy positions are kept too, unless buy is set.
+        """
+        self.strategyInfo = strategyInfo
+        self.params = params
+        self.buyStrategy = strategyInfo[ "BUY" ]
+        self.sellStrategy = strategyInfo[ "SELL" ]
+        self.startDate = pd.to_datetime( params[ "START_DATE" ] ) if params.get( "START_DATE" ) else None
+        self.endDate = pd.to_datetime( params[ "END_DATE" ] ) if params.get( "END_DATE" ) else None
+
+        self.initTradeInfo()
+        self.trades = self.trades.iloc[ 0:0 ]
+        self.openTrades = self.openTrades.iloc[ 0:0 ]
+        if buy:
+            self.positions = self.positions.iloc[ 0:0 ]
+        else:
+            # Stop losses set by the buy rules are part of the buy state
+            self.tradeInfo[ "liveStopLoss" ] = list( self.buyStopLoss )
+
     def ticker( self ):
         return self._ticker
+
+    def memoryUsage( self ):
+        """Returns the number of bytes held by the data and the trades of this engine
+        """
+        frames = [ self.data, self.intradayData, self.trades, self.positions, self.openTrades ]
+        return sum( int( f.memory_usage( deep=True ).sum() ) for f in frames if f is not None )
+
+    def memoryByColumn( self ):
+        """Returns the bytes held by every column of the daily and intraday data, with the index
+        counted as a column named "Index"
+        """
+        frames = { "daily" : self.data, "intraday" : self.intradayData }
+        usage = [ f.memory_usage( deep=True ).rename( period ) for period, f in frames.items() if f is not None and not f.empty ]
+        usage = pd.concat( usage, axis=1 ) if usage else pd.DataFrame()
+        return usage.reindex( columns=list( frames ) ).fillna( 0 ).astype( "int64" )
     
     @timer
     def executeCondition( self, condition, globalVars, localVars ):
@@ -146,11 +294,15 @@ class TradeEngine( object ):
         
         print( "{}: calculating buy trades.".format( self.ticker() ) )
 
+        if getattr( self.config, "fastEval", False ):
+            self.getBuysBatched( strategy )
+            return
+
         type = TradeType.BUY
         tradeId = 1
         env = self.params
 
-        for d in self.data.itertuples( index=True ):
+        for d in self.window().itertuples( index=True ):
             date = d.Index
             for name in strategy:
                 ( timeframe, qty, condition, priceCondition, stopLoss ) = strategy[ name ]
@@ -168,6 +320,164 @@ class TradeEngine( object ):
      
         self.positions[ 'Date' ] = pd.to_datetime( self.positions[ 'Date' ] )
 
+    def getBuysBatched( self, strategy ):
+        """Same trades as getBuys, with all the rules evaluated together. Every row of the data is made
+        into an evaluation context once and shared by all the rules, a rule is evaluated at most once per
+        row however many timeframes the row falls into, and the subexpressions the rules have in common
+        are computed once per row. 1Min rules are evaluated over a day x minute matrix of the intraday
+        data, see intradayTriggers(), the first minute and price they trigger at on every day are kept
+        in firstTriggers
+        """
+        env = self.params
+        index = self.data.index
+        rows = []
+        for d in self.data.itertuples( index=True ):
+            row = d._asdict()
+            row[ SHARED_MEMO ] = {}
+            rows += [ row ]
+
+        # Daily rules are evaluated row by row with a memo of the rows done, 1Min rules over all the
+        # minutes at once, and whatever cannot be evaluated over arrays goes through findTrade
+        exprs = [ e for rule in strategy.values() if not isIntraday( rule[ 0 ] ) for e in rule[ 2: ] ]
+        shared = sharedSubexpressions( exprs )
+        rules = []
+        self.firstTriggers = {}
+        for name, ( timeframe, qty, condition, priceCondition, stopLoss ) in strategy.items():
+            if not isIntraday( timeframe ):
+                compiled = tuple( compileShared( e, shared ) for e in ( condition, priceCondition, stopLoss ) )
+                rules += [ ( name, timeframe, qty, compiled, "rows", {} ) ]
+                continue
+
+            triggers = None
+            if ( timeframe[ 0 ], timeframe[ 2 ] ) == ( "1Min", "1Min" ) and self.intradayData is not None:
+                triggers = self.intradayTriggers( condition, priceCondition, stopLoss )
+            if triggers is None:
+                rules += [ ( name, timeframe, qty, ( condition, priceCondition, stopLoss ), "findTrade", None ) ]
+            else:
+                self.firstTriggers[ name ] = pd.DataFrame( [ hits[ 0 ][ :2 ] for hits in triggers.values() ],
+                                                           index=pd.Index( list( triggers ), name="Date" ), columns=[ "Minute", "Price" ] )
+                rules += [ ( name, timeframe, qty, ( condition, priceCondition, stopLoss ), "minutes", triggers ) ]
+
+        def _evaluate( code, row ):
+            try:
+                return eval( code, env, row ) if code is not None else None
+            except Exception:
+                exec_info = sys.exc_info()[ :2 ]
+                print( traceback.format_exception_only( *exec_info )[ -1 ].strip() )
+                return None
+
+        def _onRow( compiled, memo, j ):
+            """( price, stop loss ) if the rule triggers on row j, None otherwise
+            """
+            if j not in memo:
+                condition, priceCondition, stopLoss = compiled
+                row = rows[ j ]
+                memo[ j ] = ( _evaluate( priceCondition, row ), _evaluate( stopLoss, row ) ) if _evaluate( condition, row ) else None
+            return memo[ j ]
+
+        def _rowRange( timeframe, p ):
+            """Positions of the rows processTimeframe() returns for a buy on the row at position p
+            """
+            ( d1, t1, d2, t2 ) = timeframe
+            # Slicing a range works like iloc, negative bounds included
+            rows = range( p, len( index ) )
+            if ( d1, d2 ) == ( "Day", None ):
+                return rows[ t1 - 1 : t1 ]
+            elif ( d1, d2 ) == ( "Day", "Day" ):
+                return rows[ t1 - 1 : t2 - 1 ]
+            elif ( d1, d2 ) == ( "Day", "All" ):
+                return rows[ t1 - 1 : ] if t1 else rows
+            print( "Syntax error in timeframe" )
+            return range( 0 )
+
+        positions = []
+        for date in self.window().index:
+            p = index.searchsorted( date )
+            for ( name, timeframe, qty, compiled, how, memo ) in rules:
+                if how == "findTrade":
+                    data = self.processTimeframe( timeframe, date, startDate=date )
+                    condition, priceCondition, stopLoss = compiled
+                    self.findTrade( TradeType.BUY, data, condition, qty, priceCondition, stopLoss, qty, env )
+                    triggered = self.tradeInfo[ "triggered" ]
+                    self.tradeInfo[ "triggered" ] = []
+                elif how == "minutes":
+                    # Every minute the condition holds on is a trade, as with findTrade
+                    triggered = []
+                    for ( minute, price, stop ) in memo.get( date, () ):
+                        triggered += [ ( price, qty, minute ) ]
+                        if compiled[ 2 ]:
+                            self.tradeInfo[ "liveStopLoss" ] += [ ( stop, qty, minute ) ]
+                else:
+                    triggered = []
+                    for j in _rowRange( timeframe, p ):
+                        hit = _onRow( compiled, memo, j )
+                        if hit is None:
+                            continue
+                        price, stop = hit
+                        triggered += [ ( price, qty, index[ j ] ) ]
+                        if compiled[ 2 ] is not None:
+                            self.tradeInfo[ "liveStopLoss" ] += [ ( stop, qty, index[ j ] ) ]
+
+                for ( price, tradeQty, _ ) in triggered:
+                    positions += [ { 'Date': date, 'Type': TradeType.BUY, 'Strategy' : name, 'Price': price, 'Quantity': tradeQty, 'Ticker': self.ticker() } ]
+
+        self.positions = pd.DataFrame( positions, columns=self.positions.columns, index=range( 1, len( positions ) + 1 ) )
+        self.positions[ 'Date' ] = pd.to_datetime( self.positions[ 'Date' ] )
+
+    def intradayMatrix( self, columns ):
+        """The intraday data as trading day x minute of day arrays, one per column, with NaN where a
+        session has no bar, e.g. the afternoon of a half day. "present" marks the bars that exist.
+        Built once per ticker and column
+        """
+        data = self.intradayData
+        matrix = self.matrix
+        if "present" not in matrix:
+            present = pd.Series( True, index=data.index ).unstack( level=1, fill_value=False )
+            matrix[ "days" ] = present.index
+            matrix[ "minutes" ] = present.columns
+            matrix[ "present" ] = present.to_numpy( dtype=bool )
+        for c in columns:
+            if c not in matrix:
+                # Upcast like the rows findTrade works on, float32 arithmetic would round differently
+                column = data[ c ].unstack( level=1 ).reindex( index=matrix[ "days" ], columns=matrix[ "minutes" ] )
+                matrix[ c ] = column.to_numpy( dtype=float, na_value=np.nan )
+        return matrix
+
+    def intradayTriggers( self, condition, priceCondition, stopLoss ):
+        """Evaluates a 1Min buy rule on every minute of every day at once. Returns
+        { date : [ ( minute, price, stop loss ), ... ] } with the minutes the condition holds on in time
+        order, or None if the rule cannot be evaluated over arrays
+        """
+        exprs = ( condition, priceCondition, stopLoss )
+        columns = set().union( *( names( e ) for e in exprs ) ) & set( self.intradayData.columns )
+        try:
+            matrix = self.intradayMatrix( columns )
+            present = matrix[ "present" ]
+            local = { c : matrix[ c ] for c in columns }
+            local[ "Index" ] = np.asarray( matrix[ "minutes" ], dtype=object )[ None, : ]
+            local[ VECTOR_TRUTH ] = lambda x: np.asarray( x ).astype( bool )
+
+            with np.errstate( all="ignore" ):
+                hits = np.broadcast_to( eval( compileVectorized( condition ), self.params, local ), present.shape ) & present
+                rows, cols = np.nonzero( hits )
+                values = []
+                for e in exprs[ 1: ]:
+                    if e:
+                        values += [ np.broadcast_to( eval( compileShared( e ), self.params, local ), present.shape )[ rows, cols ].tolist() ]
+                    else:
+                        values += [ [ None ] * len( rows ) ]
+        except ( NameError, TypeError, ValueError ) as e:
+            # Expressions that only work on scalars, e.g. the min( Open, ... ) the parser wraps stop losses in,
+            # raise one of these over arrays. Anything else is a real error and is not hidden by the fallback
+            print( "{}: 1Min rule evaluated minute by minute, {}: {}".format( self.ticker(), type( e ).__name__, e ) )
+            return None
+
+        days, minutes = matrix[ "days" ], matrix[ "minutes" ]
+        triggers = {}
+        for r, c, price, stop in zip( rows.tolist(), cols.tolist(), *values ):
+            triggers.setdefault( days[ r ], [] ).append( ( minutes[ c ], price, stop ) )
+        return triggers
+
     def processTimeframe( self, timeframe, date, startDate=None, endDate=None ):
         """
         startDate : the starting date of a trade. The date the trade is taken is day 1
@@ -289,11 +599,11 @@ class TradeEngine( object ):
 
 
     def consolidateTrades( self, trades ):
-        consolidatedTrades = pd.DataFrame( columns=[ 'Date', 'SellDate', 'Type', 'BuyPrice', 'SellPrice', 'Quantity', 'OpenQty' ] )
+        consolidatedTrades = pd.DataFrame( columns=[ 'Date', 'SellDate', 'Type', 'Strategy', 'BuyPrice', 'SellPrice', 'Quantity', 'OpenQty' ] )
 
         tradeId = 1
         stack = []
-        BuyOrder = namedtuple( "BuyOrder", 'Date SellDate Type BuyPrice SellPrice Quantity OpenQty' )
+        BuyOrder = namedtuple( "BuyOrder", 'Date SellDate Type Strategy BuyPrice SellPrice Quantity OpenQty' )
         
         def _processSellTrade( qty ):
             nonlocal stack
@@ -319,7 +629,7 @@ class TradeEngine( object ):
 
         for t in trades.itertuples( index=True ):
             if t.Type == TradeType.BUY:
-                buyOrder = BuyOrder( Date=t.Date, SellDate=t.Date, Type="LONG", BuyPrice=t.Price, SellPrice=0, Quantity=t.Quantity, OpenQty=t.Quantity )
+                buyOrder = BuyOrder( Date=t.Date, SellDate=t.Date, Type="LONG", Strategy=t.Strategy, BuyPrice=t.Price, SellPrice=0, Quantity=t.Quantity, OpenQty=t.Quantity )
                 stack.append( buyOrder )
 
             elif t.Type == TradeType.SELL:
@@ -360,6 +670,7 @@ class TradeEngine( object ):
     def run( self, buy=True, sell=True ):
         if buy:
             self.getBuys( self.buyStrategy )
+            self.buyStopLoss = list( self.tradeInfo[ "liveStopLoss" ] )
         if sell:
             self.getSales( self.sellStrategy )
         self.cleanup()
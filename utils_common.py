@@ -1,6 +1,7 @@
 import os, sys, code, traceback
 import cmd
 from functools import wraps
+import threading
 import time
 
 class tcolors:
@@ -14,6 +15,7 @@ class tcolors:
 
 
 timerData = {}
+timerCalls = {}
 
 def timer( func ):
     @wraps( func )
@@ -25,6 +27,77 @@ def timer( func ):
         elapsedTime = end - start
         if func.__name__ not in timerData:
             timerData[ func.__name__ ] = 0
+            timerCalls[ func.__name__ ] = 0
         timerData[ func.__name__ ] += elapsedTime
+        timerCalls[ func.__name__ ] += 1
         return ret
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+def memoryInUse():
+    """Resident memory of this process in bytes, the peak where the current value is not available
+    """
+    try:
+        with open( "/proc/self/statm" ) as f:
+            return int( f.read().split()[ 1 ] ) * os.sysconf( "SC_PAGE_SIZE" )
+    except ( OSError, ValueError, AttributeError ):
+        import resource
+        peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MetricsBuffer( object ):
+    """Counters of the simulation in progress, updated by the simulator as every ticker finishes and
+    read by the monitoring tab of the web app. Updates are a few additions under a lock, reading
+    takes a copy, so neither side waits on the other for long
+    """
+    def __init__( self, slowest=10 ) -> None:
+        self.slowest = slowest
+        self.lock = threading.Lock()
+        self.startRun( 0 )
+
+    def startRun( self, tickers ):
+        with self.lock:
+            self.start = time.perf_counter()
+            self.end = None
+            self.tickers = tickers
+            self.done = 0
+            self.bars = 0
+            self.trades = 0
+            self.tickerTimes = {}
+            self.counters = {}
+            self.stagesAtStart = dict( timerData )
+            self.callsAtStart = dict( timerCalls )
+
+    def tickerDone( self, ticker, seconds, bars, trades ):
+        with self.lock:
+            self.done += 1
+            self.bars += bars
+            self.trades += trades
+            self.tickerTimes[ ticker ] = seconds
+
+    def setCounters( self, **counters ):
+        with self.lock:
+            self.counters.update( counters )
+
+    def endRun( self ):
+        with self.lock:
+            self.end = time.perf_counter()
+
+    def snapshot( self ):
+        with self.lock:
+            elapsed = ( self.end or time.perf_counter() ) - self.start
+            slowest = sorted( self.tickerTimes.items(), key=lambda kv: kv[ 1 ], reverse=True )[ : self.slowest ]
+            stages = { k : ( v - self.stagesAtStart.get( k, 0 ), timerCalls.get( k, 0 ) - self.callsAtStart.get( k, 0 ) )
+                       for k, v in list( timerData.items() ) }
+            return { "running" : self.end is None and self.tickers > 0,
+                     "elapsed" : elapsed,
+                     "tickers" : self.tickers,
+                     "done" : self.done,
+                     "barsPerSec" : self.bars / elapsed if elapsed else 0.0,
+                     "tradesPerSec" : self.trades / elapsed if elapsed else 0.0,
+                     "stages" : stages,
+                     "slowest" : slowest,
+                     "memory" : memoryInUse(),
+                     "counters" : dict( self.counters ) }
+
+runMetrics = MetricsBuffer()
\ No newline at end of file